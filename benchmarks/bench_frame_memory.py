@@ -0,0 +1,62 @@
+'''Compare the memory of the report data in its compact layout (categorical site and surgery labels, datetime64
+months) with the same data held as object strings, per worker and for every worker of a container. Each gunicorn
+worker unpickles its own copy of the snapshot, so the report data is held once per worker.
+
+    python benchmarks/bench_frame_memory.py --records 100000 --workers 16
+'''
+# Libraries
+import os # Operating system library
+import sys
+import pickle
+import argparse
+import tempfile
+import warnings
+
+os.environ['STAGE_LOGGING'] = 'false'
+
+import pandas as pd # Dataframe manipulations
+warnings.simplefilter('ignore', pd.errors.PerformanceWarning)
+
+from synthetic_subjects import SRC_PATH, write_subjects_files # puts src on sys.path
+from config_settings import ASSETS_PATH
+from data_processing import *
+from instrumentation import get_frame_memory
+
+def get_object_layout(value):
+    '''The frame (or dictionary of frames) with categorical columns held as object strings, as before compaction'''
+    if isinstance(value, dict):
+        return {k: get_object_layout(v) for k, v in value.items()}
+    if isinstance(value, pd.DataFrame):
+        return value.astype({col: 'object' for col in value.columns if isinstance(value[col].dtype, pd.CategoricalDtype)})
+    return value
+
+def format_mb(value):
+    return '{:.2f}'.format(value / 1024 / 1024)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=100000, help='subjects per MCC')
+    parser.add_argument('--workers', type=int, default=16, help='gunicorn workers per container')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        write_subjects_files(directory, args.records)
+        display_terms, display_terms_dict, display_terms_dict_multi = load_display_terms(ASSETS_PATH, 'A2CPS_display_terms.csv')
+        screening_sites = load_screening_sites(ASSETS_PATH, 'screening_sites.csv')
+        subjects_json = {mcc: read_subjects_frame(os.path.join(directory, 'subjects-' + str(mcc) + '-latest.json')) for mcc in [1, 2]}
+
+    enrolled = get_enrolled(subjects_json, screening_sites, display_terms_dict, display_terms_dict_multi)
+    layouts = {'compact': get_report_data(enrolled, screening_sites)}
+    layouts['object'] = get_object_layout(layouts['compact'])
+    memory = {layout: get_frame_memory(report_data) for layout, report_data in layouts.items()}
+    pickled = {layout: len(pickle.dumps(report_data, protocol=pickle.HIGHEST_PROTOCOL)) for layout, report_data in layouts.items()}
+
+    print('enrolled rows: {}, workers: {}'.format(len(enrolled), args.workers))
+    print('{:<24} {:>12} {:>12} {:>8}'.format('frame', 'object MB', 'compact MB', 'ratio'))
+    for frame in memory['object']:
+        before, after = memory['object'][frame], memory['compact'][frame]
+        print('{:<24} {:>12} {:>12} {:>7.2f}x'.format(frame, format_mb(before), format_mb(after), before / after))
+    totals = {layout: sum(frame_memory.values()) for layout, frame_memory in memory.items()}
+    print('{:<24} {:>12} {:>12} {:>7.2f}x'.format('per worker', format_mb(totals['object']), format_mb(totals['compact']), totals['object'] / totals['compact']))
+    print('{:<24} {:>12} {:>12}'.format('all workers', format_mb(totals['object'] * args.workers), format_mb(totals['compact'] * args.workers)))
+    print('{:<24} {:>12} {:>12} {:>7.2f}x'.format('snapshot pickle', format_mb(pickled['object']), format_mb(pickled['compact']), pickled['object'] / pickled['compact']))
@@ -0,0 +1,67 @@
+'''Check the vectorized enrolled cleaning stage reproduces the previous row-wise / merge-based cleaning exactly
+(once converted to the compact enrolled layout), and time both on a large synthetic subjects set.
+
+    python benchmarks/bench_get_enrolled.py --records 300000
+'''
+# Libraries
+import argparse
+import timeit
+
+import numpy as np
+import pandas as pd # Dataframe manipulations
+
+from synthetic_subjects import SRC_PATH, make_subjects_json # puts src on sys.path
+from config_settings import ASSETS_PATH
+from data_processing import (load_display_terms, load_screening_sites, combine_mcc_json, add_screening_site,
+                             use_b_if_not_a, clean_enrolled, compact_enrolled, ENROLLED_SOURCE_COLS)
+
+def clean_enrolled_previous(subjects_raw, screening_sites, display_terms_dict, display_terms_dict_multi):
+    '''The cleaning stage as it was before vectorization: one merge per display term field, element-wise date
+    parsing and a row-wise treatment site coalesce'''
+    enrolled = subjects_raw[(subjects_raw.obtain_date != 'N/A') & (subjects_raw.ewdateterm == 'N/A')][ENROLLED_SOURCE_COLS].copy()
+    enrolled.rename(columns={"index": "record_id"}, inplace = True)
+    enrolled = enrolled.replace('N/A', np.nan)
+    enrolled = enrolled.apply(pd.to_numeric, errors='ignore')
+    for i in display_terms_dict.keys():
+        if i in enrolled.columns:
+            display_terms = display_terms_dict[i].copy()
+            if enrolled[i].dtype == np.float64:
+                display_terms[i] = display_terms[i].astype('float64')
+            enrolled = enrolled.merge(display_terms, how='left', on=i)
+    enrolled = add_screening_site(screening_sites, enrolled, 'record_id')
+    enrolled['obtain_date'] = enrolled['obtain_date'] .apply(pd.to_datetime, errors='coerce')
+    enrolled['treatment_site'] = enrolled.apply(lambda x: use_b_if_not_a(x['sp_data_site_display'], x['redcap_data_access_group_display']), axis=1)
+    enrolled['treatment_site_type'] = enrolled['treatment_site'] + "/" + enrolled['surgery_type']
+    enrolled['obtain_month'] = enrolled['obtain_date'].dt.to_period('M')
+    enrolled['Site'] = enrolled['screening_site'] + ' (' + enrolled['surgery_type'] + ')'
+    return enrolled
+
+def make_subjects_raw(n_records, screening_sites):
+    '''Combined raw subjects frame of about n_records rows. The record id ranges of screening_sites.csv only hold a
+    few tens of thousands of ids per MCC, so a synthetic set is repeated to reach larger sizes.'''
+    mcc_json = {mcc: make_subjects_json(mcc, 20000, screening_sites) for mcc in [1, 2]}
+    subjects_raw = combine_mcc_json(mcc_json)
+    repeats = max(1, int(np.ceil(n_records / len(subjects_raw))))
+    return pd.concat([subjects_raw] * repeats, ignore_index=True).iloc[:n_records]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=300000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    display_terms, display_terms_dict, display_terms_dict_multi = load_display_terms(ASSETS_PATH, 'A2CPS_display_terms.csv')
+    screening_sites = load_screening_sites(ASSETS_PATH, 'screening_sites.csv')
+    subjects_raw = make_subjects_raw(args.records, screening_sites)
+    cleaning_args = (subjects_raw, screening_sites, display_terms_dict, display_terms_dict_multi)
+
+    previous = clean_enrolled_previous(*cleaning_args)
+    vectorized = clean_enrolled(*cleaning_args)
+    # The previous cleaning kept object columns and Period months; compare it in the compact layout of clean_enrolled
+    pd.testing.assert_frame_equal(compact_enrolled(previous[vectorized.columns].copy()), vectorized)
+    print('outputs identical: {} enrolled rows from {} raw records'.format(len(vectorized), len(subjects_raw)))
+
+    previous_time = min(timeit.repeat(lambda: clean_enrolled_previous(*cleaning_args), number=1, repeat=args.repeat))
+    vectorized_time = min(timeit.repeat(lambda: clean_enrolled(*cleaning_args), number=1, repeat=args.repeat))
+    print('previous:   {:.3f} s'.format(previous_time))
+    print('vectorized: {:.3f} s ({:.1f}x)'.format(vectorized_time, previous_time / vectorized_time))
@@ -0,0 +1,49 @@
+'''Compare peak RSS of reading the subjects reports as full json dictionaries against streaming ingestion. Each
+ingestion path runs in its own process so the peaks do not contaminate each other.
+
+    python benchmarks/bench_ingestion_memory.py --records 100000
+'''
+# Libraries
+import os # Operating system library
+import sys
+import argparse
+import resource
+import subprocess
+import tempfile
+
+from synthetic_subjects import SRC_PATH, write_subjects_files # puts src on sys.path
+
+def peak_rss_mb():
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def run_ingestion(mode, directory):
+    from data_processing import load_json_file, read_subjects_frame, combine_mcc_json
+    baseline = peak_rss_mb()
+    load_report = read_subjects_frame if mode == 'streaming' else load_json_file
+    mcc_json = {}
+    for mcc in [1, 2]:
+        mcc_json[mcc] = load_report(os.path.join(directory, 'subjects-' + str(mcc) + '-latest.json'))
+    subjects_raw = combine_mcc_json(mcc_json)
+    print(mode, len(subjects_raw), round(baseline, 1), round(peak_rss_mb(), 1))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=100000, help='subjects per MCC')
+    parser.add_argument('--child', nargs=2, metavar=('MODE', 'DIRECTORY'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_ingestion(*args.child)
+        sys.exit(0)
+
+    with tempfile.TemporaryDirectory() as directory:
+        filepaths = write_subjects_files(directory, args.records)
+        file_mb = sum(os.path.getsize(f) for f in filepaths) / 1024 / 1024
+        print('records per MCC: {}, report size: {:.1f} MB'.format(args.records, file_mb))
+        print('{:<10} {:>10} {:>16} {:>14} {:>14}'.format('mode', 'rows', 'baseline RSS MB', 'peak RSS MB', 'ingestion MB'))
+        for mode in ['json', 'streaming']:
+            output = subprocess.run([sys.executable, __file__, '--child', mode, directory],
+                                    capture_output=True, text=True, check=True).stdout.split()
+            rows, baseline, peak = int(output[1]), float(output[2]), float(output[3])
+            print('{:<10} {:>10} {:>16.1f} {:>14.1f} {:>14.1f}'.format(mode, rows, baseline, peak, peak - baseline))
@@ -0,0 +1,322 @@
+'''Time and memory-profile every public function in src/data_processing.py, plus the full serve_layout, against
+synthetic subjects reports, and compare the results with a stored baseline.
+
+    python benchmarks/bench_pipeline.py --update-baseline   # record a baseline on this machine
+    python benchmarks/bench_pipeline.py                     # compare with benchmarks/baselines/pipeline.json
+
+A case regresses when its best time is more than --threshold times the baseline (and slower by at least
+--min-seconds, so timing noise of fast cases is ignored) or its peak traced memory is more than --memory-threshold times
+the baseline. A case that looks slower is measured again with --confirm-repeat runs and only counts as a regression if
+its best time over all runs is still too slow, so a single noisy run does not fail the check. The script exits with
+status 1 if any case regresses, so it can gate a deployment.
+
+Baselines are specific to the machine and python environment they were recorded on, so they are not committed
+(benchmarks/baselines/ is ignored by git): record one on the machine that runs the comparison. A baseline recorded on
+another machine, python or pandas version is not compared with.
+'''
+# Libraries
+import os # Operating system library
+import sys
+import json
+import time
+import inspect
+import platform
+import argparse
+import tempfile
+import threading
+import timeit
+import tracemalloc
+import functools
+import warnings
+import atexit
+import shutil
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+# Work files of the app and pipeline go to a scratch directory, and stage logging is turned off, before any module
+# reads config_settings
+SCRATCH_PATH = tempfile.mkdtemp(prefix='bench_pipeline_')
+atexit.register(shutil.rmtree, SCRATCH_PATH, ignore_errors=True)
+for setting in ['SNAPSHOT_PATH', 'ENROLLED_STORE_PATH', 'EXPORT_PATH', 'METRICS_PATH']:
+    os.environ[setting] = os.path.join(SCRATCH_PATH, setting.lower())
+os.environ['STAGE_LOGGING'] = 'false'
+
+import pandas as pd # Dataframe manipulations
+warnings.simplefilter('ignore', pd.errors.PerformanceWarning)
+
+from synthetic_subjects import SRC_PATH, write_subjects_files # puts src on sys.path
+from config_settings import ASSETS_PATH
+import data_processing
+from data_processing import *
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines', 'pipeline.json')
+
+# ----------------------------------------------------------------------------
+# REPORT SERVER
+# ----------------------------------------------------------------------------
+
+def start_report_server(directory):
+    '''Serve directory over HTTP on a free local port so the download path, including the conditional requests of
+    fetch_mcc_json, runs as it does against the reports API. Returns the root URL.'''
+    handler = functools.partial(QuietRequestHandler, directory=directory)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return 'http://127.0.0.1:' + str(server.server_address[1])
+
+class QuietRequestHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+# ----------------------------------------------------------------------------
+# BENCHMARK CASES
+# ----------------------------------------------------------------------------
+
+def get_pipeline_cases(reports_path, file_url_root):
+    '''Return the benchmark cases as (name, function) pairs in pipeline order. Inputs of each case are computed
+    once here, so each case times only its own function.'''
+    report, report_suffix, mcc_list = 'subjects', 'subjects-[mcc]-latest.json', [1, 2]
+    download_path = os.path.join(SCRATCH_PATH, 'downloads')
+    report_filepath = os.path.join(reports_path, report, 'subjects-1-latest.json')
+
+    display_terms, display_terms_dict, display_terms_dict_multi = load_display_terms(ASSETS_PATH, 'A2CPS_display_terms.csv')
+    screening_sites = load_screening_sites(ASSETS_PATH, 'screening_sites.csv')
+    subjects_json, data_source, data_date, mcc_status = get_subjects_json(report, report_suffix, file_url_root, mcc_list, download_path)
+    full_json = {mcc: load_json_file(os.path.join(reports_path, report, report_suffix.replace('[mcc]', str(mcc)))) for mcc in mcc_list}
+    subjects_raw = combine_mcc_json(subjects_json)
+    enrolled = get_enrolled(subjects_json, screening_sites, display_terms_dict, display_terms_dict_multi)
+    report_data = get_report_data(enrolled, screening_sites)
+    base_rollup = report_data['base_rollup']
+    enrollment_count = report_data['enrollment_count']
+    expectations = get_enrollment_expectations()
+    monthly_expectations = get_enrollment_expectations_monthly(expectations)
+    summary_rollup = report_data['summary_rollup']
+    summary_table = summary_rollup[summary_rollup.mcc == 1].set_index('Month')[['Date: Year', 'Date: Month', 'Actual: Monthly', 'Actual: Cumulative']]
+    mcc1_enrollments = report_data['site_enrollments'][1]
+    month_groups = base_rollup.groupby(BASE_ROLLUP_COLS, observed=True)['obtain_month']
+    first_months = month_groups.min().reset_index()
+    last_month = base_rollup['obtain_month'].max()
+    # A refresh where 1% of the enrolled records changed: the old rows are removed and the new ones added
+    churn = enrolled.iloc[:max(len(enrolled) // 100, 1)]
+    month_ordinals = get_month_ordinals(enrolled['obtain_month'])
+    enrollment_cube = report_data['enrollment_cube']
+    forecast_labels, forecast_monthly = get_forecast_series(enrollment_cube)
+    forecast_first_months = (forecast_monthly > 0).argmax(axis=1)
+
+    def read_records():
+        with open(report_filepath, 'rb') as f:
+            for record in iter_subjects_records(f):
+                pass
+
+    cases = [
+        ('load_report_config', lambda: load_report_config(ASSETS_PATH, 'report_config.json')),
+        ('get_time_parameters', lambda: get_time_parameters(datetime.now())),
+        ('use_b_if_not_a', lambda: [use_b_if_not_a(a, 'b') for a in subjects_raw['sp_data_site'].head(1000)]),
+        ('load_display_terms', lambda: load_display_terms(ASSETS_PATH, 'A2CPS_display_terms.csv')),
+        ('get_display_dictionary', lambda: get_display_dictionary(display_terms[display_terms.multi == 0], 'api_field', 'api_value', 'display_text')),
+        ('get_display_maps', lambda: get_display_maps(display_terms_dict)),
+        ('get_http_session', get_http_session),
+        ('load_json_file', lambda: load_json_file(report_filepath)),
+        ('iter_subjects_records', read_records),
+        ('read_subjects_frame', lambda: read_subjects_frame(report_filepath)),
+        # The downloads exist after the first call, so repeats measure the conditional 304 path
+        ('fetch_mcc_json', lambda: fetch_mcc_json(file_url_root + '/subjects/subjects-1-latest.json',
+                                                  os.path.join(download_path, 'subjects-1-latest.json'), read_subjects_frame)),
+        ('load_mcc_json', lambda: load_mcc_json(1, file_url_root + '/subjects/subjects-1-latest.json',
+                                                os.path.join(download_path, 'subjects-1-latest.json'), read_subjects_frame)),
+        ('get_report_meta_filepath', lambda: get_report_meta_filepath(os.path.join(download_path, 'subjects-1-latest.json'))),
+        ('read_report_meta', lambda: read_report_meta(os.path.join(download_path, 'subjects-1-latest.json'))),
+        ('write_report_meta', lambda: write_report_meta(os.path.join(download_path, 'subjects-1-latest.json'),
+                                                        read_report_meta(os.path.join(download_path, 'subjects-1-latest.json')))),
+        ('format_fetch_date', lambda: format_fetch_date(time.time())),
+        ('get_subjects_json', lambda: get_subjects_json(report, report_suffix, file_url_root, mcc_list, download_path)),
+        ('combine_mcc_json', lambda: combine_mcc_json(subjects_json)),
+        ('combine_mcc_json_full_json', lambda: combine_mcc_json(full_json)),
+        ('build_screening_site_index', lambda: build_screening_site_index(screening_sites)),
+        ('build_site_targets', lambda: build_site_targets(screening_sites)),
+        ('get_site_targets', lambda: get_site_targets(screening_sites)),
+        ('load_screening_sites', lambda: load_screening_sites(ASSETS_PATH, 'screening_sites.csv')),
+        ('add_screening_site', lambda: add_screening_site(screening_sites, subjects_raw, 'index')),
+        ('get_enrolled', lambda: get_enrolled(subjects_json, screening_sites, display_terms_dict, display_terms_dict_multi)),
+        ('clean_enrolled', lambda: clean_enrolled(subjects_raw, screening_sites, display_terms_dict, display_terms_dict_multi)),
+        ('compact_enrolled', lambda: compact_enrolled(enrolled.copy())),
+        ('get_month_start', lambda: get_month_start(enrolled['obtain_date'])),
+        ('get_month_ordinals', lambda: get_month_ordinals(enrolled['obtain_month'])),
+        ('get_months_from_ordinals', lambda: get_months_from_ordinals(month_ordinals)),
+        ('get_month_grid', lambda: get_month_grid(first_months[BASE_ROLLUP_COLS], first_months['obtain_month'], last_month, 'obtain_month')),
+        ('fill_missing_months', lambda: fill_missing_months(base_rollup, 'obtain_month', BASE_ROLLUP_COLS, 'Monthly')),
+        ('enrollment_rollup', lambda: enrollment_rollup(enrolled, 'obtain_month', BASE_ROLLUP_COLS, 'Monthly')),
+        ('get_base_rollup', lambda: get_base_rollup(enrolled)),
+        ('get_site_enrollments', lambda: get_site_enrollments(enrollment_count, 1)),
+        ('get_enrollment_expectations', get_enrollment_expectations),
+        ('get_enrollment_expectations_monthly', lambda: get_enrollment_expectations_monthly(expectations)),
+        ('get_site_expectations_monthly', lambda: get_site_expectations_monthly(screening_sites)),
+        ('rollup_enrollment_expectations', lambda: rollup_enrollment_expectations(base_rollup, expectations, monthly_expectations, count_col='Monthly')),
+        ('get_plot_date', lambda: get_plot_date(base_rollup, summary_rollup, count_col='Monthly')),
+        ('get_enrollment_cube', lambda: get_enrollment_cube(base_rollup)),
+        ('query_enrollment_cube', lambda: query_enrollment_cube(enrollment_cube, enrollment_cube['months'][1], enrollment_cube['months'][-2], [1])),
+        ('get_site_performance', lambda: get_site_performance(enrollment_cube, screening_sites)),
+        ('get_forecast_series', lambda: get_forecast_series(enrollment_cube)),
+        ('forecast_rolling_rate', lambda: forecast_rolling_rate(forecast_monthly, forecast_first_months)),
+        ('forecast_exponential_smoothing', lambda: forecast_exponential_smoothing(forecast_monthly, forecast_first_months)),
+        ('get_enrollment_targets', lambda: get_enrollment_targets(forecast_labels, report_data['site_expectations'])),
+        ('get_enrollment_forecast', lambda: get_enrollment_forecast(enrollment_cube, report_data['site_expectations'])),
+        ('update_base_rollup', lambda: update_base_rollup(base_rollup, churn, churn, enrolled)),
+        ('get_report_data', lambda: get_report_data(enrolled, screening_sites)),
+        ('get_report_data_incremental', lambda: get_report_data(enrolled, screening_sites,
+                                                                base_rollup=update_base_rollup(base_rollup, churn, churn, enrolled))),
+        ('create_multiindex', lambda: create_multiindex(summary_table.copy(), ': ')),
+        ('convert_to_multindex', lambda: convert_to_multindex(summary_table.copy())),
+        ('datatable_frame_multiindex', lambda: datatable_frame_multiindex(mcc1_enrollments.copy())),
+        ('datatable_settings_multiindex', lambda: datatable_settings_multiindex(mcc1_enrollments.copy())),
+    ]
+    return cases
+
+def get_layout_cases(reports_path, file_url_root):
+    '''Benchmark cases of the full page: serve_layout with the snapshot rebuilt from the reports (cold) and with the
+    published snapshot (warm), and the layout request of a browser: answered from the worker's response cache, built,
+    serialized and compressed when the cache is empty, and revalidated with its ETag'''
+    import pathlib
+    import snapshot_cache
+    import response_cache
+    import app
+
+    app.DATA_PATH = pathlib.Path(os.path.join(SCRATCH_PATH, 'app_downloads'))
+    app.file_url_root = file_url_root
+    # Keep the background refresher from rebuilding snapshots while cases are timed
+    app.start_snapshot_refresher = lambda *args, **kwargs: None
+    client = app.server.test_client()
+
+    def serve_layout_cold():
+        snapshot_filepath = snapshot_cache.get_snapshot_filepath(app.snapshot_name)
+        if os.path.exists(snapshot_filepath):
+            os.remove(snapshot_filepath)
+        app._rendered_tabs.clear()
+        app._report_tables.clear()
+        return app.serve_layout()
+
+    browser_headers = {'Accept-Encoding': 'gzip, deflate, br'}
+
+    def layout_request(headers = browser_headers):
+        response = client.get('/_dash-layout', headers=headers)
+        response.close()
+        return response
+
+    def layout_request_uncached():
+        response_cache._response_cache.clear()
+        return layout_request()
+
+    layout_etag = {}
+
+    def layout_revalidate():
+        if 'etag' not in layout_etag:
+            layout_etag['etag'] = layout_request().headers['ETag']
+        return layout_request(dict(browser_headers, **{'If-None-Match': layout_etag['etag']}))
+
+    return [
+        ('serve_layout_cold', serve_layout_cold),
+        ('serve_layout', app.serve_layout),
+        ('layout_request', layout_request),
+        ('layout_request_uncached', layout_request_uncached),
+        ('layout_revalidate', layout_revalidate),
+    ]
+
+def get_unbenchmarked_functions(cases):
+    '''Public functions defined in data_processing without a benchmark case of the same name'''
+    case_names = set(name for name, case in cases)
+    public_functions = [name for name, member in inspect.getmembers(data_processing, inspect.isfunction)
+                        if member.__module__ == 'data_processing' and not name.startswith('_')]
+    return [name for name in public_functions if name not in case_names]
+
+# ----------------------------------------------------------------------------
+# MEASUREMENT
+# ----------------------------------------------------------------------------
+
+def measure_case(case, repeat):
+    '''Best wall time of repeat runs, then the peak python memory traced over one more run'''
+    seconds = min(timeit.repeat(case, number=1, repeat=repeat))
+    tracemalloc.start()
+    case()
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'seconds': seconds, 'peak_bytes': peak_bytes}
+
+def compare_with_baseline(results, baseline, threshold, memory_threshold, min_seconds):
+    '''Return the regressions of results against the baseline as (case, measure, baseline value, value) tuples'''
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline['cases']:
+            continue
+        base = baseline['cases'][name]
+        if result['seconds'] > base['seconds'] * threshold and result['seconds'] - base['seconds'] > min_seconds:
+            regressions.append((name, 'seconds', base['seconds'], result['seconds']))
+        if base['peak_bytes'] and result['peak_bytes'] > base['peak_bytes'] * memory_threshold:
+            regressions.append((name, 'peak_bytes', base['peak_bytes'], result['peak_bytes']))
+    return regressions
+
+def get_environment():
+    return {'python': platform.python_version(), 'pandas': pd.__version__, 'machine': platform.platform()}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=20000, help='subjects per MCC')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--update-baseline', action='store_true', help='record the results as the new baseline')
+    parser.add_argument('--threshold', type=float, default=1.5, help='allowed ratio of time to the baseline')
+    parser.add_argument('--memory-threshold', type=float, default=1.25, help='allowed ratio of peak memory to the baseline')
+    parser.add_argument('--min-seconds', type=float, default=0.05, help='time differences below this are noise')
+    parser.add_argument('--confirm-repeat', type=int, default=10, help='runs of a case that looks slower before it counts as a regression')
+    parser.add_argument('--cases', nargs='+', help='only run these cases')
+    args = parser.parse_args()
+
+    reports_path = os.path.join(SCRATCH_PATH, 'reports')
+    write_subjects_files(os.path.join(reports_path, 'subjects'), args.records)
+    file_url_root = start_report_server(reports_path)
+
+    cases = get_pipeline_cases(reports_path, file_url_root) + get_layout_cases(reports_path, file_url_root)
+    unbenchmarked = get_unbenchmarked_functions(cases)
+    if unbenchmarked:
+        print('no benchmark case for: ' + ', '.join(unbenchmarked))
+    if args.cases:
+        cases = [(name, case) for name, case in cases if name in args.cases]
+
+    baseline = None
+    if os.path.exists(args.baseline) and not args.update_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('records') != args.records:
+            print('baseline was recorded with {} records per MCC; not comparing'.format(baseline.get('records')))
+            baseline = None
+        elif any(baseline.get(key) != value for key, value in get_environment().items()):
+            print('baseline was recorded on {} with python {} and pandas {}; not comparing'.format(
+                baseline.get('machine'), baseline.get('python'), baseline.get('pandas')))
+            baseline = None
+
+    results = {}
+    print('{:<38} {:>12} {:>14} {:>12}'.format('case', 'seconds', 'peak MB', 'vs baseline'))
+    for name, case in cases:
+        results[name] = measure_case(case, args.repeat)
+        ratio = ''
+        if baseline and name in baseline['cases'] and baseline['cases'][name]['seconds']:
+            ratio = '{:.2f}x'.format(results[name]['seconds'] / baseline['cases'][name]['seconds'])
+        print('{:<38} {:>12.4f} {:>14.2f} {:>12}'.format(name, results[name]['seconds'], results[name]['peak_bytes'] / 1024 / 1024, ratio))
+
+    if args.update_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w') as f:
+            json.dump(dict(get_environment(), records=args.records, recorded=time.strftime('%Y-%m-%d'), cases=results), f, indent=2)
+        print('baseline written to ' + args.baseline)
+    elif baseline:
+        regressions = compare_with_baseline(results, baseline, args.threshold, args.memory_threshold, args.min_seconds)
+        slower_cases = set(name for name, measure, base_value, value in regressions if measure == 'seconds')
+        for name, case in cases:
+            if name in slower_cases:
+                seconds = min(timeit.repeat(case, number=1, repeat=args.confirm_repeat))
+                print('{:<38} {:>12.4f} (confirming over {} more runs)'.format(name, seconds, args.confirm_repeat))
+                results[name]['seconds'] = min(results[name]['seconds'], seconds)
+        if slower_cases:
+            regressions = compare_with_baseline(results, baseline, args.threshold, args.memory_threshold, args.min_seconds)
+        for name, measure, base_value, value in regressions:
+            print('REGRESSION {}: {} {:.4g} -> {:.4g} ({:.2f}x)'.format(name, measure, base_value, value, value / base_value))
+        if regressions:
+            sys.exit(1)
+        print('no regressions against ' + args.baseline)
@@ -0,0 +1,64 @@
+'''Time add_screening_site's interval lookup against the in-memory SQLite range join it replaced, and check both
+give the same pairing of record ids to screening sites.
+
+    python benchmarks/bench_screening_site.py --sizes 10000 100000 1000000
+'''
+# Libraries
+import argparse
+import sqlite3
+import timeit
+
+import numpy as np
+import pandas as pd # Dataframe manipulations
+
+from synthetic_subjects import SRC_PATH # puts src on sys.path
+from config_settings import ASSETS_PATH
+from data_processing import load_screening_sites, build_screening_site_index, add_screening_site
+
+def add_screening_site_sqlite(screening_sites, df, id_col):
+    '''The SQLite BETWEEN join previously used by add_screening_site'''
+    ids = df.loc[:, [id_col]]
+    conn = sqlite3.connect(':memory:')
+    ids.to_sql('ids', conn, index=False)
+    screening_sites.to_sql('ss', conn, index=False)
+    sql_qry = f'''
+    select {id_col}, screening_site, site, surgery_type, record_id_start, record_id_end
+    from ids
+    join ss on
+    ids.{id_col} between ss.record_id_start and ss.record_id_end
+    '''
+    sites = pd.read_sql_query(sql_qry, conn)
+    conn.close()
+    return sites.merge(df, how='left', on=id_col)
+
+def make_records(n_records, screening_sites, seed = 0):
+    '''Record ids spread over the screening site ranges, with a few outside every range. The ranges only hold
+    ~140k ids, so larger sizes repeat ids.'''
+    rng = np.random.default_rng(seed)
+    low, high = screening_sites.record_id_start.min() - 5000, screening_sites.record_id_end.max() + 5000
+    record_ids = rng.choice(np.arange(low, high), size=n_records, replace=n_records > high - low)
+    return pd.DataFrame({'record_id': record_ids, 'mcc': rng.integers(1, 3, n_records)})
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    screening_sites = load_screening_sites(ASSETS_PATH, 'screening_sites.csv')
+    index_time = min(timeit.repeat(lambda: build_screening_site_index(screening_sites), number=1, repeat=args.repeat))
+    print('interval index build: {:.3f} ms'.format(index_time * 1000))
+    print('{:>10} {:>12} {:>14} {:>10}'.format('records', 'sqlite s', 'interval s', 'speedup'))
+    for n_records in args.sizes:
+        records = make_records(n_records, screening_sites)
+        sqlite_result = add_screening_site_sqlite(screening_sites, records, 'record_id')
+        interval_result = add_screening_site(screening_sites, records, 'record_id')
+        # The SQLite join followed by the merge on record_id returns k * k rows for an id repeated k times, so
+        # compare the distinct rows
+        pd.testing.assert_frame_equal(
+            sqlite_result.drop_duplicates().sort_values(['record_id', 'mcc']).reset_index(drop=True),
+            interval_result.drop_duplicates().sort_values(['record_id', 'mcc']).reset_index(drop=True), check_dtype=False)
+
+        sqlite_time = min(timeit.repeat(lambda: add_screening_site_sqlite(screening_sites, records, 'record_id'), number=1, repeat=args.repeat))
+        interval_time = min(timeit.repeat(lambda: add_screening_site(screening_sites, records, 'record_id'), number=1, repeat=args.repeat))
+        print('{:>10} {:>12.4f} {:>14.4f} {:>9.1f}x'.format(n_records, sqlite_time, interval_time, sqlite_time / interval_time))
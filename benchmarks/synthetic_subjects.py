@@ -0,0 +1,78 @@
+'''Generate synthetic subjects-[mcc]-latest.json reports shaped like the A2CPS subjects API output, for benchmarking
+the data processing pipeline without access to the real data.'''
+# Libraries
+import os # Operating system library
+import sys
+import json
+import random
+import argparse
+from datetime import date, timedelta
+
+import pandas as pd # Dataframe manipulations
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC_PATH)
+from config_settings import ASSETS_PATH
+
+# Data access group and treatment site codes by MCC, from A2CPS_display_terms.csv
+ACCESS_GROUPS = {1: ['rush_university_me', 'northshore', 'uchicago'],
+                 2: ['university_of_mich', 'wayne_state', 'spectrum_health']}
+SP_DATA_SITES = {1: ['N/A'], 2: ['N/A', '1', '2', '3']}
+
+def random_date(rng, start, end):
+    return start + timedelta(days=rng.randint(0, (end - start).days))
+
+def make_subjects_json(mcc, n_records, screening_sites, consent_rate = 0.8, withdrawal_rate = 0.05, seed = 0):
+    '''Return a subjects report dictionary for one MCC with n_records subjects. Record ids fall inside the
+    screening_sites.csv record_id ranges for the MCC and missing values use the API's 'N/A' sentinel.'''
+    rng = random.Random(seed * 100 + mcc)
+    mcc_sites = screening_sites[screening_sites.mcc == mcc]
+    ranges = list(zip(mcc_sites.record_id_start, mcc_sites.record_id_end))
+    available_ids = sum(end - start + 1 for start, end in ranges)
+    if n_records > available_ids:
+        raise ValueError('MCC{} screening site ranges only hold {} record ids'.format(mcc, available_ids))
+    start, end = date(2021, 3, 1), date.today()
+    subjects = {}
+    while len(subjects) < n_records:
+        record_id_start, record_id_end = rng.choice(ranges)
+        record_id = str(rng.randint(record_id_start, record_id_end))
+        consented = rng.random() < consent_rate
+        obtain_date = random_date(rng, start, end) if consented else None
+        withdrawn = consented and rng.random() < withdrawal_rate
+        subjects[record_id] = {
+            'main_record_id': record_id if rng.random() < 0.9 else 'N/A',
+            'obtain_date': obtain_date.isoformat() if consented else 'N/A',
+            'ewdateterm': random_date(rng, obtain_date, end).isoformat() if withdrawn else 'N/A',
+            'ewprimaryreason': str(rng.randint(1, 4)) if withdrawn else 'N/A',
+            'redcap_data_access_group': rng.choice(ACCESS_GROUPS[mcc]),
+            'sp_data_site': rng.choice(SP_DATA_SITES[mcc]),
+            'sex': rng.choice(['1', '2', 'N/A']),
+            'dem_race': rng.choice(['1', '2', '3', '4', '5', 'N/A']),
+            'ethnic': rng.choice(['1', '2', '3', 'N/A']),
+            'age': str(rng.randint(18, 90)),
+            'surgery_date': random_date(rng, start, end).isoformat() if consented else 'N/A',
+            'baseline_visit': rng.choice(['complete', 'pending', 'N/A']),
+        }
+    return subjects
+
+def write_subjects_files(directory, n_records, mcc_list = [1, 2], seed = 0, report_suffix = 'subjects-[mcc]-latest.json'):
+    '''Write one synthetic report per MCC into directory and return the file paths'''
+    screening_sites = pd.read_csv(os.path.join(ASSETS_PATH, 'screening_sites.csv'))
+    os.makedirs(directory, exist_ok=True)
+    filepaths = []
+    for mcc in mcc_list:
+        filepath = os.path.join(directory, report_suffix.replace('[mcc]', str(mcc)))
+        with open(filepath, 'w') as f:
+            json.dump(make_subjects_json(mcc, n_records, screening_sites, seed=seed), f)
+        filepaths.append(filepath)
+    return filepaths
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('directory')
+    parser.add_argument('--records', type=int, default=10000, help='subjects per MCC')
+    parser.add_argument('--mcc', type=int, nargs='+', default=[1, 2])
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    for filepath in write_subjects_files(args.directory, args.records, args.mcc, args.seed):
+        print(filepath)
@@ -2,27 +2,29 @@
 # PYTHON LIBRARIES
 # ----------------------------------------------------------------------------
 import dash_bootstrap_components as dbc
-from dash import Dash, callback, clientside_callback, html, dcc, dash_table as dt, Input, Output, State, MATCH, ALL
+from dash import Dash, html, dcc, dash_table as dt, Input, Output, State, MATCH
 from dash.exceptions import PreventUpdate
-import dash_daq as daq
-
-from dash_extensions import Download
-from dash_extensions.snippets import send_file
 
 
 # import local modules
 from config_settings import *
 from data_processing import *
+from snapshot_cache import *
+from enrolled_store import *
+from report_export import *
+from static_report import *
+from response_cache import *
+from instrumentation import *
 
 from styling import *
+from make_components import *
 
-# for export
-import io
-# import flask
+import time
 
-# Plotly graphing
-# import plotly.graph_objects as go
-import plotly.express as px
+# for export
+import json
+import flask
+from flask_compress import Compress
 
 # ----------------------------------------------------------------------------
 # DEBUGGING
@@ -49,13 +51,21 @@ app = Dash(__name__,
 # ----------------------------------------------------------------------------
 # POINTERS TO DATA FILES AND APIS
 # ----------------------------------------------------------------------------
-display_terms_file = 'A2CPS_display_terms.csv'
+# MCCs, report files and expectation tables are declared in the report configuration file
+report_config = load_report_config(ASSETS_PATH, REPORT_CONFIG_FILE)
+display_terms_file = report_config['display_terms_file']
+screening_sites_file = report_config['screening_sites_file']
+enrollment_expectations_file = report_config['enrollment_expectations_file']
 
 # Directions for locating file at TACC
-file_url_root ='https://api.a2cps.org/files/v2/download/public/system/a2cps.storage.community/reports'
-report = 'subjects'
-report_suffix = report + '-[mcc]-latest.json'
-mcc_list=[1,2]
+file_url_root = os.environ.get('FILE_URL_ROOT', 'https://api.a2cps.org/files/v2/download/public/system/a2cps.storage.community/reports')
+report = report_config['report']
+report_suffix = report_config['report_suffix']
+mcc_list = report_config['mcc_list']
+
+# Files the snapshot is built from, besides the subjects data: a change to any of them is a new snapshot version
+snapshot_asset_files = [os.path.join(ASSETS_PATH, asset_file) for asset_file in
+                        [REPORT_CONFIG_FILE, display_terms_file, screening_sites_file, enrollment_expectations_file]]
 
 
 # ----------------------------------------------------------------------------
@@ -66,7 +76,15 @@ def build_datatable_multi(df, table_id, fill_width = False):
     new_datatable = build_datatable(table_id, table_columns, table_data, fill_width)
     return new_datatable
 
-def build_datatable(table_id, table_columns, table_data, fill_width = False):
+def build_datatable(table_id, table_columns, table_data, fill_width = False, page_size = None, page_count = None):
+    ''' With page_size, the table is paged, sorted and filtered server side: table_data holds only the first page and
+    the update_paged_table callback supplies the rest.'''
+    if page_size:
+        server_side_settings = dict(page_action='custom', page_current=0, page_size=page_size, page_count=page_count,
+                                    sort_action='custom', sort_mode='multi', sort_by=[],
+                                    filter_action='custom', filter_query='')
+    else:
+        server_side_settings = {}
     try:
         new_datatable =  dt.DataTable(
                 id = table_id,
@@ -96,6 +114,7 @@ def build_datatable(table_id, table_columns, table_data, fill_width = False):
                 style_table={'overflowX': 'auto'},
                 # export_format="csv",
                 merge_duplicate_headers=True,
+                **server_side_settings
             )
         return new_datatable
     except Exception as e:
@@ -103,117 +122,482 @@ def build_datatable(table_id, table_columns, table_data, fill_width = False):
         return None
 
 # ----------------------------------------------------------------------------
-# DASH APP LAYOUT FUNCTION
+# DATA SNAPSHOT
 # ----------------------------------------------------------------------------
-def serve_layout():
-    page_meta_dict, enrollment_dict = {'report_date_msg':''}, {}
-    report_date = datetime.now()
-    report_children = ['exception']
-
-    # try:
-    # get data for page
-    # print('time parameters')
-    today, start_report, end_report, report_date_msg, report_range_msg  = get_time_parameters(report_date)
-    page_meta_dict['report_date_msg'] = report_date_msg
-    page_meta_dict['report_range_msg'] = report_range_msg
-    # print('get data inputs')
-
-    # display_terms, display_terms_dict, display_terms_dict_multi, clean_weekly, consented, screening_data, clean_adverse, centers_df, r_status = get_data_for_page(ASSETS_PATH, display_terms_file, file_url_root, report, report_suffix, mcc_list)
-    display_terms, display_terms_dict, display_terms_dict_multi = load_display_terms(ASSETS_PATH, 'A2CPS_display_terms.csv')
-    screening_sites = pd.read_csv(os.path.join(ASSETS_PATH, 'screening_sites.csv'))
-
-    # Run Data Calls
-    # print(os.path.join(DATA_PATH,'test_file.txt'))
-    # try:
-    subjects_json, data_source, data_date = get_subjects_json(report, report_suffix,file_url_root, mcc_list =[1,2],  DATA_PATH = DATA_PATH)
-    page_meta_dict['data_source'] = data_source
-    page_meta_dict['data_date'] = data_date
-    # except:
-    #     subjects_json = get_subjects_json(report, report_suffix,file_url_root, mcc_list =[1,2], source='local', DATA_PATH = DATA_PATH)
-    #     page_meta_dict['data_source'] = 'loca data files'
-    #     page_meta_dict['data_date'] = '06/15/2022'
-
-    print(page_meta_dict['data_source'])
-    print(page_meta_dict['data_date'])
-
-    if subjects_json:
-    ### DATA PROCESSING
-        enrolled = get_enrolled(subjects_json, screening_sites, display_terms_dict, display_terms_dict_multi)
-        enrollment_count = enrollment_rollup(enrolled, 'obtain_month', ['mcc','screening_site','surgery_type','Site'], 'Monthly')
-        mcc1_enrollments = get_site_enrollments(enrollment_count, 1).reset_index()
-        mcc2_enrollments = get_site_enrollments(enrollment_count, 2).reset_index()
-        enrollment_expectations_df = get_enrollment_expectations()
-        monthly_expectations = get_enrollment_expectations_monthly(enrollment_expectations_df)
-        summary_rollup = rollup_enrollment_expectations(enrolled, enrollment_expectations_df, monthly_expectations)
-        expected_plot_df = get_plot_date(enrolled, summary_rollup)
-        summary_options_list = [(x, y) for x in summary_rollup.mcc.unique() for y in summary_rollup.surgery_type.unique()]
-        tab_summary_content_children = []
-        for tup in summary_options_list:
-            tup_summary = summary_rollup[(summary_rollup.mcc == tup[0]) & (summary_rollup.surgery_type == tup[1])]
+# The number at the end changes whenever the content of the snapshot changes, so snapshots published by an older
+# version of the app are not read
+snapshot_name = 'enrollment_report-7'
+
+@instrument_stage('build_summary_figures', rows_out=False)
+def build_summary_figures(report_data):
+    '''Build the cumulative enrollment figure dictionary for each mcc / surgery type combination, with the
+    projected enrollment of each forecasting method'''
+    summary_rollup = report_data['summary_rollup']
+    expected_plot_df = report_data['expected_plot_df']
+    projections = report_data['enrollment_forecast']['projections']
+    mcc_projections = projections[projections.level == 'mcc']
+    figures = {}
+    for tup in report_data['summary_options_list']:
+        tup_summary = summary_rollup[(summary_rollup.mcc == tup[0]) & (summary_rollup.surgery_type == tup[1])]
+        if len(tup_summary) > 0:
             plot_df = expected_plot_df[(expected_plot_df.mcc == tup[0]) & (expected_plot_df.surgery_type == tup[1])]
+            tup_projections = mcc_projections[(mcc_projections.mcc == tup[0]) & (mcc_projections.surgery_type == tup[1])]
+            plot_df = pd.concat([plot_df, tup_projections[['Month', 'Cumulative', 'type']]], ignore_index=True)
+            plot_title = 'Cumulative enrollment: MCC' + str(tup[0])+' ('+tup[1] +')'
+            figures[tup] = build_line_figure(plot_df, x="Month", y="Cumulative", color='type', title=plot_title,
+                                             typed_arrays=FIGURE_TYPED_ARRAYS)
+    return figures
+
+@instrument_stage('build_snapshot', rows_out=False)
+def build_snapshot(previous_snapshot = None):
+    '''Fetch the subjects data and run the processing pipeline. If the upstream data, the asset files and the report
+    month have not changed since the previous snapshot, the previous results are reused and only the page metadata
+    is refreshed. Otherwise the records that are new, changed or withdrawn since the previous snapshot are applied
+    to its rollups.'''
+    subjects_json, data_source, data_date, mcc_status = get_subjects_json(report, report_suffix,file_url_root, mcc_list = mcc_list,  DATA_PATH = DATA_PATH)
+    page_meta_dict = {'data_source': data_source, 'data_date': data_date, 'mcc_status': mcc_status}
+
+    # Never replace a report that has every MCC with one that is missing some: keep serving the last good snapshot
+    # and let the refresher try again
+    unavailable_mccs = [str(mcc) for mcc, status in mcc_status.items() if status['source'] == 'unavailable']
+    if unavailable_mccs and previous_snapshot and previous_snapshot.get('report_data'):
+        raise RuntimeError('No subjects data for MCC ' + ', '.join(unavailable_mccs) + '; keeping the last good snapshot')
+
+    version = get_snapshot_version(subjects_json, snapshot_asset_files)
+    if previous_snapshot and previous_snapshot.get('version') == version:
+        snapshot = dict(previous_snapshot)
+        snapshot['page_meta'] = page_meta_dict
+        return snapshot
+
+    snapshot = {'version': version, 'page_meta': page_meta_dict, 'report_data': None, 'figures': {}}
+    if subjects_json:
+        display_terms_registry = get_display_terms_registry(ASSETS_PATH, display_terms_file)
+        screening_sites = load_screening_sites(ASSETS_PATH, screening_sites_file)
+        delta = get_enrolled_delta(subjects_json, screening_sites, display_terms_registry['uni'], display_terms_registry['multi'])
+        if delta is not None:
+            enrolled = delta['enrolled']
+            enrollment_expectations_df = get_enrollment_expectations(ASSETS_PATH, enrollment_expectations_file)
+            # The previous base rollup can be brought up to date with the delta only if it was built from the store
+            # the delta was taken against; otherwise (first run, the store was rebuilt for changed display terms or
+            # screening sites, or another worker's snapshot) every row is rolled up again
+            base_rollup = None
+            previous_report_data = previous_snapshot.get('report_data') if previous_snapshot else None
+            if (previous_report_data and not delta['rebuilt'] and delta['previous_generation']
+                    and previous_snapshot.get('enrolled_generation') == delta['previous_generation']):
+                base_rollup = update_base_rollup(previous_report_data['base_rollup'], delta['added'], delta['removed'], enrolled)
+            report_data = get_report_data(enrolled, screening_sites, enrollment_expectations_df, mcc_list, base_rollup)
+            snapshot['report_data'] = report_data
+            snapshot['enrolled_generation'] = delta['generation']
+            snapshot['figures'] = build_summary_figures(report_data)
+
+    return snapshot
+
+def build_freshness_list(mcc_status):
+    '''Show where each MCC's data came from and when it was last received from the API'''
+    freshness_items = []
+    for mcc, status in mcc_status.items():
+        if status['fetched']:
+            fetched = datetime.fromtimestamp(status['fetched']).strftime('%m/%d/%Y %H:%M')
+        else:
+            fetched = 'never'
+        if status['source'] == 'API':
+            item_text = 'MCC' + str(mcc) + ': updated ' + fetched
+            item_style = {}
+        elif status['source'] == 'last good copy':
+            item_text = 'MCC' + str(mcc) + ': API unavailable, showing data from ' + fetched
+            item_style = {'color': '#b35c00'}
+        else:
+            item_text = 'MCC' + str(mcc) + ': no data available'
+            item_style = {'color': '#a00'}
+        freshness_items.append(html.Li(item_text, style=item_style))
+    return html.Ul(freshness_items, style={'list-style': 'none', 'padding-left': 0, 'font-size': 'small'})
 
-            if len(tup_summary) > 0:
-                table_cols = ['Date: Year', 'Date: Month', 'Actual: Monthly', 'Actual: Cumulative',
-                                'Expected: Monthly', 'Expected: Cumulative', 'Percent: Monthly','Percent: Cumulative']
-                tup_df = tup_summary.set_index('Month')[table_cols].sort_index(ascending=True)
-                tup_stup_table_df = convert_to_multindex(tup_df)
-                table_id = 'table_mcc'+ str(tup[0])+'_'+tup[1]
-                figure_id = 'figure_mcc'+ str(tup[0])+'_'+tup[1]
-                tup_table = build_datatable_multi(tup_stup_table_df, table_id)
-                plot_title = 'Cumulative enrollment: MCC' + str(tup[0])+' ('+tup[1] +')'
-                tup_fig = px.line(plot_df, x="Month", y="Cumulative", title=plot_title, color = 'type')
-                tup_fig_div = dcc.Graph(figure = tup_fig, id=figure_id)
-            else:
-                tup_message = 'There is currently no data for ' + tup[1] + ' surgeries at MCC' + str(tup[0])
-                tup_table = html.Div(tup_message)
-                tup_fig_div = html.Div()
-
-            tup_section = html.Div([
-                dbc.Row([
-                    dbc.Col([html.H2('MCC' + str(tup[0]) + ': ' + tup[1]),])
-                ]),
-                dbc.Row([
-                    dbc.Col([html.Div(tup_table)])
-                ]),
-                dbc.Row([
-                    dbc.Col([html.Div(tup_fig_div)])
-                ]),
+# ----------------------------------------------------------------------------
+# REPORT TABLES
+# ----------------------------------------------------------------------------
+# Rows per page of the server-side paged report tables
+table_page_size = 12
+
+summary_table_cols = ['Date: Year', 'Date: Month', 'Actual: Monthly', 'Actual: Cumulative',
+                      'Expected: Monthly', 'Expected: Cumulative', 'Percent: Monthly','Percent: Cumulative']
+
+def get_site_table_id(mcc):
+    return 'mcc' + str(mcc) + '_datatable'
+
+def get_summary_table_id(tup):
+    return 'table_mcc'+ str(tup[0])+'_'+tup[1]
+
+site_performance_table_id = 'site_performance_datatable'
+
+def get_site_performance_table(site_performance):
+    ''' Site performance rows with the date and percent formatting of the site / surgery summary tables'''
+    def format_percent(percent):
+        return percent.map(lambda p: '' if pd.isna(p) else str(p) + '%')
+    table_df = pd.DataFrame({
+        'Site: MCC': 'MCC' + site_performance['mcc'].astype(str),
+        'Site: Site': site_performance['site'],
+        'Site: Surgery type': site_performance['surgery_type'],
+        'Date: Study month': site_performance['study_month'],
+        'Date: Year': site_performance['Month'].dt.strftime('%Y'),
+        'Date: Month': site_performance['Month'].dt.strftime('%B'),
+    })
+    for col in summary_table_cols[2:6]:
+        table_df[col] = site_performance[col]
+    table_df['Percent: Monthly'] = format_percent(site_performance['Percent: Monthly']).where(site_performance['Actual: Monthly'] > 0, '')
+    table_df['Percent: Cumulative'] = format_percent(site_performance['Percent: Cumulative'])
+    return table_df
+
+@instrument_stage('build_report_tables', rows_out=False)
+def build_report_tables(report_data):
+    ''' Return the DataTable columns and flattened dataframe of every table in the report, by table id'''
+    report_tables = {}
+    for mcc, site_enrollments in report_data['site_enrollments'].items():
+        report_tables[get_site_table_id(mcc)] = datatable_frame_multiindex(site_enrollments.copy())
+    summary_rollup = report_data['summary_rollup']
+    for tup in report_data['summary_options_list']:
+        tup_summary = summary_rollup[(summary_rollup.mcc == tup[0]) & (summary_rollup.surgery_type == tup[1])]
+        if len(tup_summary) > 0:
+            tup_df = tup_summary.set_index('Month')[summary_table_cols].sort_index(ascending=True)
+            report_tables[get_summary_table_id(tup)] = datatable_frame_multiindex(convert_to_multindex(tup_df))
+    if not report_data['site_performance'].empty:
+        site_performance_df = get_site_performance_table(report_data['site_performance'])
+        report_tables[site_performance_table_id] = datatable_frame_multiindex(convert_to_multindex(site_performance_df))
+    return report_tables
+
+# Report tables built by this process, for the current snapshot version only
+_report_tables = {}
+
+def get_report_tables(snapshot):
+    if snapshot['version'] not in _report_tables:
+        _report_tables.clear()
+        _report_tables[snapshot['version']] = build_report_tables(snapshot['report_data'])
+    return _report_tables[snapshot['version']]
+
+def build_report_table(snapshot, table_id):
+    ''' Build a server-side paged DataTable holding the first page of a report table. Paged tables use pattern
+    matching ids so one callback serves them all.'''
+    table_columns, table_df = get_report_tables(snapshot)[table_id]
+    table_data, page_count = get_table_page(table_df, 0, table_page_size)
+    return build_datatable({'type': 'report_table', 'index': table_id}, table_columns, table_data,
+                           page_size=table_page_size, page_count=page_count)
 
+# ----------------------------------------------------------------------------
+# EXCEL EXPORT
+# ----------------------------------------------------------------------------
+export_name = 'enrollment_report'
+export_route = 'export/' + export_name + '.xlsx'
+
+def get_export_sheets(snapshot):
+    '''Sheets of the exported workbook: the site enrollments of each MCC, each site / surgery summary and the
+    performance of each site against its targets'''
+    report_tables = get_report_tables(snapshot)
+    sheets = [('MCC' + str(mcc), ) + report_tables[get_site_table_id(mcc)] for mcc in snapshot['report_data']['site_enrollments']]
+    for tup in snapshot['report_data']['summary_options_list']:
+        table_id = get_summary_table_id(tup)
+        if table_id in report_tables:
+            sheets.append(('MCC' + str(tup[0]) + ' ' + tup[1], ) + report_tables[table_id])
+    if site_performance_table_id in report_tables:
+        sheets.append(('Site performance', ) + report_tables[site_performance_table_id])
+    return sheets
+
+@app.server.route(app.config.routes_pathname_prefix + export_route)
+def download_report_export():
+    ''' Stream the workbook for the current snapshot from disk. It is written on the first request for each data
+    version and snapshot format, so later downloads only read the file and a new release of the app writes it again.'''
+    snapshot = get_published_snapshot(snapshot_name, build_snapshot)
+    if not snapshot or not snapshot['report_data']:
+        flask.abort(503)
+    export_filepath = get_report_export(export_name, snapshot_name + '-' + snapshot['version'], lambda: get_export_sheets(snapshot))
+    if not export_filepath:
+        flask.abort(500)
+    download_name = export_name + '_' + snapshot['page_meta']['data_date'].replace('/', '-') + '.xlsx'
+    return flask.send_file(export_filepath, as_attachment=True, download_name=download_name,
+                           mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
 
-            ], style={'margin-bottom':'20px'})
+# ----------------------------------------------------------------------------
+# STATIC REPORT
+# ----------------------------------------------------------------------------
+# The static report is written by render_report.py; see static_report.py
+static_report_route = app.config.routes_pathname_prefix + 'static-report/'
+
+@app.server.route(static_report_route, defaults={'filename': 'index.html'})
+@app.server.route(static_report_route + '<path:filename>')
+def static_report_file(filename):
+    ''' Send a file of the current static report from disk. The files of a version never change, so responses may
+    be cached for STATIC_REPORT_MAX_AGE seconds and are revalidated with their ETag and Last-Modified headers.'''
+    report_dir = get_static_report_path()
+    if not report_dir:
+        flask.abort(404)
+    # Flask 2.1 leaves the ETag to werkzeug's default, which werkzeug 2.0 does not set
+    return flask.send_from_directory(report_dir, filename, max_age=STATIC_REPORT_MAX_AGE, etag=True)
 
-            tab_summary_content_children.append(tup_section)
+# ----------------------------------------------------------------------------
+# TAB CONTENT
+# ----------------------------------------------------------------------------
+def build_enrollments_tab(snapshot):
+    tab_enrollments_children = []
+    for mcc in snapshot['report_data']['site_enrollments']:
+        tab_enrollments_children.append(html.H2('MCC ' + str(mcc)))
+        tab_enrollments_children.append(build_report_table(snapshot, get_site_table_id(mcc)))
+    tab_enrollments = html.Div(tab_enrollments_children)
+    return html.Div([tab_enrollments], id='section_1')
+
+def build_summary_tab(snapshot):
+    report_data = snapshot['report_data']
+    summary_rollup = report_data['summary_rollup']
+    tab_summary_content_children = []
+    for tup in report_data['summary_options_list']:
+        tup_summary = summary_rollup[(summary_rollup.mcc == tup[0]) & (summary_rollup.surgery_type == tup[1])]
+
+        if len(tup_summary) > 0:
+            figure_id = 'figure_mcc'+ str(tup[0])+'_'+tup[1]
+            tup_table = build_report_table(snapshot, get_summary_table_id(tup))
+            tup_fig_div = html.Div([dcc.Graph(figure = snapshot['figures'][tup], id=figure_id),
+                                    html.P(get_target_message(report_data['enrollment_forecast']['summary'], tup))])
+        else:
+            tup_message = 'There is currently no data for ' + tup[1] + ' surgeries at MCC' + str(tup[0])
+            tup_table = html.Div(tup_message)
+            tup_fig_div = html.Div()
+
+        tup_section = html.Div([
+            dbc.Row([
+                dbc.Col([html.H2('MCC' + str(tup[0]) + ': ' + tup[1]),])
+            ]),
+            dbc.Row([
+                dbc.Col([html.Div(tup_table)])
+            ]),
+            dbc.Row([
+                dbc.Col([html.Div(tup_fig_div)])
+            ]),
+
+
+        ], style={'margin-bottom':'20px'})
+
+        tab_summary_content_children.append(tup_section)
+
+    return html.Div([html.Div(tab_summary_content_children)], id='section_3')
 
-    ### BUILD PAGE COMPONENTS
-        data_source = 'Data Source: ' + page_meta_dict['data_source']
-        data_date = 'Data Date: ' + page_meta_dict['data_date']
+# ----------------------------------------------------------------------------
+# SITE PERFORMANCE
+# ----------------------------------------------------------------------------
+def build_site_performance_tab(snapshot):
+    ''' Where each site stands against the targets of screening_sites.csv in its latest study month, the cumulative
+    percent of target of every site by study month and the paged study month table of all sites'''
+    site_performance = snapshot['report_data']['site_performance']
+    if site_performance.empty:
+        return html.Div('There is currently no site performance data', id='section_6')
+
+    latest = site_performance.drop_duplicates(['screening_site', 'surgery_type'], keep='last')
+    latest_cols = ['Site: MCC', 'Site: Site', 'Site: Surgery type', 'Date: Study month', 'Date: Year', 'Date: Month',
+                   'Expected: Cumulative', 'Actual: Cumulative', 'Percent: Cumulative']
+    latest_df = convert_to_multindex(get_site_performance_table(latest)[latest_cols])
+
+    series = [(site + ' (' + surgery_type + ')', site_df['study_month'], site_df['Percent: Cumulative'])
+              for (site, surgery_type), site_df in site_performance.groupby(['screening_site', 'surgery_type'], sort=False)]
+    figure = build_series_figure(series, 'Study month', 'Percent of cumulative target', 'Site',
+                                 'Cumulative enrollment as a percent of site targets', typed_arrays=FIGURE_TYPED_ARRAYS)
+
+    site_performance_note = ('Actual enrollment of each site against the monthly targets of screening_sites.csv, by study '
+                             'month from the site start date. Enrollments before a site\'s first study month count '
+                             'toward its first study month.')
+    return html.Div([
+        html.P(site_performance_note),
+        html.H2('Latest study month'),
+        build_datatable_multi(latest_df, 'site_performance_latest'),
+        dcc.Graph(figure=figure, id='site_performance_figure'),
+        html.H2('By study month'),
+        build_report_table(snapshot, site_performance_table_id),
+    ], id='section_6')
 
-        tab_enrollments = html.Div([
-            html.H2('MCC 1'),
-            build_datatable_multi(mcc1_enrollments, 'mcc1_datatable'),
-            html.H2('MCC 2'),
-            build_datatable_multi(mcc2_enrollments, 'mcc2_datatable')
-            ])
+# ----------------------------------------------------------------------------
+# FORECAST
+# ----------------------------------------------------------------------------
+def format_target_month(enrolled, target, target_month):
+    if pd.isna(target):
+        return ''
+    if enrolled >= target:
+        return 'Reached'
+    if pd.isna(target_month):
+        return 'Not projected'
+    return target_month.strftime('%B %Y')
+
+def get_target_message(forecast_summary, tup):
+    ''' When the MCC / surgery type is projected to reach the total of its sites' targets by each method'''
+    tup_forecast = forecast_summary[(forecast_summary.level == 'mcc') & (forecast_summary.mcc == tup[0]) & (forecast_summary.surgery_type == tup[1])]
+    if tup_forecast.empty or pd.isna(tup_forecast['Target'].iloc[0]):
+        return 'No site enrollment targets are set for ' + tup[1] + ' surgeries at MCC' + str(tup[0])
+    projected = ['{} ({})'.format(format_target_month(row['Enrolled'], row['Target'], row['Target month']), row['type'].replace('Projected: ', ''))
+                 for i, row in tup_forecast.iterrows()]
+    return 'Site target total: {:,.0f}. Projected to be reached: {}.'.format(tup_forecast['Target'].iloc[0], ', '.join(projected))
+
+def build_forecast_tab(snapshot):
+    ''' Enrolled total, target and projected monthly rate and target month by forecasting method of each MCC and
+    site series'''
+    forecast_summary = snapshot['report_data']['enrollment_forecast']['summary']
+    if forecast_summary.empty:
+        return html.Div('There is currently no enrollment data', id='section_5')
+    # Each method's summary holds the same series in the same order
+    method_summaries = [method_summary.reset_index(drop=True) for method, method_summary in forecast_summary.groupby('method', sort=False)]
+    series = method_summaries[0]
+    table_df = pd.DataFrame({
+        'MCC': 'MCC' + series['mcc'].astype(str),
+        'Screening site': series['screening_site'].fillna('All sites'),
+        'Surgery type': series['surgery_type'],
+        'Enrolled': series['Enrolled'],
+        'Target': series['Target'].map(lambda target: '' if pd.isna(target) else '{:.0f}'.format(target)),
+    })
+    table_columns = [{'name': ['Series', col], 'id': col} for col in table_df.columns]
+    for method_summary in method_summaries:
+        method_name = method_summary['type'].iloc[0]
+        rate_col, month_col = method_summary['method'].iloc[0] + '_rate', method_summary['method'].iloc[0] + '_month'
+        table_df[rate_col] = method_summary['Monthly rate']
+        table_df[month_col] = [format_target_month(*row) for row in method_summary[['Enrolled', 'Target', 'Target month']].itertuples(index=False)]
+        table_columns += [{'name': [method_name, 'Monthly rate'], 'id': rate_col}, {'name': [method_name, 'Target month'], 'id': month_col}]
+
+    forecast_note = ('Projections continue the monthly rate of each series from its last month with enrollments: the mean of '
+                     'the last {} months (rolling rate) or simple exponential smoothing with alpha {}. Targets are the sum '
+                     'of the expected enrollment of the sites in screening_sites.csv.').format(FORECAST_WINDOW, FORECAST_ALPHA)
+    return html.Div([
+        html.P(forecast_note),
+        build_datatable('forecast_table', table_columns, table_df.to_dict('records')),
+    ], id='section_5')
 
-        tab_summary_content = html.Div(
-            tab_summary_content_children
-        )
+# ----------------------------------------------------------------------------
+# ENROLLMENT EXPLORER
+# ----------------------------------------------------------------------------
+# Filter changes are answered from the enrollment cube of the snapshot, so the callback only slices and sums small
+# arrays and never reruns the pipeline
+
+def get_month_marks(months):
+    ''' Month range slider marks: the first month and every January'''
+    months = pd.DatetimeIndex(months)
+    return {i: month.strftime('%b %Y') for i, month in enumerate(months) if i == 0 or month.month == 1}
+
+def get_explore_results(cube, month_range, mccs, sites, surgery_types):
+    ''' Return the cumulative enrollment figure, the table columns and rows and the totals message for a selection
+    of the explorer controls. An empty site selection selects every site.'''
+    months = cube['months']
+    first, last = (month_range or [0, len(months) - 1])[:2]
+    first, last = sorted(min(max(int(month), 0), len(months) - 1) for month in [first, last])
+    selected_months, selected_types, monthly, cumulative = query_enrollment_cube(
+        cube, months[first], months[last], mccs or [], sites or None, surgery_types or [])
+
+    series = [(surgery_type, selected_months, cumulative[:, i]) for i, surgery_type in enumerate(selected_types)]
+    figure = build_series_figure(series, 'Month', 'Cumulative', 'surgery_type', 'Cumulative enrollment: selected sites',
+                                 typed_arrays=FIGURE_TYPED_ARRAYS)
+
+    table_columns = [{'name': ['Date', 'Year'], 'id': 'Year'}, {'name': ['Date', 'Month'], 'id': 'Month'}]
+    for surgery_type in selected_types:
+        table_columns += [{'name': [surgery_type, count_name], 'id': surgery_type + '_' + count_name} for count_name in ['Monthly', 'Cumulative']]
+    month_labels = pd.DatetimeIndex(selected_months)
+    table_data = []
+    for row, month in enumerate(month_labels):
+        record = {'Year': month.strftime('%Y'), 'Month': month.strftime('%B')}
+        for i, surgery_type in enumerate(selected_types):
+            record[surgery_type + '_Monthly'] = int(monthly[row, i])
+            record[surgery_type + '_Cumulative'] = int(cumulative[row, i])
+        table_data.append(record)
+
+    totals_message = 'Enrolled from {} through {}: {}. Enrolled to date: {}.'.format(
+        month_labels[0].strftime('%B %Y'), month_labels[-1].strftime('%B %Y'), int(monthly.sum()), int(cumulative[-1].sum()))
+    return figure, table_columns, table_data, totals_message
+
+def build_explore_tab(snapshot):
+    cube = snapshot['report_data']['enrollment_cube']
+    if len(cube['months']) == 0:
+        return html.Div('There is currently no enrollment data', id='section_4')
+    last_month = len(cube['months']) - 1
+    mccs = sorted(set(int(mcc) for mcc in cube['site_mccs']))
+    surgery_types = list(cube['surgery_types'])
+    figure, table_columns, table_data, totals_message = get_explore_results(cube, [0, last_month], mccs, [], surgery_types)
+
+    checklist_label_style = {'display': 'inline-block', 'margin-right': '15px'}
+    controls = html.Div([
+        dbc.Row([
+            dbc.Col([
+                html.Label('Months'),
+                dcc.RangeSlider(id='explore_months', min=0, max=last_month, step=1, value=[0, last_month],
+                                marks=get_month_marks(cube['months']), allowCross=False),
+            ]),
+        ]),
+        dbc.Row([
+            dbc.Col([
+                html.Label('MCC'),
+                dcc.Checklist(id='explore_mccs', options=[{'label': 'MCC' + str(mcc), 'value': mcc} for mcc in mccs],
+                              value=mccs, labelStyle=checklist_label_style),
+            ], width=3),
+            dbc.Col([
+                html.Label('Surgery type'),
+                dcc.Checklist(id='explore_surgery_types', options=[{'label': t, 'value': t} for t in surgery_types],
+                              value=surgery_types, labelStyle=checklist_label_style),
+            ], width=3),
+            dbc.Col([
+                html.Label('Screening site'),
+                dcc.Dropdown(id='explore_sites', options=[{'label': site, 'value': site} for site in cube['sites']],
+                             value=[], multi=True, placeholder='All sites'),
+            ], width=6),
+        ]),
+    ], style={'margin-bottom': '20px'})
+
+    return html.Div([
+        controls,
+        html.P(totals_message, id='explore_totals'),
+        build_datatable('explore_table', table_columns, table_data),
+        dcc.Graph(figure=figure, id='explore_figure'),
+    ], id='section_4')
+
+# Tabs in display order: value, label and the function building the tab's content from a snapshot
+report_tabs = [
+    ('tab_1', 'Site Enrollments', build_enrollments_tab),
+    ('tab_3', 'Site / Surgery Summary', build_summary_tab),
+    ('tab_6', 'Site Performance', build_site_performance_tab),
+    ('tab_4', 'Enrollment Explorer', build_explore_tab),
+    ('tab_5', 'Forecast', build_forecast_tab),
+]
+default_tab = report_tabs[0][0]
+
+# Rendered tab content in this process by (snapshot version, tab value). Only the current version is kept.
+_rendered_tabs = {}
+
+def get_tab_content(snapshot, tab):
+    '''Return the content of one tab, rendering it only the first time it is requested for a snapshot version'''
+    key = (snapshot['version'], tab)
+    if key not in _rendered_tabs:
+        build_tab = {value: builder for value, label, builder in report_tabs}.get(tab)
+        if build_tab is None:
+            return html.Div()
+        for stale_key in [k for k in _rendered_tabs if k[0] != snapshot['version']]:
+            del _rendered_tabs[stale_key]
+        _rendered_tabs[key] = build_tab(snapshot)
+    return _rendered_tabs[key]
 
+# ----------------------------------------------------------------------------
+# DASH APP LAYOUT FUNCTION
+# ----------------------------------------------------------------------------
+def build_page_layout(snapshot):
+    ''' The report page for a snapshot, with the default tab rendered'''
+    report_data = snapshot['report_data'] if snapshot else None
+    if report_data:
+        page_meta = snapshot['page_meta']
+        data_source = 'Data Source: ' + page_meta['data_source']
+        data_date = 'Data Date: ' + page_meta['data_date']
+        data_freshness = build_freshness_list(page_meta.get('mcc_status', {}))
+
+        # Only the active tab is rendered into the initial layout; the others are rendered when selected
         tabs = html.Div([
-                    dcc.Tabs(id='tabs_tables', children=[
-                        dcc.Tab(label='Site Enrollments', id='tab_1', children=[
-                            html.Div([tab_enrollments], id='section_1'),
-                        ]),
-                        dcc.Tab(label="Site / Surgery Summary", id='tab_3', children=[
-                            html.Div([tab_summary_content], id='section_3'),
-                        ]),
-
+                    dcc.Tabs(id='tabs_tables', value=default_tab, children=[
+                        dcc.Tab(label=label, id=value, value=value) for value, label, builder in report_tabs
                     ]),
+                    html.Div(get_tab_content(snapshot, default_tab), id='tab_content'),
                     ])
+        export_link = html.A('Download Excel', href=app.get_relative_path('/' + export_route),
+                             className='btn btn-info', style=EXCEL_EXPORT_STYLE)
     else:
         data_source = 'unavailable'
         data_date = 'unavailable'
+        data_freshness = html.Div()
         tabs = 'Data unavailable'
+        export_link = html.Div()
 
     page_layout = html.Div([
         dcc.Loading(
@@ -237,9 +621,16 @@ def serve_layout():
                     ], width=6),
                     dbc.Col([
                         html.P(data_date),
+                        data_freshness,
                     ], width=6, style={'text-align': 'right'}),
                 ]),
 
+                dbc.Row([
+                    dbc.Col([
+                        export_link,
+                    ])
+                ]),
+
                 dbc.Row([
                     dbc.Col([
                         tabs,
@@ -258,13 +649,185 @@ def serve_layout():
 
     return page_layout
 
+@instrument_stage('serve_layout')
+def serve_layout():
+    # Data processing results are shared across workers and rebuilt by a background refresher, so the request only
+    # reads the latest published snapshot
+    start_snapshot_refresher(snapshot_name, build_snapshot)
+    snapshot = get_published_snapshot(snapshot_name, build_snapshot)
+    return build_page_layout(snapshot)
+
 app.layout = serve_layout
 
 
 # ----------------------------------------------------------------------------
 # DATA CALLBACKS
 # ----------------------------------------------------------------------------
+@app.callback(
+    Output('tab_content', 'children'),
+    Input('tabs_tables', 'value'),
+    prevent_initial_call=True
+)
+def render_tab_content(tab):
+    snapshot = get_published_snapshot(snapshot_name, build_snapshot)
+    if not snapshot or not snapshot['report_data']:
+        return 'Data unavailable'
+    return get_tab_content(snapshot, tab)
+
+@app.callback(
+    Output({'type': 'report_table', 'index': MATCH}, 'data'),
+    Output({'type': 'report_table', 'index': MATCH}, 'page_count'),
+    Input({'type': 'report_table', 'index': MATCH}, 'page_current'),
+    Input({'type': 'report_table', 'index': MATCH}, 'page_size'),
+    Input({'type': 'report_table', 'index': MATCH}, 'sort_by'),
+    Input({'type': 'report_table', 'index': MATCH}, 'filter_query'),
+    State({'type': 'report_table', 'index': MATCH}, 'id'),
+    prevent_initial_call=True
+)
+def update_paged_table(page_current, page_size, sort_by, filter_query, table_id):
+    snapshot = get_published_snapshot(snapshot_name, build_snapshot)
+    report_tables = get_report_tables(snapshot) if snapshot and snapshot['report_data'] else {}
+    if table_id['index'] not in report_tables:
+        raise PreventUpdate
+    table_columns, table_df = report_tables[table_id['index']]
+    return get_table_page(table_df, page_current, page_size, sort_by, filter_query)
+
+@app.callback(
+    Output('explore_figure', 'figure'),
+    Output('explore_table', 'columns'),
+    Output('explore_table', 'data'),
+    Output('explore_totals', 'children'),
+    Input('explore_months', 'value'),
+    Input('explore_mccs', 'value'),
+    Input('explore_sites', 'value'),
+    Input('explore_surgery_types', 'value'),
+    prevent_initial_call=True
+)
+def update_explore_results(month_range, mccs, sites, surgery_types):
+    snapshot = get_published_snapshot(snapshot_name, build_snapshot)
+    if not snapshot or not snapshot['report_data'] or not len(snapshot['report_data']['enrollment_cube']['months']):
+        raise PreventUpdate
+    return get_explore_results(snapshot['report_data']['enrollment_cube'], month_range, mccs, sites, surgery_types)
+
+# ----------------------------------------------------------------------------
+# INSTRUMENTATION
+# ----------------------------------------------------------------------------
+# The layout request stage covers serve_layout and the serialization of the layout by dash
+layout_route = app.config.routes_pathname_prefix + '_dash-layout'
+
+@app.server.before_request
+def start_layout_timer():
+    if flask.request.path == layout_route:
+        flask.g.layout_start = time.perf_counter()
+
+@app.server.after_request
+def record_layout_request(response):
+    if flask.request.path == layout_route and 'layout_start' in flask.g:
+        finish_stage({'stage': 'layout_request', 'labels': {}, 'rows_in': None,
+                      'rows_out': None,
+                      'seconds': time.perf_counter() - flask.g.layout_start,
+                      'peak_rss_bytes': get_peak_rss_bytes()})
+    return response
+
+# Memory of the report data frames of the snapshot loaded in this worker, for the current snapshot version only
+_frame_memory = {}
+
+def get_snapshot_frame_memory(snapshot):
+    if snapshot['version'] not in _frame_memory:
+        _frame_memory.clear()
+        _frame_memory[snapshot['version']] = get_frame_memory(snapshot['report_data'] or {})
+    return _frame_memory[snapshot['version']]
+
+@app.server.route(app.config.routes_pathname_prefix + 'metrics')
+def stage_metrics_endpoint():
+    ''' Per-stage timings, row counts and memory of every worker, and the memory of the report data held by the
+    worker answering, in the Prometheus text format'''
+    metrics_text = get_stage_metrics_text()
+    snapshot = load_snapshot(snapshot_name)
+    if snapshot is not None:
+        metrics_text += get_frame_memory_metrics_text(get_snapshot_frame_memory(snapshot), pid=os.getpid())
+    return flask.Response(metrics_text, mimetype='text/plain; version=0.0.4')
+
+# ----------------------------------------------------------------------------
+# HTTP CACHING
+# ----------------------------------------------------------------------------
+# Layout and callback responses only change with the published snapshot (its data version and page metadata), the
+# request and the app code and assets. They carry a weak ETag of those, so browsers and the proxy revalidate the
+# layout with a 304 instead of downloading it again, and each worker keeps its final (compressed) responses, so a
+# repeated callback, like a switch to a tab viewed before, is answered without running it. Browsers do not
+# revalidate POST requests, so callbacks only benefit from the worker cache.
+callback_route = app.config.routes_pathname_prefix + '_dash-update-component'
+cached_routes = [layout_route, callback_route]
+cached_response_headers = ['Content-Type', 'Content-Encoding', 'Vary', 'ETag', 'Cache-Control']
+
+# Hash of the app code and assets, so responses cached by browsers before a deploy are not reused after it
+app_version = get_files_version(list(pathlib.Path(__file__).parent.glob('*.py')) + [f for f in ASSETS_PATH.glob('*') if f.is_file()])
+
+def get_response_etag(snapshot, request):
+    return get_etag(app_version, snapshot['version'], json.dumps(snapshot['page_meta'], sort_keys=True, default=str),
+                    request.path, request.get_data())
+
+@app.server.before_request
+def answer_from_cache():
+    ''' Answer a layout or callback request with a 304 if the browser holds the current response, or from this
+    worker's response cache'''
+    request = flask.request
+    if request.path not in cached_routes:
+        return None
+    if request.path == layout_route:
+        # Layouts answered here skip serve_layout, which starts the refresher
+        start_snapshot_refresher(snapshot_name, build_snapshot)
+    snapshot = load_snapshot(snapshot_name)
+    if snapshot is None:
+        return None
 
+    etag = get_response_etag(snapshot, request)
+    flask.g.response_etag = etag
+    if request.method in ('GET', 'HEAD') and request.if_none_match.contains_weak(etag):
+        flask.g.response_cached = True
+        response = flask.Response(status=304)
+        response.set_etag(etag, weak=True)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    cached = get_cached_response((etag, request.headers.get('Accept-Encoding', '')))
+    if cached is not None:
+        flask.g.response_cached = True
+        body, headers = cached
+        return flask.Response(body, headers=headers)
+    return None
+
+@app.server.after_request
+def store_cached_response(response):
+    ''' Tag layout and callback responses with their ETag and keep them in the response cache. Registered before
+    the compression hook, so it runs after it and keeps the compressed body.'''
+    etag = flask.g.get('response_etag')
+    if not etag or flask.g.get('response_cached') or response.status_code != 200 or response.direct_passthrough:
+        return response
+    response.set_etag(etag, weak=True)
+    # Browsers may keep the response, but revalidate it on every use
+    response.headers['Cache-Control'] = 'no-cache'
+    headers = [(name, response.headers[name]) for name in cached_response_headers if name in response.headers]
+    cache_response((etag, flask.request.headers.get('Accept-Encoding', '')), response.get_data(), headers)
+    return response
+
+# Static report files are sent as they are on disk, with a strong ETag and a 304 when the browser holds them.
+# Compressing them would rewrite the ETag to '<etag>:br' and, as they are streamed, leave out the conditional check,
+# so every revalidation would download the file again. The compression hook is registered here to skip them.
+uncompressed_endpoints = ['static_report_file']
+
+if HTTP_COMPRESSION:
+    app.server.config.update(COMPRESS_ALGORITHM=HTTP_COMPRESSION, COMPRESS_MIN_SIZE=HTTP_COMPRESSION_MIN_SIZE,
+                             COMPRESS_MIMETYPES=['text/html', 'text/css', 'text/plain', 'text/csv', 'application/json',
+                                                 'application/javascript'],
+                             COMPRESS_REGISTER=False)
+    compress = Compress(app.server)
+
+    @app.server.after_request
+    def compress_response(response):
+        if flask.request.endpoint in uncompressed_endpoints:
+            return response
+        return compress.after_request(response)
 
 # ----------------------------------------------------------------------------
 # RUN APPLICATION
@@ -40,3 +40,56 @@ def get_django_user():
 DATA_PATH = pathlib.Path(__file__).parent.joinpath("data")
 ASSETS_PATH = pathlib.Path(__file__).parent.joinpath("assets")
 REQUESTS_PATHNAME_PREFIX = os.environ.get("REQUESTS_PATHNAME_PREFIX", "/")
+
+# The MCCs, report files and expectation tables of the report are declared in this file. A relative path is read
+# from ASSETS_PATH.
+REPORT_CONFIG_FILE = os.environ.get("REPORT_CONFIG_FILE", "report_config.json")
+
+# Processed report snapshots are shared across gunicorn workers through a file store in DATA_PATH.
+# SNAPSHOT_TTL is the number of seconds a snapshot is served before the upstream data is checked again.
+SNAPSHOT_PATH = pathlib.Path(os.environ.get("SNAPSHOT_PATH", DATA_PATH.joinpath("snapshots")))
+SNAPSHOT_TTL = int(os.environ.get("SNAPSHOT_TTL", 60 * 60))
+# Seconds between checks made by each worker's background snapshot refresher
+SNAPSHOT_REFRESH_INTERVAL = int(os.environ.get("SNAPSHOT_REFRESH_INTERVAL", 5 * 60))
+
+# HTTP settings for downloading the MCC subjects reports
+HTTP_TIMEOUT = (float(os.environ.get("HTTP_CONNECT_TIMEOUT", 5)), float(os.environ.get("HTTP_READ_TIMEOUT", 60)))
+HTTP_RETRIES = int(os.environ.get("HTTP_RETRIES", 3))
+HTTP_BACKOFF = float(os.environ.get("HTTP_BACKOFF", 0.5))
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", 8))
+
+# Read the subjects reports record by record, keeping only the enrolled subjects and the fields the report uses
+SUBJECTS_STREAMING = os.environ.get("SUBJECTS_STREAMING", "true").lower() in ("1", "true", "yes")
+
+# Directory of the typed columnar store of the cleaned enrolled dataframe, updated incrementally from each subjects
+# pull
+ENROLLED_STORE_PATH = pathlib.Path(os.environ.get("ENROLLED_STORE_PATH", DATA_PATH.joinpath("enrolled_store")))
+
+# Send figure y values as base64 typed arrays rather than JSON number lists. Needs plotly.js 2.28 or later in the
+# browser (dash 2.15+), so it is off for the dash version pinned in requirements.txt.
+FIGURE_TYPED_ARRAYS = os.environ.get("FIGURE_TYPED_ARRAYS", "false").lower() in ("1", "true", "yes")
+
+# Excel exports of the report, written once per data version and served from disk
+EXPORT_PATH = pathlib.Path(os.environ.get("EXPORT_PATH", DATA_PATH.joinpath("exports")))
+
+# Pipeline stage instrumentation: log each stage as a json line, and share stage totals between workers in
+# METRICS_PATH for the /metrics endpoint. Set STAGE_TRACEMALLOC to also record python memory allocated per stage.
+STAGE_LOGGING = os.environ.get("STAGE_LOGGING", "true").lower() in ("1", "true", "yes")
+STAGE_TRACEMALLOC = os.environ.get("STAGE_TRACEMALLOC", "false").lower() in ("1", "true", "yes")
+METRICS_PATH = pathlib.Path(os.environ.get("METRICS_PATH", DATA_PATH.joinpath("metrics")))
+
+# Enrollment forecasts: months projected past the last month with data, months averaged by the rolling rate method
+# and the smoothing factor of the exponential smoothing method
+FORECAST_HORIZON = int(os.environ.get("FORECAST_HORIZON", 12))
+FORECAST_WINDOW = int(os.environ.get("FORECAST_WINDOW", 6))
+FORECAST_ALPHA = float(os.environ.get("FORECAST_ALPHA", 0.3))
+
+# Static report written by render_report.py and served from disk, with Cache-Control max-age in seconds
+STATIC_REPORT_PATH = pathlib.Path(os.environ.get("STATIC_REPORT_PATH", DATA_PATH.joinpath("static_report")))
+STATIC_REPORT_MAX_AGE = int(os.environ.get("STATIC_REPORT_MAX_AGE", 5 * 60))
+
+# Compression of responses, by algorithm in order of preference (br, gzip); empty to turn compression off. Layout
+# and callback responses of the current snapshot are also kept by each worker, up to HTTP_RESPONSE_CACHE_SIZE.
+HTTP_COMPRESSION = [algorithm.strip() for algorithm in os.environ.get("HTTP_COMPRESSION", "br,gzip").split(",") if algorithm.strip()]
+HTTP_COMPRESSION_MIN_SIZE = int(os.environ.get("HTTP_COMPRESSION_MIN_SIZE", 500))
+HTTP_RESPONSE_CACHE_SIZE = int(os.environ.get("HTTP_RESPONSE_CACHE_SIZE", 128))
@@ -7,18 +7,30 @@ import traceback
 import os # Operating system library
 import pathlib # file paths
 import json
+import time
+import logging
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
 import math
 import numpy as np
 import pandas as pd # Dataframe manipulations
 
-import sqlite3
+try:
+    import ijson # incremental json parser used for streaming ingestion of the subjects reports
+except ImportError:
+    ijson = None
 import datetime
 from datetime import datetime, timedelta
 
 from collections import OrderedDict
 # import local modules
 from config_settings import *
+from display_terms import *
+from instrumentation import *
+
+logger = logging.getLogger('enrollment_report.data_processing')
 
 # ----------------------------------------------------------------------------
 # Get dataframes and parameters
@@ -62,13 +74,13 @@ def convert_to_multindex(df, delimiter = ': '):
     df_mi.columns = pd.MultiIndex.from_tuples(df_mi.columns)
     return df_mi
 
-def datatable_settings_multiindex(df, flatten_char = '_'):
+def datatable_frame_multiindex(df, flatten_char = '_'):
     ''' Plotly dash datatables do not natively handle multiindex dataframes. This function takes a multiindex column set
     and generates a flattend column name list for the dataframe, while also structuring the table dictionary to represent the
     columns in their original multi-level format.
 
-    Function returns the variables datatable_col_list, datatable_data for the columns and data parameters of
-    the dash_table.DataTable'''
+    Function returns the datatable_col_list for the columns parameter of the dash_table.DataTable, and the
+    dataframe with flattened column names, whose records are the data parameter.'''
     datatable_col_list = []
 
     levels = df.columns.nlevels
@@ -83,6 +95,13 @@ def datatable_settings_multiindex(df, flatten_char = '_'):
             columns_list.append(col_id)
         df.columns = columns_list
 
+    return datatable_col_list, df
+
+def datatable_settings_multiindex(df, flatten_char = '_'):
+    '''Function returns the variables datatable_col_list, datatable_data for the columns and data parameters of
+    the dash_table.DataTable for a (possibly multiindex) dataframe. See datatable_frame_multiindex.'''
+    datatable_col_list, df = datatable_frame_multiindex(df, flatten_char)
+
     dd = OrderedDict()
     datatable_data = df.to_dict('records', into=dd)
     #
@@ -90,6 +109,32 @@ def datatable_settings_multiindex(df, flatten_char = '_'):
 
     return datatable_col_list, datatable_data
 
+# ----------------------------------------------------------------------------
+# REPORT CONFIGURATION
+# ----------------------------------------------------------------------------
+# Settings used when the report configuration file leaves them out
+DEFAULT_REPORT_CONFIG = {
+    'report': 'subjects',
+    'report_suffix': 'subjects-[mcc]-latest.json',
+    'mcc_list': [1, 2],
+    'display_terms_file': 'A2CPS_display_terms.csv',
+    'screening_sites_file': 'screening_sites.csv',
+    'enrollment_expectations_file': 'enrollment_expectations.csv',
+}
+
+def load_report_config(ASSETS_PATH, report_config_file):
+    '''Load the report configuration declaring the MCCs, the report fetched for each ('[mcc]' in report_suffix is
+    replaced by the MCC number) and the display terms, screening sites and enrollment expectations files. Adding an
+    MCC only takes adding it to mcc_list and its rows to the screening sites and expectations files.'''
+    report_config = dict(DEFAULT_REPORT_CONFIG)
+    try:
+        report_config_filepath = os.path.join(ASSETS_PATH, report_config_file) if ASSETS_PATH else report_config_file
+        report_config.update(load_json_file(report_config_filepath))
+    except Exception as e:
+        traceback.print_exc()
+    report_config['mcc_list'] = [int(mcc) for mcc in report_config['mcc_list']]
+    return report_config
+
 # ----------------------------------------------------------------------------
 # DATA DISPLAY DICTIONARIES & SCREENING DATA
 # ----------------------------------------------------------------------------
@@ -136,48 +181,198 @@ def get_display_dictionary(display_terms, api_field, api_value, display_col):
         traceback.print_exc()
         return None
 
+def get_display_maps(display_terms_dict):
+    '''Convert a display terms dictionary of dataframes into a dictionary by field of {database value: display text}
+    mappings, so columns can be translated with a single Series.map instead of a merge. Numeric database values
+    match both integer and float columns. Mappings already compiled by the display terms registry are passed
+    through as they are.'''
+    display_maps = {}
+    for field, term in display_terms_dict.items():
+        if isinstance(term, dict):
+            display_maps[field] = term
+        else:
+            display_maps[field] = dict(zip(term[field], term[field + '_display']))
+    return display_maps
+
 # ----------------------------------------------------------------------------
 # DATA LOADING
 # ----------------------------------------------------------------------------
-def get_subjects_json(report, report_suffix,  file_url_root=None, mcc_list =[1,2], DATA_PATH = None):
-    subjects_json = {}
+# Pooled HTTP session shared by the threads fetching MCC reports, created on first use in each process
+_http_session = None
+
+def get_http_session():
+    '''Return a requests session with a connection pool sized for parallel MCC downloads and retry with
+    exponential backoff on connection errors and transient server errors.'''
+    global _http_session
+    if _http_session is None:
+        retry = Retry(total=HTTP_RETRIES, backoff_factor=HTTP_BACKOFF,
+                      status_forcelist=[429, 500, 502, 503, 504], allowed_methods=['GET'])
+        adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _http_session = session
+    return _http_session
+
+def load_json_file(filepath):
+    with open(filepath, 'r') as f:
+        return json.load(f)
+
+# Fields of each subject record used by get_enrolled. Streaming ingestion keeps only these.
+SUBJECTS_FIELDS = ['main_record_id', 'obtain_date', 'ewdateterm', 'redcap_data_access_group', 'sp_data_site']
+
+def iter_subjects_records(f):
+    '''Yield (record_id, record) pairs from a subjects report file. With ijson installed the records are parsed one
+    at a time; otherwise the whole file is parsed first.'''
+    if ijson:
+        return ijson.kvitems(f, '', use_float=True)
+    return iter(json.load(f).items())
+
+def read_subjects_frame(filepath, fields = SUBJECTS_FIELDS):
+    '''Stream a subjects report from disk, keeping only consented subjects (obtain_date set) who have not withdrawn
+    (ewdateterm not set) and only the given fields. Returns a compact dataframe with the record id in an 'index'
+    column, the same layout combine_mcc_json produces from the full json.'''
+    columns = {field: [] for field in ['index'] + fields}
+    with open(filepath, 'rb') as f:
+        for record_id, record in iter_subjects_records(f):
+            if record.get('obtain_date', np.nan) == 'N/A' or record.get('ewdateterm', np.nan) != 'N/A':
+                continue
+            columns['index'].append(record_id)
+            for field in fields:
+                columns[field].append(record.get(field, np.nan))
+    return pd.DataFrame(columns)
+
+def get_report_meta_filepath(mcc_filepath):
+    return mcc_filepath + '.meta.json'
+
+def read_report_meta(mcc_filepath):
+    '''Return the download metadata kept alongside a report file: its ETag and Last-Modified headers and 'fetched',
+    the time the report was last confirmed current by the API. Reports placed on disk by hand have no metadata, so
+    their modification time stands in for 'fetched'.'''
+    meta = {}
+    meta_filepath = get_report_meta_filepath(mcc_filepath)
+    if os.path.exists(meta_filepath):
+        try:
+            meta = load_json_file(meta_filepath)
+        except Exception as e:
+            traceback.print_exc()
+    if not meta.get('fetched') and os.path.exists(mcc_filepath):
+        meta['fetched'] = os.path.getmtime(mcc_filepath)
+    return meta
+
+def write_report_meta(mcc_filepath, meta):
+    meta_filepath = get_report_meta_filepath(mcc_filepath)
+    tmp_filepath = meta_filepath + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp_filepath, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_filepath, meta_filepath)
+
+def fetch_mcc_json(json_url, mcc_filepath, load_report = load_json_file):
+    '''Download one MCC report to mcc_filepath and return it as read by load_report. The ETag and Last-Modified
+    headers of the download are kept alongside the file and the request is made conditional on them, so an
+    unchanged report is answered with a 304 and read from disk instead of re-downloaded. The body is streamed to
+    disk rather than held in memory, and the file is only replaced once the download completes, so it always holds
+    the last good copy. Returns None if the server does not return the report.'''
+    meta = read_report_meta(mcc_filepath) if os.path.exists(mcc_filepath) else {}
+    headers = {}
+    if meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+
+    r = get_http_session().get(json_url, headers=headers, timeout=HTTP_TIMEOUT, stream=True)
     try:
-        # Read files into json from API
-        for mcc in mcc_list:
-            json_url = '/'.join([file_url_root, report,report_suffix.replace('[mcc]',str(mcc))])
-            r = requests.get(json_url)
-            if r.status_code == 200:
-            # TO DO: add an else statement to use local files if the request fails
-                mcc_json = r.json()
-                subjects_json[mcc] = mcc_json
+        if r.status_code == 304:
+            mcc_json = load_report(mcc_filepath)
+            meta['fetched'] = time.time()
+            write_report_meta(mcc_filepath, meta)
+            return mcc_json
+        if r.status_code != 200:
+            return None
+
+        # Persist the download for conditional requests and as the local fallback
+        os.makedirs(os.path.dirname(mcc_filepath), exist_ok=True)
+        tmp_filepath = mcc_filepath + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp_filepath, 'wb') as f:
+            for chunk in r.iter_content(chunk_size=1024 * 1024):
+                f.write(chunk)
+        os.replace(tmp_filepath, mcc_filepath)
+        write_report_meta(mcc_filepath, {'etag': r.headers.get('ETag'), 'last_modified': r.headers.get('Last-Modified'),
+                                         'fetched': time.time()})
+    finally:
+        r.close()
+
+    return load_report(mcc_filepath)
+
+def load_mcc_json(mcc, json_url, mcc_filepath, load_report = load_json_file):
+    '''Fetch one MCC report, falling back to the last good copy on disk if the API fails or does not return it.
+    Returns the report (None if there is no copy at all) and its status: 'source' is 'API', 'last good copy' or
+    'unavailable', and 'fetched' is the time the report was last received from the API.'''
+    with record_stage('fetch_mcc_json', mcc=mcc) as stage_record:
+        try:
+            mcc_json = fetch_mcc_json(json_url, mcc_filepath, load_report)
+            source = 'API'
+        except Exception as e:
+            traceback.print_exc()
+            mcc_json = None
+        if mcc_json is None:
+            source = 'unavailable'
+            if os.path.exists(mcc_filepath):
+                try:
+                    mcc_json = load_report(mcc_filepath)
+                    source = 'last good copy'
+                except Exception as e:
+                    traceback.print_exc()
+        stage_record['rows_out'] = get_row_count(mcc_json)
+    mcc_status = {'source': source, 'fetched': read_report_meta(mcc_filepath).get('fetched') if mcc_json is not None else None}
+    return mcc_json, mcc_status
+
+def format_fetch_date(fetched):
+    return datetime.fromtimestamp(fetched).strftime('%m/%d/%Y') if fetched else 'unavailable'
+
+@instrument_stage('get_subjects_json')
+def get_subjects_json(report, report_suffix,  file_url_root=None, mcc_list =[1,2], DATA_PATH = None, streaming = SUBJECTS_STREAMING):
+    '''Load the subjects report for each MCC, fetching all MCCs in parallel. With streaming, each report is returned
+    as the compact, pre-filtered dataframe from read_subjects_frame instead of the full json dictionary.
+
+    An MCC whose report cannot be fetched is served from the last good copy on disk. Along with the reports, returns
+    the overall data source, the data date (the oldest fetch among the MCCs) and the status of each MCC from
+    load_mcc_json. MCCs with no report at all are left out of subjects_json.'''
+    load_report = read_subjects_frame if streaming else load_json_file
+    json_urls = ['/'.join([file_url_root, report,report_suffix.replace('[mcc]',str(mcc))]) for mcc in mcc_list]
+    mcc_filepaths = [os.path.join(DATA_PATH, report_suffix.replace('[mcc]',str(mcc))) for mcc in mcc_list]
+    with ThreadPoolExecutor(max_workers=max(len(mcc_list), 1)) as executor:
+        mcc_results = list(executor.map(load_mcc_json, mcc_list, json_urls, mcc_filepaths, [load_report] * len(mcc_list)))
+
+    subjects_json, mcc_status = {}, {}
+    for mcc, (mcc_json, status) in zip(mcc_list, mcc_results):
+        mcc_status[mcc] = status
+        if mcc_json is not None:
+            subjects_json[mcc] = mcc_json
+
+    sources = set(status['source'] for status in mcc_status.values())
+    if sources == {'API'}:
         data_source = 'API'
-        data_date = datetime.now().strftime('%m/%d/%Y')
-
-        # for mcc in mcc_list:
-        #     mcc_filename = ''.join(['subjects-',str(mcc),'-latest.json'])
-        #     mcc_filepath = os.path.join(DATA_PATH, mcc_filename)
-        #     with open(mcc_filepath, 'r') as f:
-        #         subjects_json[mcc] = json.load(f)
-        # data_source = 'local files'
-        # data_date = '06/15/2022'
-    except:
-        #load local files if API failss
-        for mcc in mcc_list:
-            mcc_filename = ''.join(['subjects-',str(mcc),'-latest.json'])
-            mcc_filepath = os.path.join(DATA_PATH, mcc_filename)
-            with open(mcc_filepath, 'r') as f:
-                subjects_json[mcc] = json.load(f)
+    elif 'API' in sources:
+        data_source = 'API and local files'
+    else:
         data_source = 'local files'
-        data_date = '06/15/2022'
+    fetch_times = [status['fetched'] for status in mcc_status.values() if status['fetched']]
+    data_date = format_fetch_date(min(fetch_times)) if fetch_times else 'unavailable'
 
-    return subjects_json, data_source, data_date
+    return subjects_json, data_source, data_date, mcc_status
 
 
+@instrument_stage('combine_mcc_json', rows_in_arg='mcc_json')
 def combine_mcc_json(mcc_json):
-    '''Convert MCC json subjects data into dataframe and combine'''
+    '''Convert MCC json subjects data into dataframe and combine. Reports that were already read into dataframes by
+    streaming ingestion are combined as they are.'''
     df = pd.DataFrame()
     for mcc in mcc_json:
-        mcc_data = pd.DataFrame.from_dict(mcc_json[mcc], orient='index').reset_index()
+        if isinstance(mcc_json[mcc], pd.DataFrame):
+            mcc_data = mcc_json[mcc].copy()
+        else:
+            mcc_data = pd.DataFrame.from_dict(mcc_json[mcc], orient='index').reset_index()
         mcc_data['mcc'] = mcc
         if df.empty:
             df = mcc_data
@@ -186,25 +381,93 @@ def combine_mcc_json(mcc_json):
 
     return df
 
-def add_screening_site(screening_sites, df, id_col):
-    # Get dataframes
-    ids = df.loc[:, [id_col]]
+def build_screening_site_index(screening_sites):
+    '''Build an interval index over the screening site record_id_start / record_id_end ranges so record ids can be
+    assigned to screening sites with a binary search. Ranges are sorted by start; overlapping ranges are flagged
+    so add_screening_site can match a record to every range containing it. Sites with no range are left out.'''
+    ranges = screening_sites[['record_id_start', 'record_id_end']].apply(pd.to_numeric, errors='coerce')
+    has_range = ranges.notnull().all(axis=1).values
+    rows = np.nonzero(has_range)[0]
+    order = rows[np.argsort(ranges['record_id_start'].values[rows], kind='stable')]
+    starts = ranges['record_id_start'].values[order]
+    ends = ranges['record_id_end'].values[order]
+    overlapping = bool(len(starts) > 1 and np.any(starts[1:] <= np.maximum.accumulate(ends)[:-1]))
+    if overlapping:
+        logger.warning('screening site record_id ranges overlap; records in the overlap are assigned to every matching site')
+
+    site_index = {'starts': starts, 'ends': ends, 'rows': order, 'overlapping': overlapping}
+    return site_index
+
+def build_site_targets(screening_sites):
+    '''Parse the per-site monthly enrollment targets of screening_sites once into a (site x study month) matrix.
+    expected_enrollment and study_month hold comma separated vectors, and study month 1 is the site's start_month
+    of start_year. Returns a dictionary with the 'sites' with targets (mcc, screening_site, site, surgery_type), the
+    'start_months' of their study month 1, the 'expected' matrix, with zeros for study months a site does not list,
+    and 'listed', true for the study months each site lists. Sites without targets are left out.'''
+    target_cols = ['expected_enrollment', 'study_month', 'start_month', 'start_year']
+    sites = screening_sites.dropna(subset=target_cols).reset_index(drop=True)
+    expected = sites['expected_enrollment'].astype(str).str.split(',').explode().dropna()
+    study_month = sites['study_month'].astype(str).str.split(',').explode().dropna()
+    rows = expected.index.values
+    cols = study_month.astype(int).values - 1
+    n_study_months = cols.max() + 1 if len(cols) else 0
+
+    expected_matrix = np.zeros((len(sites), n_study_months), dtype='int64')
+    expected_matrix[rows, cols] = expected.astype(int).values
+    listed = np.zeros((len(sites), n_study_months), dtype=bool)
+    listed[rows, cols] = True
+    # Month ordinals count months from January 1970
+    start_ordinals = (sites['start_year'].astype(int).values - 1970) * 12 + sites['start_month'].astype(int).values - 1
+
+    site_targets = {
+        'sites': sites[['mcc', 'screening_site', 'site', 'surgery_type']],
+        'start_months': get_months_from_ordinals(start_ordinals),
+        'expected': expected_matrix,
+        'listed': listed,
+    }
+    return site_targets
 
-    # open sql connection to create new datarframe with record_id paired to screening site
-    conn = sqlite3.connect(':memory:')
-    ids.to_sql('ids', conn, index=False)
-    screening_sites.to_sql('ss', conn, index=False)
+def get_site_targets(screening_sites):
+    return screening_sites.attrs.get('site_targets') or build_site_targets(screening_sites)
 
-    sql_qry = f'''
-    select {id_col}, screening_site, site, surgery_type, record_id_start, record_id_end
-    from ids
-    join ss on
-    ids.{id_col} between ss.record_id_start and ss.record_id_end
-    '''
-    sites = pd.read_sql_query(sql_qry, conn)
-    conn.close()
+def load_screening_sites(ASSETS_PATH, screening_sites_file):
+    '''Load the screening sites file, with its record_id interval index and site target matrix built once and kept
+    in the dataframe's attrs'''
+    try:
+        if ASSETS_PATH:
+            screening_sites = pd.read_csv(os.path.join(ASSETS_PATH, screening_sites_file))
+        else:
+            screening_sites = pd.read_csv(screening_sites_file)
+        screening_sites.attrs['site_index'] = build_screening_site_index(screening_sites)
+        screening_sites.attrs['site_targets'] = build_site_targets(screening_sites)
+        return screening_sites
+    except Exception as e:
+        traceback.print_exc()
+        return None
 
-    df = sites.merge(df, how='left', on=id_col)
+@instrument_stage('add_screening_site', rows_in_arg='df')
+def add_screening_site(screening_sites, df, id_col):
+    '''Pair each row of df with the screening site whose record_id range contains df[id_col]. Rows whose id is
+    missing or outside every range are dropped; with overlapping ranges a row appears once per matching site.'''
+    site_index = screening_sites.attrs.get('site_index') or build_screening_site_index(screening_sites)
+    starts, ends = site_index['starts'], site_index['ends']
+    ids = pd.to_numeric(df[id_col], errors='coerce').values.astype('float64')
+
+    if site_index['overlapping']:
+        # Compare each id with every range (there are only a handful of screening sites)
+        matches = (ids[:, None] >= starts[None, :]) & (ids[:, None] <= ends[None, :])
+        df_rows, range_positions = np.nonzero(matches)
+    else:
+        # Disjoint ranges: the only candidate is the last range starting at or before the id
+        range_positions = np.searchsorted(starts, ids, side='right') - 1
+        in_range = (range_positions >= 0) & (ids <= ends[np.clip(range_positions, 0, None)])  # NaN ids never match
+        df_rows = np.nonzero(in_range)[0]
+        range_positions = range_positions[in_range]
+
+    site_cols = ['screening_site', 'site', 'surgery_type', 'record_id_start', 'record_id_end']
+    sites = screening_sites[site_cols].iloc[site_index['rows'][range_positions]].reset_index(drop=True)
+    df_matched = df.iloc[df_rows].reset_index(drop=True)
+    df = pd.concat([df_matched[[id_col]], sites, df_matched.drop(columns=[id_col])], axis=1)
 
     return df
 
@@ -212,6 +475,10 @@ def add_screening_site(screening_sites, df, id_col):
 # DATA CLEANING
 # ----------------------------------------------------------------------------
 
+# Columns of the raw subjects data used to build the enrolled dataframe
+ENROLLED_SOURCE_COLS = ['index', 'main_record_id', 'obtain_date', 'mcc', 'redcap_data_access_group','sp_data_site']
+
+@instrument_stage('get_enrolled', rows_in_arg='subjects_json')
 def get_enrolled(subjects_json, screening_sites, display_terms_dict, display_terms_dict_multi):
     '''Take the raw subjects data frame and clean it up. Note that apis don't pass datetime columns well, so
     these should be converted to datetime by the receiver.'''
@@ -220,116 +487,256 @@ def get_enrolled(subjects_json, screening_sites, display_terms_dict, display_ter
         subjects_raw = combine_mcc_json(subjects_json)
         subjects_raw.reset_index(drop=True, inplace=True)
 
+        return clean_enrolled(subjects_raw, screening_sites, display_terms_dict, display_terms_dict_multi)
+
+    except Exception as e:
+        traceback.print_exc()
+        return None
 
-        # Select only consented patients (obtain_date not null) who have not dropped out (ewdateterm null) and needed columns
-        enrolled_cols = ['index', 'main_record_id', 'obtain_date',
-            'mcc', 'redcap_data_access_group','sp_data_site']
-        enrolled = subjects_raw[(subjects_raw.obtain_date != 'N/A') & (subjects_raw.ewdateterm == 'N/A')][enrolled_cols].copy()
-        # Rename 'index' to 'record_id'
-        enrolled.rename(columns={"index": "record_id"}, inplace = True)
+@instrument_stage('clean_enrolled', rows_in_arg='subjects_raw')
+def clean_enrolled(subjects_raw, screening_sites, display_terms_dict, display_terms_dict_multi, extra_cols = []):
+    '''Clean the combined raw subjects dataframe into the enrolled dataframe. Any extra_cols of the raw data are
+    carried through unchanged.'''
+    # Select only consented patients (obtain_date not null) who have not dropped out (ewdateterm null) and needed columns
+    enrolled_cols = ENROLLED_SOURCE_COLS + extra_cols
+    enrolled = subjects_raw[(subjects_raw.obtain_date != 'N/A') & (subjects_raw.ewdateterm == 'N/A')][enrolled_cols].copy()
 
-        # Convert all string 'N/A' values to nan values
-        enrolled = enrolled.replace('N/A', np.nan)
+    # Rename 'index' to 'record_id'
+    enrolled.rename(columns={"index": "record_id"}, inplace = True)
 
-        # Coerce numeric values to enable merge
-        enrolled = enrolled.apply(pd.to_numeric, errors='ignore')
+    # Convert all string 'N/A' values to nan values
+    enrolled = enrolled.replace('N/A', np.nan)
 
-        # Merge columns on the display terms dictionary to convert from database terminology to user terminology
-        for i in display_terms_dict.keys():
-            if i in enrolled.columns: # Merge columns if the column exists in the dataframe
-                display_terms = display_terms_dict[i]
-                if enrolled[i].dtype == np.float64:
-                    # for display columns where data is numeric, merge on display dictionary, treating cols as floats to handle nas
-                    display_terms[i] = display_terms[i].astype('float64')
-                enrolled = enrolled.merge(display_terms, how='left', on=i)
+    # Coerce numeric values to enable merge
+    enrolled = enrolled.apply(pd.to_numeric, errors='ignore')
 
+    # Map columns through the display terms dictionary to convert from database terminology to user terminology
+    for field, display_map in get_display_maps(display_terms_dict).items():
+        if field in enrolled.columns: # Map columns if the column exists in the dataframe
+            enrolled[field + '_display'] = translate_column(enrolled[field], display_map)
 
+    # Add screening sites
+    enrolled = add_screening_site(screening_sites, enrolled, 'record_id')
 
-        # Add screening sites
-        enrolled = add_screening_site(screening_sites, enrolled, 'record_id')
+    # Convert datetime columns
+    enrolled['obtain_date'] = pd.to_datetime(enrolled['obtain_date'], errors='coerce')
 
-        # Convert datetime columns
-        enrolled['obtain_date'] = enrolled['obtain_date'] .apply(pd.to_datetime, errors='coerce')
+    # get treatment site column: the sp_data_site display value, or the data access group where that is missing
+    enrolled['treatment_site'] = enrolled['sp_data_site_display'].fillna(enrolled['redcap_data_access_group_display'])
+    enrolled['treatment_site_type'] = enrolled['treatment_site'] + "/" + enrolled['surgery_type']
 
-        # get treatment site column
-        enrolled['treatment_site'] = enrolled.apply(lambda x: use_b_if_not_a(x['sp_data_site_display'], x['redcap_data_access_group_display']), axis=1)
-        enrolled['treatment_site_type'] = enrolled['treatment_site'] + "/" + enrolled['surgery_type']
+    # Modify columns
+    enrolled['Site'] = enrolled['screening_site'] + ' (' + enrolled['surgery_type'] + ')'
 
-        # Modify columns
-        enrolled['obtain_month'] = enrolled['obtain_date'].dt.to_period('M')
-        enrolled['Site'] = enrolled['screening_site'] + ' (' + enrolled['surgery_type'] + ')'
+    return compact_enrolled(enrolled)
 
-        return enrolled
+# Repeated site and surgery labels are held as categoricals
+ENROLLED_CATEGORY_COLS = ['screening_site', 'site', 'surgery_type', 'Site', 'treatment_site', 'treatment_site_type',
+                          'redcap_data_access_group', 'redcap_data_access_group_display', 'sp_data_site_display']
 
-    except Exception as e:
-        traceback.print_exc()
-        return None
+def compact_enrolled(enrolled):
+    '''Convert the enrolled dataframe to its compact layout: categoricals for the repeated site and surgery labels,
+    and obtain_month as datetime64 month starts rather than Period objects'''
+    for col in ENROLLED_CATEGORY_COLS:
+        if col in enrolled.columns:
+            # Sorted categories keep groupby and sort order the same as for the original string columns
+            enrolled[col] = enrolled[col].astype('category')
+            enrolled[col] = enrolled[col].cat.reorder_categories(sorted(enrolled[col].cat.categories))
+    enrolled['obtain_date'] = pd.to_datetime(enrolled['obtain_date'], errors='coerce')
+    enrolled['obtain_month'] = get_month_start(enrolled['obtain_date'])
+    return enrolled
 
 # ----------------------------------------------------------------------------
 # Enrollment FUNCTIONS
 # ----------------------------------------------------------------------------
 
-def enrollment_rollup(enrollment_df, index_col, grouping_cols, count_col_name, cumsum=True, fill_na_value = 0):
-    enrollment_count = enrollment_df.groupby([index_col] + grouping_cols).size().reset_index(name=count_col_name).fillna({count_col_name:fill_na_value})
+# Months are held as datetime64 month starts, and month arithmetic is done on month ordinals (months since January
+# 1970), so no Period objects are created
+def get_month_start(dates):
+    '''Truncate a Series of datetimes to the start of their month'''
+    return pd.Series(dates.values.astype('datetime64[M]').astype('datetime64[ns]'), index=dates.index, name=dates.name)
+
+def get_month_ordinals(months):
+    return np.asarray(months, dtype='datetime64[M]').astype('int64')
+
+def get_months_from_ordinals(ordinals):
+    return np.asarray(ordinals, dtype='int64').astype('datetime64[M]').astype('datetime64[ns]')
+
+def get_month_grid(groups_df, first_months, last_month, month_col):
+    '''Repeat each row of groups_df once for every month from its entry in first_months through last_month, adding
+    the month as month_col. Returns the grid and each row's position within its group's months.'''
+    first_ordinals = get_month_ordinals(first_months)
+    n_months = np.clip(get_month_ordinals(last_month) - first_ordinals + 1, 0, None)
+    rows = np.repeat(np.arange(len(groups_df)), n_months)
+    month_index = np.arange(n_months.sum()) - np.repeat(np.cumsum(n_months) - n_months, n_months)
+    month_grid = groups_df.iloc[rows].reset_index(drop=True)
+    month_grid[month_col] = get_months_from_ordinals(first_ordinals[rows] + month_index)
+    return month_grid, month_index
+
+def fill_missing_months(enrollment_count, index_col, grouping_cols, count_col_name, fill_na_value = 0):
+    '''Add a row with fill_na_value for every month with no enrollments, from each group's first month through the
+    last month in enrollment_count'''
+    if enrollment_count.empty:
+        return enrollment_count
+    first_months = enrollment_count.groupby(grouping_cols, observed=True, sort=False)[index_col].min().reset_index()
+    month_grid, month_index = get_month_grid(first_months[grouping_cols], first_months[index_col], enrollment_count[index_col].max(), index_col)
+    enrollment_count = month_grid[[index_col] + grouping_cols].merge(enrollment_count, how='left', on=[index_col] + grouping_cols)
+    enrollment_count[count_col_name] = enrollment_count[count_col_name].fillna(fill_na_value).astype(int)
+    return enrollment_count
+
+@instrument_stage('enrollment_rollup', rows_in_arg='enrollment_df')
+def enrollment_rollup(enrollment_df, index_col, grouping_cols, count_col_name, cumsum=True, fill_na_value = 0, count_col = None, full_months = False):
+    '''Count enrollments by the month column index_col and grouping_cols. enrollment_df is either one row per
+    enrolled subject, or a finer rollup whose counts are in count_col, so coarser rollups can be derived from one
+    base rollup instead of grouping the subject rows again. With full_months, months with no enrollments are
+    included with a count of fill_na_value.'''
+    if count_col:
+        enrollment_count = enrollment_df.groupby([index_col] + grouping_cols, observed=True)[count_col].sum().reset_index(name=count_col_name)
+    else:
+        enrollment_count = enrollment_df.groupby([index_col] + grouping_cols, observed=True).size().reset_index(name=count_col_name).fillna({count_col_name:fill_na_value})
+    if full_months:
+        enrollment_count = fill_missing_months(enrollment_count, index_col, grouping_cols, count_col_name, fill_na_value)
+    # observed groupbys on categorical columns are not returned in sorted order
+    enrollment_count = enrollment_count.sort_values([index_col] + grouping_cols, ignore_index=True)
     if cumsum:
-        enrollment_count['Cumulative'] = enrollment_count.groupby(grouping_cols)[count_col_name].cumsum()
+        enrollment_count['Cumulative'] = enrollment_count.groupby(grouping_cols, observed=True)[count_col_name].cumsum()
 
     return enrollment_count
 
+# Dimensions of the base rollup. Site is determined by screening_site and surgery_type but is carried for display.
+BASE_ROLLUP_COLS = ['mcc', 'screening_site', 'surgery_type', 'Site']
+
+@instrument_stage('get_base_rollup', rows_in_arg='enrolled')
+def get_base_rollup(enrolled):
+    '''Count the enrolled subjects once by month x mcc x screening_site x surgery_type. Every other rollup in the
+    report is derived from this by passing it to enrollment_rollup with count_col='Monthly'.'''
+    return enrollment_rollup(enrolled, 'obtain_month', BASE_ROLLUP_COLS, 'Monthly', cumsum=False)
+
+@instrument_stage('update_base_rollup', rows_in_arg='base_rollup')
+def update_base_rollup(base_rollup, added, removed, enrolled):
+    '''Apply a change in the enrolled rows to a base rollup: the added and removed rows are counted by month and
+    group, and their counts are added to and taken from the base rollup's, so only the changed rows are grouped. The
+    result equals get_base_rollup(enrolled), where enrolled is the dataframe after the change, whose column types the
+    result takes.'''
+    if len(added) == 0 and len(removed) == 0:
+        return base_rollup
+
+    # Each month and group is encoded as one integer, from the month ordinal and the position of each group value
+    # among the values of that column, in the column order of the rollup, so the sorted integers are in the row order
+    # of get_base_rollup. Category columns use the categories of enrolled: values that are no longer among them have
+    # no enrolled rows left, so their counts are dropped.
+    def get_value_codes(series, values):
+        '''Position of each element of series in the index values, or -1 for missing values and values not in it'''
+        if series.dtype == 'category':
+            # Look up each category once rather than each element
+            category_codes = np.append(values.get_indexer(series.cat.categories), -1)
+            return category_codes[series.cat.codes.values]
+        return values.get_indexer(series)
+
+    frames = [base_rollup, added, removed]
+    weights = np.concatenate([base_rollup['Monthly'].values.astype('int64'), np.ones(len(added), dtype='int64'),
+                              -np.ones(len(removed), dtype='int64')])
+    ordinals = np.concatenate([get_month_ordinals(frame['obtain_month']) for frame in frames])
+    # As in the groupby of get_base_rollup, rows with a missing month or group value are not counted
+    valid = np.concatenate([frame['obtain_month'].notnull().values for frame in frames])
+    first_ordinal = ordinals[valid].min() if valid.any() else 0
+    keys = np.where(valid, ordinals - first_ordinal, 0)
+    col_values = []
+    for col in BASE_ROLLUP_COLS:
+        if enrolled[col].dtype == 'category':
+            values = enrolled[col].cat.categories
+        else:
+            values = pd.Index(pd.concat([frame[col] for frame in frames]).dropna().unique()).sort_values()
+        codes = np.concatenate([get_value_codes(frame[col], values) for frame in frames])
+        valid &= codes >= 0
+        keys = keys * max(len(values), 1) + codes
+        col_values.append(values)
+
+    group_keys, group_rows = np.unique(keys[valid], return_inverse=True)
+    counts = np.bincount(group_rows, weights=weights[valid], minlength=len(group_keys)).round().astype('int64')
+    group_keys = group_keys[counts > 0]
+
+    updated = {}
+    for col, values in reversed(list(zip(BASE_ROLLUP_COLS, col_values))):
+        codes = group_keys % max(len(values), 1)
+        group_keys = group_keys // max(len(values), 1)
+        if enrolled[col].dtype == 'category':
+            updated[col] = pd.Categorical.from_codes(codes, dtype=enrolled[col].dtype)
+        else:
+            updated[col] = values.take(codes).values.astype(enrolled[col].dtype)
+    updated['obtain_month'] = get_months_from_ordinals(group_keys + first_ordinal)
+    updated['Monthly'] = counts[counts > 0].astype(base_rollup['Monthly'].dtype)
+    return pd.DataFrame(updated, columns=['obtain_month'] + BASE_ROLLUP_COLS + ['Monthly'])
+
+@instrument_stage('get_site_enrollments', rows_in_arg='enrollment_count')
 def get_site_enrollments(enrollment_count, mcc):
     site_enrollments = enrollment_count[enrollment_count.mcc == mcc].copy()
     replace_string = 'MCC'+str(mcc)+': '
     site_enrollments['Site'] = site_enrollments['Site'].str.replace(replace_string,'')
     site_enrollments = pd.pivot(site_enrollments, index=['obtain_month'], columns = 'Site', values=['Monthly','Cumulative'])
-    site_enrollments = site_enrollments.swaplevel(0,1, axis=1).sort_index(1).reindex(['Monthly','Cumulative'], level=1, axis=1).reset_index()
+    site_enrollments = site_enrollments.swaplevel(0,1, axis=1).sort_index(axis=1).reindex(['Monthly','Cumulative'], level=1, axis=1).reset_index()
     site_enrollments['Month'] = site_enrollments['obtain_month'].dt.strftime("%B")
     site_enrollments['Year'] = site_enrollments['obtain_month'].dt.strftime("%Y")
     site_enrollments = site_enrollments.set_index(['Month','Year']).drop(columns='obtain_month')
     return site_enrollments
 
-def get_enrollment_expectations():
-    enrollment_expectations_dict = {'mcc': ['1','1','2','2'],
-                                'surgery_type':['TKA','Thoracic','Thoracic','TKA'],
-                                'start_month': ['02/22','06/22','02/22','06/22'],
-                                'expected_cumulative_start':[280,10,70,10], 'expected_monthly':[30,10,30,10]}
-
-    enrollment_expectations_df = pd.DataFrame.from_dict(enrollment_expectations_dict)
-    enrollment_expectations_df['start_month'] =  pd.to_datetime(enrollment_expectations_df['start_month'], format='%m/%y').dt.to_period('M')
+def get_enrollment_expectations(ASSETS_PATH = ASSETS_PATH, enrollment_expectations_file = DEFAULT_REPORT_CONFIG['enrollment_expectations_file']):
+    '''Load the expected enrollment of each mcc / surgery type: the expected cumulative enrollment at start_month
+    (mm/yy) and the expected monthly enrollment after it'''
+    if ASSETS_PATH:
+        enrollment_expectations_df = pd.read_csv(os.path.join(ASSETS_PATH, enrollment_expectations_file), dtype={'start_month': str})
+    else:
+        enrollment_expectations_df = pd.read_csv(enrollment_expectations_file, dtype={'start_month': str})
+    enrollment_expectations_df['start_month'] =  pd.to_datetime(enrollment_expectations_df['start_month'], format='%m/%y')
 
     enrollment_expectations_df['mcc'] = enrollment_expectations_df['mcc'].astype(int)
 
     return enrollment_expectations_df
 
-def get_enrollment_expectations_monthly(enrollment_expectations_df):
-    mcc_type_expectations = pd.DataFrame()
-    for i in range(len(enrollment_expectations_df)):
-        mcc = enrollment_expectations_df.iloc[i]['mcc']
-        surgery_type = enrollment_expectations_df.iloc[i]['surgery_type']
-        start_month = enrollment_expectations_df.iloc[i]['start_month']
-        expected_start_count = enrollment_expectations_df.iloc[i]['expected_cumulative_start']
-        expected_monthly = enrollment_expectations_df.iloc[i]['expected_monthly']
-
-        months = pd.period_range(start_month,datetime.now(),freq='M').tolist()
-        expected_monthly_series = len(months) * [expected_monthly]
-
-        for index, month in enumerate(months):
-            new_row = {'mcc':mcc,
-                       'surgery_type': surgery_type,
-                       'Month': month,
-                       'Expected: Monthly': expected_monthly_series[index],
-                       'Expected: Cumulative': expected_start_count+index*expected_monthly}
-            mcc_type_expectations = mcc_type_expectations.append(new_row, ignore_index=True)
+@instrument_stage('get_enrollment_expectations_monthly', rows_in_arg='enrollment_expectations_df')
+def get_enrollment_expectations_monthly(enrollment_expectations_df, end_month = None):
+    '''Expand the mcc / surgery type expectations into one row per month from each start_month through end_month
+    (default: the current month), with the expected monthly and cumulative enrollment. The whole
+    (mcc, surgery_type, month) grid is built with array operations rather than row by row.'''
+    if end_month is None:
+        end_month = np.datetime64(datetime.now(), 'M')
+    expectations, month_index = get_month_grid(enrollment_expectations_df, enrollment_expectations_df['start_month'], end_month, 'Month')
+    mcc_type_expectations = pd.DataFrame({
+        'mcc': expectations['mcc'],
+        'surgery_type': expectations['surgery_type'],
+        'Month': expectations['Month'],
+        'Expected: Monthly': expectations['expected_monthly'],
+        'Expected: Cumulative': expectations['expected_cumulative_start'] + month_index * expectations['expected_monthly'],
+    })
 
     return mcc_type_expectations
 
-def rollup_enrollment_expectations(enrollment_df, enrollment_expectations_df, monthly_expectations):
+@instrument_stage('get_site_expectations_monthly', rows_in_arg='screening_sites')
+def get_site_expectations_monthly(screening_sites):
+    '''Expand the per-site monthly enrollment targets of screening_sites into one row per site and study month
+    listed in its targets (see build_site_targets). Sites without targets are left out.'''
+    site_targets = get_site_targets(screening_sites)
+    rows, cols = np.nonzero(site_targets['listed'])
+    site_expectations = site_targets['sites'].iloc[rows].reset_index(drop=True)
+    site_expectations['study_month'] = cols + 1
+    site_expectations['Month'] = get_months_from_ordinals(get_month_ordinals(site_targets['start_months'])[rows] + cols)
+    site_expectations['Expected: Monthly'] = site_targets['expected'][rows, cols]
+    site_expectations['Expected: Cumulative'] = site_targets['expected'].cumsum(axis=1)[rows, cols]
+
+    return site_expectations
+
+@instrument_stage('rollup_enrollment_expectations', rows_in_arg='enrollment_df')
+def rollup_enrollment_expectations(enrollment_df, enrollment_expectations_df, monthly_expectations, count_col = None):
+    '''Roll up enrollments by mcc and surgery type against the monthly expectations. Enrollments before an
+    expectation's start month count toward the start month. enrollment_df may be a base rollup with counts in
+    count_col (see enrollment_rollup).'''
     enrollment_df = enrollment_df.merge(enrollment_expectations_df[['mcc','surgery_type','start_month']], how='left', on=['mcc','surgery_type'])
 
     # Determine if values in early months or should be broken out
     enrollment_df['expected_month'] = np.where(enrollment_df['obtain_month'] <= enrollment_df['start_month'], enrollment_df['start_month'], enrollment_df['obtain_month'] )
 
     # Rolll up data by month
-    ee_rollup = enrollment_rollup(enrollment_df, 'expected_month', ['mcc','surgery_type'], 'Monthly').sort_values(by='mcc')
+    ee_rollup = enrollment_rollup(enrollment_df, 'expected_month', ['mcc','surgery_type'], 'Monthly', count_col=count_col, full_months=True).sort_values(by='mcc', kind='stable')
     ee_rollup_rename_dict={
         'expected_month':'Month',
         'Monthly': 'Actual: Monthly',
@@ -352,16 +759,277 @@ def rollup_enrollment_expectations(enrollment_df, enrollment_expectations_df, mo
     return ee_rollup
 
 
-def get_plot_date(enrollment_df, summary_rollup):
+@instrument_stage('get_plot_date', rows_in_arg='enrollment_df')
+def get_plot_date(enrollment_df, summary_rollup, count_col = None):
     cols = ['Month', 'mcc', 'surgery_type', 'Expected: Monthly', 'Expected: Cumulative']
     expected_data = summary_rollup[cols].copy()
     expected_data.columns = [s.replace('Expected: ','') for s in list(expected_data.columns)]
     expected_data['type'] = 'Expected'
-    ec= enrollment_rollup(enrollment_df, 'obtain_month', ['mcc','surgery_type'], 'Monthly').rename(columns={'obtain_month':'Month'})
+    ec= enrollment_rollup(enrollment_df, 'obtain_month', ['mcc','surgery_type'], 'Monthly', count_col=count_col, full_months=True).rename(columns={'obtain_month':'Month'})
     ec['type'] = 'Actual'
 
-    df = ec.append(expected_data, ignore_index=True )
-
-    df['Month'] = df['Month'].apply(lambda x: x.to_timestamp())
+    df = pd.concat([ec, expected_data], ignore_index=True)
 
     return df
+
+# ----------------------------------------------------------------------------
+# ENROLLMENT CUBE
+# ----------------------------------------------------------------------------
+
+@instrument_stage('get_enrollment_cube', rows_in_arg='base_rollup', rows_out=False)
+def get_enrollment_cube(base_rollup):
+    '''Hold the base rollup as a dense month x screening site x surgery type array of monthly enrollments, along with
+    its running total over the months, so any selection of months, MCCs, sites and surgery types is answered by
+    slicing and summing arrays instead of grouping rows. Months run without gaps from the first to the last month
+    with enrollments. Returns a dictionary with the 'counts' and 'cumulative' arrays and the labels of each axis:
+    'months', 'sites' (with the mcc of each site in 'site_mccs') and 'surgery_types'.'''
+    rollup = base_rollup[base_rollup['Monthly'] > 0]
+    site_pos, sites = pd.factorize(rollup['screening_site'].astype(str), sort=True)
+    type_pos, surgery_types = pd.factorize(rollup['surgery_type'].astype(str), sort=True)
+    month_ordinals = get_month_ordinals(rollup['obtain_month'])
+    first_month = month_ordinals.min() if len(rollup) else 0
+    n_months = month_ordinals.max() - first_month + 1 if len(rollup) else 0
+
+    counts = np.zeros((n_months, len(sites), len(surgery_types)), dtype=np.int32)
+    np.add.at(counts, (month_ordinals - first_month, site_pos, type_pos), rollup['Monthly'].values)
+    site_mccs = np.zeros(len(sites), dtype=rollup['mcc'].dtype)
+    site_mccs[site_pos] = rollup['mcc'].values
+
+    return {
+        'months': get_months_from_ordinals(np.arange(first_month, first_month + n_months)),
+        'sites': np.asarray(sites, dtype=object),
+        'site_mccs': site_mccs,
+        'surgery_types': np.asarray(surgery_types, dtype=object),
+        'counts': counts,
+        'cumulative': counts.cumsum(axis=0, dtype=np.int32),
+    }
+
+def query_enrollment_cube(cube, start_month = None, end_month = None, mccs = None, sites = None, surgery_types = None):
+    '''Monthly and cumulative enrollment by month and surgery type for the months from start_month through
+    end_month, summed over the selected MCCs, screening sites and surgery types (None selects all of them).
+    Cumulative counts are totals to date, so they include enrollments before start_month. Returns the selected
+    months and surgery types and the monthly and cumulative arrays of shape (months, surgery types).'''
+    months = cube['months']
+    first = np.searchsorted(months, np.datetime64(start_month, 'ns')) if start_month is not None else 0
+    last = np.searchsorted(months, np.datetime64(end_month, 'ns'), side='right') if end_month is not None else len(months)
+
+    site_mask = np.ones(len(cube['sites']), dtype=bool)
+    if mccs is not None:
+        site_mask &= np.isin(cube['site_mccs'], list(mccs))
+    if sites is not None:
+        site_mask &= np.isin(cube['sites'], list(sites))
+    type_mask = np.ones(len(cube['surgery_types']), dtype=bool)
+    if surgery_types is not None:
+        type_mask &= np.isin(cube['surgery_types'], list(surgery_types))
+
+    monthly = cube['counts'][first:last][:, site_mask][:, :, type_mask].sum(axis=1)
+    cumulative = cube['cumulative'][first:last][:, site_mask][:, :, type_mask].sum(axis=1)
+    return months[first:last], cube['surgery_types'][type_mask], monthly, cumulative
+
+# ----------------------------------------------------------------------------
+# SITE PERFORMANCE
+# ----------------------------------------------------------------------------
+@instrument_stage('get_site_performance', rows_in_arg='screening_sites')
+def get_site_performance(cube, screening_sites):
+    '''Expected vs actual enrollment of every site with targets by study month, through the last month of the
+    enrollment cube. Each site's actual counts are read from the cube's running totals at the calendar months of
+    its study months, so the counts and percentages of all sites are computed at once on (site x study month)
+    arrays. Enrollments before a site's study month 1 count toward study month 1. Percentages are NaN where
+    nothing is expected.'''
+    site_targets = get_site_targets(screening_sites)
+    sites, expected = site_targets['sites'], site_targets['expected']
+    columns = list(sites.columns) + ['study_month', 'Month', 'Expected: Monthly', 'Expected: Cumulative', 'Actual: Monthly',
+                                     'Actual: Cumulative', 'Percent: Monthly', 'Percent: Cumulative']
+    months = cube['months']
+    if len(months) == 0 or expected.size == 0:
+        return pd.DataFrame(columns=columns)
+
+    # Position of each site's study months on the month axis of the cube, and of the site on its site and surgery
+    # type axes (-1 for sites without enrollments)
+    first_ordinal = get_month_ordinals(months[0])
+    study_ordinals = get_month_ordinals(site_targets['start_months'])[:, None] + np.arange(expected.shape[1])[None, :]
+    month_pos = study_ordinals - first_ordinal
+    site_pos = pd.Index(cube['sites']).get_indexer(sites['screening_site'].astype(str))[:, None]
+    type_pos = pd.Index(cube['surgery_types']).get_indexer(sites['surgery_type'].astype(str))[:, None]
+
+    running_totals = cube['cumulative'][np.clip(month_pos, 0, len(months) - 1), np.clip(site_pos, 0, None), np.clip(type_pos, 0, None)]
+    actual_cumulative = np.where((month_pos >= 0) & (site_pos >= 0) & (type_pos >= 0), running_totals, 0).astype('int64')
+    actual_monthly = np.diff(actual_cumulative, axis=1, prepend=0)
+    expected_cumulative = expected.cumsum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        percent_monthly = np.where(expected > 0, 100 * actual_monthly / expected, np.nan).round(1)
+        percent_cumulative = np.where(expected_cumulative > 0, 100 * actual_cumulative / expected_cumulative, np.nan).round(1)
+
+    rows, cols = np.nonzero(site_targets['listed'] & (month_pos < len(months)))
+    site_performance = sites.iloc[rows].reset_index(drop=True)
+    site_performance['study_month'] = cols + 1
+    site_performance['Month'] = get_months_from_ordinals(study_ordinals[rows, cols])
+    site_performance['Expected: Monthly'] = expected[rows, cols]
+    site_performance['Expected: Cumulative'] = expected_cumulative[rows, cols]
+    site_performance['Actual: Monthly'] = actual_monthly[rows, cols]
+    site_performance['Actual: Cumulative'] = actual_cumulative[rows, cols]
+    site_performance['Percent: Monthly'] = percent_monthly[rows, cols]
+    site_performance['Percent: Cumulative'] = percent_cumulative[rows, cols]
+    return site_performance
+
+# ----------------------------------------------------------------------------
+# FORECASTING
+# ----------------------------------------------------------------------------
+# Every enrollment series (each site and surgery type, and each MCC and surgery type) is a row of one
+# (series x month) array, so each forecasting method runs once for all series
+
+FORECAST_METHODS = {'rolling_rate': 'Projected: rolling rate', 'exponential_smoothing': 'Projected: exponential smoothing'}
+
+def get_forecast_series(cube):
+    '''Return the labels (level 'site' or 'mcc', mcc, screening_site, surgery_type) and the monthly enrollment array
+    of every series with enrollments in the enrollment cube. MCC series are the sum of the MCC's sites.'''
+    counts = cube['counts']
+    n_months, n_sites, n_types = counts.shape
+    site_series = counts.transpose(1, 2, 0).reshape(n_sites * n_types, n_months)
+    site_labels = pd.DataFrame({
+        'level': 'site',
+        'mcc': np.repeat(cube['site_mccs'], n_types),
+        'screening_site': np.repeat(cube['sites'], n_types),
+        'surgery_type': np.tile(cube['surgery_types'], n_sites),
+    })
+
+    mccs, site_mcc_pos = np.unique(cube['site_mccs'], return_inverse=True)
+    mcc_members = (site_mcc_pos[None, :] == np.arange(len(mccs))[:, None]).astype(counts.dtype)
+    mcc_series = np.einsum('cs,mst->ctm', mcc_members, counts).reshape(len(mccs) * n_types, n_months)
+    mcc_labels = pd.DataFrame({
+        'level': 'mcc',
+        'mcc': np.repeat(mccs, n_types),
+        'screening_site': None,
+        'surgery_type': np.tile(cube['surgery_types'], len(mccs)),
+    })
+
+    labels = pd.concat([mcc_labels, site_labels], ignore_index=True)
+    monthly = np.concatenate([mcc_series, site_series])
+    has_enrollments = monthly.sum(axis=1) > 0
+    return labels[has_enrollments].reset_index(drop=True), monthly[has_enrollments]
+
+def forecast_rolling_rate(monthly, first_months, window = FORECAST_WINDOW):
+    '''Monthly rate of each series: its mean over the last window months, counting only the months since the
+    series' first enrollment'''
+    n_months = monthly.shape[1]
+    months_counted = np.clip(n_months - first_months, 1, window)
+    return monthly[:, -window:].sum(axis=1) / months_counted
+
+def forecast_exponential_smoothing(monthly, first_months, alpha = FORECAST_ALPHA):
+    '''Monthly rate of each series by simple exponential smoothing from the series' first enrollment'''
+    level = np.zeros(monthly.shape[0])
+    for month in range(monthly.shape[1]):
+        smoothed = alpha * monthly[:, month] + (1 - alpha) * level
+        level = np.where(month == first_months, monthly[:, month], np.where(month > first_months, smoothed, 0))
+    return level
+
+def get_enrollment_targets(labels, site_expectations):
+    '''Total planned enrollment of each series from the per-site targets of screening_sites.csv: a site's target is
+    the sum of its expected_enrollment vector and an MCC's target the sum of its sites' targets. NaN where no site
+    of the series has a target.'''
+    site_targets = site_expectations.groupby(['screening_site', 'surgery_type'])['Expected: Monthly'].sum()
+    mcc_targets = site_expectations.groupby(['mcc', 'surgery_type'])['Expected: Monthly'].sum()
+    site_keys = pd.MultiIndex.from_arrays([labels['screening_site'], labels['surgery_type']])
+    mcc_keys = pd.MultiIndex.from_arrays([labels['mcc'], labels['surgery_type']])
+    targets = np.where(labels['level'] == 'site', site_targets.reindex(site_keys).values, mcc_targets.reindex(mcc_keys).values)
+    return targets.astype(float)
+
+@instrument_stage('get_enrollment_forecast', rows_out=False)
+def get_enrollment_forecast(cube, site_expectations, horizon = FORECAST_HORIZON, window = FORECAST_WINDOW, alpha = FORECAST_ALPHA):
+    '''Project the cumulative enrollment of every site and MCC series for horizon months past the last month of the
+    cube with each forecasting method, and the month each series reaches its target at the projected rate.
+
+    Returns a dictionary with 'projections', the projected cumulative enrollment by series, method and month
+    (starting from the last actual month so the lines join the actuals), and 'summary', one row per series and
+    method with the enrolled total, target, monthly rate and target month (NaT if the target is not reached or the
+    series has no target).'''
+    labels, monthly = get_forecast_series(cube)
+    empty = {'projections': pd.DataFrame(columns=list(labels.columns) + ['method', 'type', 'Month', 'Cumulative']),
+             'summary': pd.DataFrame(columns=list(labels.columns) + ['method', 'type', 'Enrolled', 'Target', 'Monthly rate', 'Target month'])}
+    if len(labels) == 0:
+        return empty
+
+    first_months = (monthly > 0).argmax(axis=1)
+    enrolled = monthly.sum(axis=1)
+    targets = get_enrollment_targets(labels, site_expectations)
+    last_ordinal = get_month_ordinals(cube['months'][-1])
+    steps = np.arange(horizon + 1)
+    projection_months = get_months_from_ordinals(last_ordinal + steps)
+    rates = {'rolling_rate': forecast_rolling_rate(monthly, first_months, window),
+             'exponential_smoothing': forecast_exponential_smoothing(monthly, first_months, alpha)}
+
+    projections, summaries = [], []
+    for method, rate in rates.items():
+        cumulative = enrolled[:, None] + rate[:, None] * steps[None, :]
+        projection = labels.loc[np.repeat(np.arange(len(labels)), len(steps))].reset_index(drop=True)
+        projection['method'] = method
+        projection['type'] = FORECAST_METHODS[method]
+        projection['Month'] = np.tile(projection_months, len(labels))
+        projection['Cumulative'] = cumulative.ravel().round(1)
+        projections.append(projection)
+
+        # Months from the last actual month until the target is reached: 0 if it already is, NaN if never
+        with np.errstate(divide='ignore', invalid='ignore'):
+            months_to_target = np.where(enrolled >= targets, 0, np.ceil((targets - enrolled) / rate))
+        reachable = np.isfinite(months_to_target) & ~np.isnan(targets)
+        target_months = np.full(len(labels), np.datetime64('NaT'), dtype='datetime64[ns]')
+        target_months[reachable] = get_months_from_ordinals(last_ordinal + months_to_target[reachable].astype('int64'))
+
+        summary = labels.copy()
+        summary['method'] = method
+        summary['type'] = FORECAST_METHODS[method]
+        summary['Enrolled'] = enrolled
+        summary['Target'] = targets
+        summary['Monthly rate'] = rate.round(1)
+        summary['Target month'] = target_months
+        summaries.append(summary)
+
+    return {'projections': pd.concat(projections, ignore_index=True), 'summary': pd.concat(summaries, ignore_index=True)}
+
+# ----------------------------------------------------------------------------
+# REPORT DATA
+# ----------------------------------------------------------------------------
+
+@instrument_stage('get_report_data', rows_in_arg='enrolled')
+def get_report_data(enrolled, screening_sites, enrollment_expectations_df = None, mcc_list = None, base_rollup = None):
+    '''Run the processing pipeline on the enrolled dataframe and return a dictionary with every dataframe the page
+    needs, so the result can be cached and shared instead of rebuilt for each page load. site_enrollments holds the
+    site enrollments table of each MCC in mcc_list (default: every MCC with enrolled subjects). A base rollup already
+    brought up to date with update_base_rollup can be passed in, so the enrolled rows are not grouped again; the rest
+    of the report is derived from the base rollup, whose size depends on the number of sites and months rather than
+    subjects.'''
+    if enrollment_expectations_df is None:
+        enrollment_expectations_df = get_enrollment_expectations()
+    if mcc_list is None:
+        mcc_list = sorted(enrolled['mcc'].unique())
+
+    # All rollups are derived from a single pass over the enrolled rows, for all MCCs at once, so each added MCC
+    # adds rows to the same passes rather than passes of its own
+    if base_rollup is None:
+        base_rollup = get_base_rollup(enrolled)
+    enrollment_count = enrollment_rollup(base_rollup, 'obtain_month', BASE_ROLLUP_COLS, 'Monthly', count_col='Monthly', full_months=True)
+    mcc_counts = dict(list(enrollment_count.groupby('mcc', sort=False)))
+    site_enrollments = {mcc: get_site_enrollments(mcc_counts[mcc], mcc).reset_index() for mcc in mcc_list if mcc in mcc_counts}
+    monthly_expectations = get_enrollment_expectations_monthly(enrollment_expectations_df)
+    site_expectations = get_site_expectations_monthly(screening_sites)
+    summary_rollup = rollup_enrollment_expectations(base_rollup, enrollment_expectations_df, monthly_expectations, count_col='Monthly')
+    expected_plot_df = get_plot_date(base_rollup, summary_rollup, count_col='Monthly')
+    summary_options_list = [(x, y) for x in summary_rollup.mcc.unique() for y in summary_rollup.surgery_type.unique()]
+    enrollment_cube = get_enrollment_cube(base_rollup)
+    enrollment_forecast = get_enrollment_forecast(enrollment_cube, site_expectations)
+    site_performance = get_site_performance(enrollment_cube, screening_sites)
+
+    report_data = {
+        'enrolled': enrolled,
+        'base_rollup': base_rollup,
+        'enrollment_count': enrollment_count,
+        'site_enrollments': site_enrollments,
+        'site_expectations': site_expectations,
+        'summary_rollup': summary_rollup,
+        'expected_plot_df': expected_plot_df,
+        'summary_options_list': summary_options_list,
+        'enrollment_cube': enrollment_cube,
+        'enrollment_forecast': enrollment_forecast,
+        'site_performance': site_performance,
+    }
+    return report_data
@@ -0,0 +1,72 @@
+# Libraries
+import traceback
+
+# File Management
+import os # Operating system library
+import hashlib
+import threading
+
+import pandas as pd # Dataframe manipulations
+
+# ----------------------------------------------------------------------------
+# DISPLAY TERMS REGISTRY
+# ----------------------------------------------------------------------------
+# The display terms file explains how to translate data columns and controlled terms into the English language
+# terms displayed to the user. It is compiled once per process into plain dictionaries, so any report using the
+# same terms file can translate a column with a single Series.map.
+
+# Compiled registries by file path
+_registries = {}
+_registries_lock = threading.Lock()
+
+def compile_display_maps(display_terms):
+    '''Compile display terms rows into a dictionary by api_field of {api_value: display_text}. As with
+    get_display_dictionary, the api values of a field are numeric if they all parse as numbers, and numeric keys
+    match both integer and float columns.'''
+    display_maps = {}
+    for field, term_df in display_terms.groupby('api_field', sort=False):
+        api_values = pd.to_numeric(term_df['api_value'], errors='ignore')
+        display_maps[field] = dict(zip(api_values, term_df['display_text']))
+    return display_maps
+
+def compile_display_terms(display_terms_filepath):
+    '''Read and compile a display terms file into a registry dictionary with the one-to-one (multi == 0) and
+    one-to-many (multi == 1) field mappings'''
+    with open(display_terms_filepath, 'rb') as f:
+        version = hashlib.md5(f.read()).hexdigest()
+    display_terms = pd.read_csv(display_terms_filepath)
+    registry = {
+        'filepath': str(display_terms_filepath),
+        'mtime': os.stat(display_terms_filepath).st_mtime_ns,
+        'version': version,
+        'display_terms': display_terms,
+        'uni': compile_display_maps(display_terms[display_terms.multi == 0]),
+        'multi': compile_display_maps(display_terms[display_terms.multi == 1]),
+    }
+    return registry
+
+def get_display_terms_registry(ASSETS_PATH, display_terms_file):
+    '''Return the compiled display terms registry for the file, compiling it on first use in the process and again
+    only if the file's modification time changes'''
+    display_terms_filepath = os.path.join(ASSETS_PATH, display_terms_file) if ASSETS_PATH else display_terms_file
+    try:
+        mtime = os.stat(display_terms_filepath).st_mtime_ns
+        registry = _registries.get(display_terms_filepath)
+        if registry is None or registry['mtime'] != mtime:
+            with _registries_lock:
+                registry = _registries.get(display_terms_filepath)
+                if registry is None or registry['mtime'] != mtime:
+                    registry = compile_display_terms(display_terms_filepath)
+                    _registries[display_terms_filepath] = registry
+        return registry
+    except Exception as e:
+        traceback.print_exc()
+        return None
+
+# ----------------------------------------------------------------------------
+# TRANSLATION
+# ----------------------------------------------------------------------------
+
+def translate_column(values, display_map):
+    '''Translate a column of database values with a one-to-one display map. Unmapped values become NaN.'''
+    return values.map(display_map)
@@ -0,0 +1,239 @@
+# Libraries
+import traceback
+
+# File Management
+import os # Operating system library
+import json
+import uuid
+import hashlib
+
+import numpy as np
+import pandas as pd # Dataframe manipulations
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather # columnar on-disk format for the enrolled store
+except ImportError:
+    feather = None
+
+# import local modules
+from config_settings import *
+from data_processing import *
+
+# ----------------------------------------------------------------------------
+# ENROLLED STORE SETTINGS
+# ----------------------------------------------------------------------------
+
+# Increment when the layout of the stored dataframe changes so existing stores are rebuilt
+ENROLLED_STORE_FORMAT = 2
+
+# The store is rewritten as a single segment when an update would leave it with more segments than this, or with
+# more removed rows than this fraction of its rows
+ENROLLED_STORE_MAX_SEGMENTS = 24
+ENROLLED_STORE_MAX_REMOVED = 0.1
+
+# ----------------------------------------------------------------------------
+# ENROLLED STORE FILES
+# ----------------------------------------------------------------------------
+# The store is a directory of feather segments and a manifest. Each update appends a segment with the rows it added
+# and records the source hashes of the rows it removed, which hide those rows in the earlier segments, so writing an
+# update costs in proportion to the changed records rather than to all enrolled subjects. Segments are named by the
+# generation that wrote them and the manifest is replaced atomically, so the store is never read half written.
+
+def get_enrolled_store_key(screening_sites, display_terms_dict, display_terms_dict_multi):
+    '''Hash of everything other than the subjects data that the cleaned rows depend on. A store written with a
+    different key is discarded and rebuilt from scratch.'''
+    key_hash = hashlib.md5(str(ENROLLED_STORE_FORMAT).encode())
+    key_hash.update(pd.util.hash_pandas_object(screening_sites, index=False).values.tobytes())
+    for display_maps in [get_display_maps(display_terms_dict), get_display_maps(display_terms_dict_multi)]:
+        for field in sorted(display_maps):
+            key_hash.update(field.encode())
+            key_hash.update(repr(sorted(display_maps[field].items(), key=str)).encode())
+    return key_hash.hexdigest()
+
+def get_source_hashes(subjects_raw):
+    '''Hash of the raw fields each enrolled row is cleaned from, one per row of subjects_raw. This is the only work
+    of an update done for every record rather than for the changed ones.'''
+    source_hashes = np.zeros(len(subjects_raw), dtype=np.uint64)
+    for col in ENROLLED_SOURCE_COLS:
+        # Record ids are unique, so they are hashed as they are; the other fields repeat a few values, which are
+        # hashed once each
+        col_hashes = pd.util.hash_array(subjects_raw[col].values, categorize=col not in ['index', 'main_record_id'])
+        source_hashes = source_hashes * np.uint64(1000003) ^ col_hashes
+    return source_hashes
+
+def get_store_manifest_filepath(store_path):
+    return os.path.join(store_path, 'manifest.json')
+
+def read_store_manifest(store_path):
+    '''Return the manifest of the store, or an empty dictionary if there is none'''
+    try:
+        with open(get_store_manifest_filepath(store_path)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def load_enrolled_store(store_key, store_path = ENROLLED_STORE_PATH):
+    '''Read the stored enrolled dataframe into this process, in the compact layout of compact_enrolled. Returns the
+    dataframe, the hashes of raw records that were cleaned but produced no enrolled row (e.g. record ids outside
+    every screening site range) and the generation id of the write, or (None, None, None) if there is no store, it
+    cannot be read, or it was written for a different store_key.'''
+    manifest = read_store_manifest(store_path)
+    if feather is None or manifest.get('store_key') != store_key:
+        return None, None, None
+    try:
+        segments = manifest['segments']
+        # Every segment is written with the same schema (see save_enrolled_store), so they are read as one table
+        tables = [feather.read_table(os.path.join(store_path, segment['file'])) for segment in segments]
+        enrolled = compact_enrolled(pa.concat_tables(tables).to_pandas())
+
+        removed_hashes = [np.array(segment['removed_hashes'], dtype=np.uint64) for segment in segments]
+        if sum(len(hashes) for hashes in removed_hashes):
+            # A row is hidden by the removed hashes of any later segment
+            row_segments = np.repeat(np.arange(len(segments)), [table.num_rows for table in tables])
+            removed_by = pd.Series(np.concatenate([np.full(len(hashes), position) for position, hashes in enumerate(removed_hashes)]),
+                                   index=np.concatenate(removed_hashes)).groupby(level=0).max()
+            removed_rows = removed_by.index.get_indexer(enrolled['source_hash'].values)
+            hidden = (removed_rows >= 0) & (row_segments < removed_by.values[removed_rows])
+            enrolled = enrolled[~hidden].reset_index(drop=True)
+            for col in ENROLLED_CATEGORY_COLS:
+                if col in enrolled.columns:
+                    enrolled[col] = remove_unused_categories(enrolled[col])
+
+        excluded_hashes = np.array(manifest.get('excluded_hashes', []), dtype=np.uint64)
+        return enrolled, excluded_hashes, manifest.get('generation')
+    except Exception as e:
+        traceback.print_exc()
+        return None, None, None
+
+def save_enrolled_store(enrolled, excluded_hashes, store_key, store_path = ENROLLED_STORE_PATH, added = None, removed = None):
+    '''Write the enrolled dataframe to the store uncompressed, so loading it skips a decompression pass. If the added
+    rows (the last len(added) rows of enrolled) and removed rows of an update of the stored dataframe are given, only
+    they are written, as a new segment. The whole dataframe is written as a single segment otherwise, and when the
+    store belongs to another store_key, the column types changed or the store has too many segments or removed rows.
+    Each write gets a new generation id, which is returned (None if the store was not written).'''
+    if feather is None:
+        return None
+    try:
+        generation = uuid.uuid4().hex
+        # Months are derived from obtain_date on load rather than stored
+        enrolled_columns = enrolled.drop(columns=['obtain_month'])
+        schema = pa.Schema.from_pandas(enrolled_columns, preserve_index=False)
+        schema_text = str(schema.remove_metadata())
+        manifest = read_store_manifest(store_path)
+        segments = manifest.get('segments', [])
+        removed_count = sum(len(segment['removed_hashes']) for segment in segments) + (len(removed) if removed is not None else 0)
+        if (added is None or removed is None or manifest.get('store_key') != store_key or manifest.get('schema') != schema_text
+                or len(segments) >= ENROLLED_STORE_MAX_SEGMENTS or removed_count > ENROLLED_STORE_MAX_REMOVED * len(enrolled)):
+            segments = []
+            segment_rows = enrolled_columns
+            removed_hashes = []
+        else:
+            segment_rows = enrolled_columns.iloc[len(enrolled) - len(added):]
+            removed_hashes = [int(h) for h in pd.unique(removed['source_hash'])]
+
+        os.makedirs(store_path, exist_ok=True)
+        segment_file = generation + '.feather'
+        table = pa.Table.from_pandas(segment_rows, schema=schema, preserve_index=False)
+        feather.write_feather(table, os.path.join(store_path, segment_file), compression='uncompressed')
+        segments = segments + [{'file': segment_file, 'removed_hashes': removed_hashes}]
+
+        manifest = {'store_key': store_key, 'generation': generation, 'schema': schema_text, 'segments': segments,
+                    'excluded_hashes': [int(h) for h in excluded_hashes]}
+        tmp_path = get_store_manifest_filepath(store_path) + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, get_store_manifest_filepath(store_path))
+
+        # Segments no longer in the manifest were replaced by a rewrite of the whole store
+        segment_files = [segment['file'] for segment in segments]
+        for filename in os.listdir(store_path):
+            if filename.endswith('.feather') and filename not in segment_files:
+                os.remove(os.path.join(store_path, filename))
+        return generation
+    except Exception as e:
+        traceback.print_exc()
+        return None
+
+def remove_unused_categories(column):
+    '''Drop the categories no row of a categorical column uses. Counting the codes is much cheaper than the unique
+    of Series.cat.remove_unused_categories, and the column is only recoded if some category is unused.'''
+    codes = column.cat.codes.values
+    used = np.bincount(codes[codes >= 0], minlength=len(column.cat.categories)) > 0
+    if used.all():
+        return column
+    return column.cat.remove_categories(column.cat.categories[~used])
+
+def concat_enrolled(frames):
+    '''Concatenate enrolled dataframes in the compact layout. Category columns are combined on the sorted union of
+    their categories, without converting them back to strings, and keep only the categories in use.'''
+    columns = {}
+    for col in frames[0].columns:
+        if col in ENROLLED_CATEGORY_COLS:
+            categories = sorted(set().union(*[frame[col].cat.categories for frame in frames]))
+            columns[col] = remove_unused_categories(pd.concat([frame[col].cat.set_categories(categories) for frame in frames], ignore_index=True))
+        else:
+            columns[col] = pd.concat([frame[col] for frame in frames], ignore_index=True)
+    return pd.DataFrame(columns)
+
+# ----------------------------------------------------------------------------
+# INCREMENTAL UPDATE
+# ----------------------------------------------------------------------------
+
+@instrument_stage('get_enrolled_delta', rows_in_arg='subjects_json')
+def get_enrolled_delta(subjects_json, screening_sites, display_terms_dict, display_terms_dict_multi, store_path = ENROLLED_STORE_PATH):
+    '''Diff subjects_json against the stored enrolled dataframe by the hash of each record's raw fields, cleaning
+    only records that are new or changed. Rows whose hash no longer appears in the subjects data (changed records,
+    and records withdrawn by an ewdateterm) are dropped. The added rows and the hashes of the removed rows are then
+    appended to the store.
+
+    Returns a dictionary with the new 'enrolled' dataframe, the 'added' and 'removed' enrolled rows, and the
+    'previous_generation' and 'generation' ids of the store before and after, or None on error. 'rebuilt' is True
+    when there was no usable store (first run, or screening sites or display terms changed), in which case every
+    row is cleaned again and the delta is not meaningful.'''
+    try:
+        subjects_raw = combine_mcc_json(subjects_json)
+        subjects_raw.reset_index(drop=True, inplace=True)
+        candidates = subjects_raw[(subjects_raw.obtain_date != 'N/A') & (subjects_raw.ewdateterm == 'N/A')].copy()
+        candidates['source_hash'] = get_source_hashes(candidates)
+
+        store_key = get_enrolled_store_key(screening_sites, display_terms_dict, display_terms_dict_multi)
+        stored, excluded_hashes, previous_generation = load_enrolled_store(store_key, store_path)
+        delta = {'rebuilt': stored is None, 'previous_generation': previous_generation}
+        if stored is None:
+            enrolled = clean_enrolled(candidates, screening_sites, display_terms_dict, display_terms_dict_multi, extra_cols=['source_hash'])
+            excluded_hashes = candidates.source_hash[~candidates.source_hash.isin(enrolled.source_hash)].values
+            delta.update({'enrolled': enrolled, 'added': enrolled, 'removed': enrolled.iloc[:0],
+                          'generation': save_enrolled_store(enrolled, excluded_hashes, store_key, store_path)})
+            return delta
+
+        # Only the hashes are compared over every record; the cleaning and the writes are of the changed ones
+        keep = stored.source_hash.isin(candidates.source_hash).values
+        removed = stored[~keep]
+        excluded_hashes = excluded_hashes[np.isin(excluded_hashes, candidates.source_hash)]
+        changed = candidates[~candidates.source_hash.isin(stored.source_hash) & ~candidates.source_hash.isin(excluded_hashes)]
+        if len(changed) == 0 and len(removed) == 0:
+            delta.update({'enrolled': stored, 'added': stored.iloc[:0], 'removed': removed,
+                          'generation': previous_generation})
+            return delta
+
+        if len(changed) > 0:
+            added = clean_enrolled(changed, screening_sites, display_terms_dict, display_terms_dict_multi, extra_cols=['source_hash'])
+            changed_excluded = changed.source_hash[~changed.source_hash.isin(added.source_hash)].values
+            excluded_hashes = np.concatenate([excluded_hashes, changed_excluded])
+        else:
+            added = stored.iloc[:0]
+        enrolled = concat_enrolled([stored[keep] if len(removed) else stored, added])
+
+        delta.update({'enrolled': enrolled, 'added': added, 'removed': removed,
+                      'generation': save_enrolled_store(enrolled, excluded_hashes, store_key, store_path, added, removed)})
+        return delta
+
+    except Exception as e:
+        traceback.print_exc()
+        return None
+
+def get_enrolled_incremental(subjects_json, screening_sites, display_terms_dict, display_terms_dict_multi, store_path = ENROLLED_STORE_PATH):
+    '''Return the enrolled dataframe for subjects_json, cleaning only records that are new or changed since the
+    stored dataframe was written (see get_enrolled_delta)'''
+    delta = get_enrolled_delta(subjects_json, screening_sites, display_terms_dict, display_terms_dict_multi, store_path)
+    return delta['enrolled'] if delta is not None else None
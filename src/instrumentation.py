@@ -0,0 +1,241 @@
+# Libraries
+import traceback
+
+# File Management
+import os # Operating system library
+import sys
+import glob
+import json
+import time
+import logging
+import resource
+import tracemalloc
+import threading
+import functools
+import inspect
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd # Dataframe manipulations
+
+# import local modules
+from config_settings import *
+
+# ----------------------------------------------------------------------------
+# STAGE RECORDS
+# ----------------------------------------------------------------------------
+# Each pipeline stage records its wall time, rows in and out and the process peak memory. Every record is logged as
+# a json line, and the totals of each process are written to METRICS_PATH so the metrics endpoint of any gunicorn
+# worker can report the stages run by all of them (the snapshot is usually built by another worker's refresher).
+
+stage_logger = logging.getLogger('enrollment_report.stages')
+if STAGE_LOGGING and not stage_logger.handlers:
+    _stage_log_handler = logging.StreamHandler()
+    _stage_log_handler.setFormatter(logging.Formatter('%(message)s'))
+    stage_logger.addHandler(_stage_log_handler)
+    stage_logger.setLevel(logging.INFO)
+    stage_logger.propagate = False
+
+if STAGE_TRACEMALLOC and not tracemalloc.is_tracing():
+    tracemalloc.start()
+
+# Stage totals of this process by (stage, labels)
+_stage_totals = {}
+_stage_totals_lock = threading.Lock()
+# Nesting depth of the running stages in each thread; totals are written to disk when a top level stage finishes
+_stage_depth = threading.local()
+
+def get_row_count(value):
+    '''Rows in a stage input or output: the length of a dataframe, series or list, the total length of the
+    dataframes and dictionaries in a dictionary (e.g. the subjects json by MCC) and the rows of the first item of a
+    tuple. None for anything else.'''
+    if isinstance(value, (pd.DataFrame, pd.Series, list)):
+        return len(value)
+    if isinstance(value, tuple) and value:
+        return get_row_count(value[0])
+    if isinstance(value, dict):
+        counts = [len(v) for v in value.values() if isinstance(v, (pd.DataFrame, dict))]
+        return sum(counts) if counts else None
+    return None
+
+def get_peak_rss_bytes():
+    '''Peak resident memory of this process. ru_maxrss is in kilobytes on Linux and bytes on macOS.'''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+@contextmanager
+def record_stage(stage, rows_in = None, **labels):
+    '''Time the enclosed block as a pipeline stage. Yields the stage record, so the block can set 'rows_out'. When
+    tracemalloc is tracing, the peak python memory allocated during the stage is recorded too.'''
+    stage_record = {'stage': stage, 'labels': {k: str(v) for k, v in labels.items()}, 'rows_in': rows_in, 'rows_out': None}
+    depth = getattr(_stage_depth, 'depth', 0)
+    _stage_depth.depth = depth + 1
+    traced = tracemalloc.is_tracing() and hasattr(tracemalloc, 'reset_peak')
+    if traced:
+        traced_start = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+    start = time.perf_counter()
+    try:
+        yield stage_record
+    finally:
+        stage_record['seconds'] = time.perf_counter() - start
+        stage_record['peak_rss_bytes'] = get_peak_rss_bytes()
+        if traced:
+            stage_record['peak_traced_bytes'] = tracemalloc.get_traced_memory()[1] - traced_start
+        _stage_depth.depth = depth
+        finish_stage(stage_record, write_totals = depth == 0)
+
+def instrument_stage(stage, rows_in_arg = None, rows_out = True):
+    '''Decorator recording each call of a function as a stage. rows_in_arg names the argument whose rows are the
+    stage input; with rows_out, the rows of the return value are the stage output.'''
+    def decorator(func):
+        signature = inspect.signature(func)
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            rows_in = None
+            if rows_in_arg:
+                rows_in = get_row_count(signature.bind_partial(*args, **kwargs).arguments.get(rows_in_arg))
+            with record_stage(stage, rows_in) as stage_record:
+                result = func(*args, **kwargs)
+                if rows_out:
+                    stage_record['rows_out'] = get_row_count(result)
+            return result
+        return wrapper
+    return decorator
+
+def finish_stage(stage_record, write_totals = True):
+    stage_record['time'] = time.time()
+    if STAGE_LOGGING:
+        stage_logger.info(json.dumps(dict(stage_record, event='stage', pid=os.getpid()), default=str))
+
+    key = (stage_record['stage'], tuple(sorted(stage_record['labels'].items())))
+    with _stage_totals_lock:
+        totals = _stage_totals.setdefault(key, {'stage': stage_record['stage'], 'labels': stage_record['labels'],
+                                                'count': 0, 'seconds': 0.0, 'peak_rss_bytes': 0})
+        totals['count'] += 1
+        totals['seconds'] += stage_record['seconds']
+        totals['peak_rss_bytes'] = max(totals['peak_rss_bytes'], stage_record['peak_rss_bytes'])
+        totals['last'] = {k: stage_record.get(k) for k in ['time', 'seconds', 'rows_in', 'rows_out', 'peak_traced_bytes']}
+    if write_totals:
+        write_stage_totals()
+
+# ----------------------------------------------------------------------------
+# DATAFRAME MEMORY
+# ----------------------------------------------------------------------------
+
+def get_memory_bytes(value):
+    '''Memory held by a dataframe, series or array, including the python objects of object columns, or the total
+    of those in a dictionary (e.g. the site enrollments by MCC). 0 for anything else.'''
+    if isinstance(value, np.ndarray):
+        return int(value.nbytes)
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(index=True, deep=True))
+    if isinstance(value, dict):
+        return sum(get_memory_bytes(v) for v in value.values())
+    return 0
+
+def get_frame_memory(frames):
+    '''Memory of each dataframe (or dictionary of dataframes) in the dictionary frames, by key'''
+    return {str(name): get_memory_bytes(value) for name, value in frames.items() if get_memory_bytes(value)}
+
+# ----------------------------------------------------------------------------
+# STAGE TOTALS SHARED BETWEEN PROCESSES
+# ----------------------------------------------------------------------------
+
+def write_stage_totals(metrics_path = METRICS_PATH):
+    '''Publish this process's stage totals to METRICS_PATH/stages-<pid>.json'''
+    try:
+        os.makedirs(metrics_path, exist_ok=True)
+        with _stage_totals_lock:
+            totals = json.dumps(list(_stage_totals.values()))
+        totals_filepath = os.path.join(metrics_path, 'stages-' + str(os.getpid()) + '.json')
+        tmp_filepath = totals_filepath + '.' + str(threading.get_ident()) + '.tmp'
+        with open(tmp_filepath, 'w') as f:
+            f.write(totals)
+        os.replace(tmp_filepath, totals_filepath)
+    except Exception as e:
+        traceback.print_exc()
+
+def pid_is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def read_stage_totals(metrics_path = METRICS_PATH):
+    '''Combine the stage totals published by every running process: counts and seconds are summed, peak memory is
+    the highest and the last run is the most recent one. Files of processes that have exited are removed.'''
+    combined = {}
+    for totals_filepath in glob.glob(os.path.join(metrics_path, 'stages-*.json')):
+        try:
+            pid = int(os.path.basename(totals_filepath)[len('stages-'):-len('.json')])
+            if not pid_is_running(pid):
+                os.remove(totals_filepath)
+                continue
+            with open(totals_filepath) as f:
+                process_totals = json.load(f)
+        except Exception as e:
+            continue
+        for totals in process_totals:
+            key = (totals['stage'], tuple(sorted(totals['labels'].items())))
+            if key not in combined:
+                combined[key] = dict(totals)
+                continue
+            stage_totals = combined[key]
+            stage_totals['count'] += totals['count']
+            stage_totals['seconds'] += totals['seconds']
+            stage_totals['peak_rss_bytes'] = max(stage_totals['peak_rss_bytes'], totals['peak_rss_bytes'])
+            if totals['last']['time'] > stage_totals['last']['time']:
+                stage_totals['last'] = totals['last']
+    return [combined[key] for key in sorted(combined)]
+
+# ----------------------------------------------------------------------------
+# PROMETHEUS TEXT FORMAT
+# ----------------------------------------------------------------------------
+metrics_prefix = 'enrollment_report_stage_'
+
+# name, type, help and the function returning the value from a stage's totals
+stage_metrics = [
+    ('calls_total', 'counter', 'Number of times the stage ran', lambda t: t['count']),
+    ('seconds_total', 'counter', 'Total wall time of the stage in seconds', lambda t: t['seconds']),
+    ('last_seconds', 'gauge', 'Wall time of the last run of the stage in seconds', lambda t: t['last']['seconds']),
+    ('last_rows_in', 'gauge', 'Rows into the last run of the stage', lambda t: t['last']['rows_in']),
+    ('last_rows_out', 'gauge', 'Rows out of the last run of the stage', lambda t: t['last']['rows_out']),
+    ('last_traced_peak_bytes', 'gauge', 'Peak python memory allocated in the last run of the stage (tracemalloc only)',
+        lambda t: t['last'].get('peak_traced_bytes')),
+    ('peak_rss_bytes', 'gauge', 'Highest process peak resident memory seen at the end of the stage', lambda t: t['peak_rss_bytes']),
+]
+
+def format_metric_labels(labels):
+    label_text = ','.join(k + '="' + str(v).replace('\\', '\\\\').replace('"', '\\"') + '"' for k, v in labels)
+    return '{' + label_text + '}'
+
+def get_frame_memory_metrics_text(frame_memory, **labels):
+    '''Render the memory of each dataframe from get_frame_memory as a Prometheus gauge'''
+    name = 'enrollment_report_frame_bytes'
+    lines = ['# HELP ' + name + ' Memory held by each dataframe of the report data loaded in this worker',
+             '# TYPE ' + name + ' gauge']
+    for frame, frame_bytes in sorted(frame_memory.items()):
+        frame_labels = [('frame', frame)] + sorted((k, str(v)) for k, v in labels.items())
+        lines.append(name + format_metric_labels(frame_labels) + ' ' + repr(float(frame_bytes)))
+    return '\n'.join(lines) + '\n'
+
+def get_stage_metrics_text(metrics_path = METRICS_PATH):
+    '''Render the combined stage totals in the Prometheus text exposition format'''
+    stage_totals = read_stage_totals(metrics_path)
+    lines = []
+    for name, metric_type, help_text, get_value in stage_metrics:
+        lines.append('# HELP ' + metrics_prefix + name + ' ' + help_text)
+        lines.append('# TYPE ' + metrics_prefix + name + ' ' + metric_type)
+        for totals in stage_totals:
+            value = get_value(totals)
+            if value is None:
+                continue
+            labels = [('stage', totals['stage'])] + sorted(totals['labels'].items())
+            lines.append(metrics_prefix + name + format_metric_labels(labels) + ' ' + repr(float(value)))
+    return '\n'.join(lines) + '\n'
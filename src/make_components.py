@@ -1,7 +1,9 @@
 # Libraries
 # Data
 import pandas as pd # Dataframe manipulations
+import numpy as np
 import math
+import base64
 
 # Dash Framework
 import dash_bootstrap_components as dbc
@@ -16,3 +18,178 @@ from styling import *
 # ----------------------------------------------------------------------------
 # CUSTOM FUNCTIONS FOR DASH UI COMPONENTS
 # ----------------------------------------------------------------------------
+
+# ----------------------------------------------------------------------------
+# SERVER-SIDE DATATABLE PAGING, SORTING AND FILTERING
+# ----------------------------------------------------------------------------
+# DataTables with page_action, sort_action and filter_action set to 'custom' send their page, sort_by and
+# filter_query to a callback, which answers with just the visible page of the full dataframe.
+
+# DataTable filter operators, in the order they are matched, and their names
+filter_operators = [['ge ', '>='],
+                    ['le ', '<='],
+                    ['lt ', '<'],
+                    ['gt ', '>'],
+                    ['ne ', '!='],
+                    ['eq ', '='],
+                    ['contains '],
+                    ['datestartswith ']]
+
+def split_filter_part(filter_part):
+    '''Split one clause of a DataTable filter_query (e.g. '{Year} >= 2022') into the column id, operator name and
+    value. Quoted values are returned as strings, unquoted values as numbers where they parse as numbers.'''
+    for operator_type in filter_operators:
+        for operator in operator_type:
+            if operator in filter_part:
+                name_part, value_part = filter_part.split(operator, 1)
+                name = name_part[name_part.find('{') + 1: name_part.rfind('}')]
+
+                value_part = value_part.strip()
+                v0 = value_part[0] if value_part else ''
+                if v0 and v0 == value_part[-1] and v0 in ("'", '"', '`'):
+                    value = value_part[1: -1].replace('\\' + v0, v0)
+                else:
+                    try:
+                        value = float(value_part)
+                    except ValueError:
+                        value = value_part
+
+                # word operators need spaces after them in the filter string, but we don't want these later
+                return name, operator_type[0].strip(), value
+
+    return [None] * 3
+
+# Text that stands for a missing value in table cells, after any percent sign is removed
+missing_cell_text = ['', 'nan', 'None', 'N/A']
+
+def get_numeric_values(col):
+    '''Return the numbers of a table column. Text cells are parsed without thousands separators or a trailing percent
+    sign ('1,200', '20.5%'); cells that are not numbers are NaN.'''
+    if pd.api.types.is_numeric_dtype(col):
+        return col
+    text = col.astype(str).str.strip().str.rstrip('%').str.replace(',', '', regex=False)
+    return pd.to_numeric(text, errors='coerce')
+
+def get_sort_values(col):
+    '''Sort key of a table column: the numbers of text columns that only hold numbers and missing values, such as
+    percents ('100%' after '20%'), and the column itself otherwise'''
+    if pd.api.types.is_numeric_dtype(col):
+        return col
+    numeric = get_numeric_values(col)
+    missing = col.isna() | col.astype(str).str.strip().str.rstrip('%').isin(missing_cell_text)
+    if numeric.notna().any() and (numeric.notna() | missing).all():
+        return numeric
+    return col
+
+def filter_table_frame(df, filter_query):
+    '''Apply a DataTable filter_query to a dataframe as one vectorized boolean mask per clause. Numeric filter values
+    are compared with the numbers of the column (see get_numeric_values), so '{Date_Year} = 2022' matches the text
+    '2022'; text filter values are compared with the column as text.'''
+    if not filter_query:
+        return df
+    mask = pd.Series(True, index=df.index)
+    for filter_part in filter_query.split(' && '):
+        col_name, operator, filter_value = split_filter_part(filter_part)
+        if col_name not in df.columns:
+            continue
+        col = df[col_name]
+        if isinstance(filter_value, float) and filter_value.is_integer():
+            filter_text = str(int(filter_value))
+        else:
+            filter_text = str(filter_value)
+        try:
+            if operator in ('eq', 'ne', 'lt', 'le', 'gt', 'ge'):
+                # these operators match pandas series operator method names
+                if isinstance(filter_value, float):
+                    col = get_numeric_values(col)
+                elif not pd.api.types.is_numeric_dtype(col):
+                    col = col.astype(str)
+                mask &= getattr(col, operator)(filter_value).fillna(False)
+            elif operator == 'contains':
+                mask &= col.astype(str).str.contains(filter_text, regex=False)
+            elif operator == 'datestartswith':
+                mask &= col.astype(str).str.startswith(filter_text)
+        except TypeError:
+            # e.g. comparing a number column with text
+            mask &= False
+    return df[mask]
+
+def sort_table_frame(df, sort_by):
+    '''Apply a DataTable sort_by list to a dataframe, sorting text columns of numbers by value (see get_sort_values)'''
+    sort_by = [s for s in (sort_by or []) if s['column_id'] in df.columns]
+    if not sort_by:
+        return df
+    return df.sort_values([s['column_id'] for s in sort_by],
+                          ascending=[s['direction'] == 'asc' for s in sort_by],
+                          kind='stable', na_position='last', key=get_sort_values)
+
+def get_table_page(df, page_current, page_size, sort_by = None, filter_query = None):
+    '''Filter and sort a dataframe as the DataTable requests and return the records of the current page along with
+    the total page count'''
+    df = sort_table_frame(filter_table_frame(df, filter_query), sort_by)
+    page_count = max(math.ceil(len(df) / page_size), 1)
+    page_current = min(page_current or 0, page_count - 1)
+    page_df = df.iloc[page_current * page_size: (page_current + 1) * page_size]
+    return page_df.to_dict('records'), page_count
+
+# ----------------------------------------------------------------------------
+# FIGURES
+# ----------------------------------------------------------------------------
+# Figures are built as plain dictionaries rather than through plotly express: they are built once per snapshot and
+# the dictionary only carries what the graph needs, instead of the full default template.
+
+# Trace colors and styling of the default plotly template
+figure_colorway = px.colors.qualitative.Plotly
+figure_axis_style = {'gridcolor': 'white', 'linecolor': 'white', 'zerolinecolor': 'white', 'automargin': True}
+figure_layout_style = {
+    'paper_bgcolor': 'white',
+    'plot_bgcolor': '#E5ECF6',
+    'font': {'color': '#2a3f5f'},
+    'hovermode': 'closest',
+    'title': {'x': 0.05},
+}
+
+def encode_typed_array(values):
+    '''Encode a numeric column as a plotly.js typed array spec ({'dtype', 'bdata'}), which is decoded without
+    parsing one JSON number per point. Integer columns are sent as 32 bit integers.'''
+    values = np.asarray(values)
+    if np.issubdtype(values.dtype, np.integer) and values.size and np.abs(values).max() < 2**31:
+        values = values.astype('<i4')
+        dtype = 'i4'
+    else:
+        values = values.astype('<f8')
+        dtype = 'f8'
+    return {'dtype': dtype, 'bdata': base64.b64encode(values.tobytes()).decode('ascii')}
+
+def build_line_figure(df, x, y, color, title, typed_arrays = False):
+    '''Return a figure dictionary with one line per value of the color column, equivalent to
+    px.line(df, x=x, y=y, color=color, title=title). Datetime x values are sent as dates. With typed_arrays the y
+    values are sent as typed arrays, which requires plotly.js 2.28 or later.'''
+    series = [(name, trace_df[x], trace_df[y].values) for name, trace_df in df.groupby(color, sort=False)]
+    return build_series_figure(series, x, y, color, title, typed_arrays)
+
+def build_series_figure(series, x, y, color, title, typed_arrays = False):
+    '''Return a figure dictionary styled as build_line_figure with one line per (name, x values, y values) in
+    series, for lines that are already separate arrays. x and y are the axis titles and color the legend title.'''
+    traces = []
+    for i, (name, x_values, y_values) in enumerate(series):
+        x_values = pd.Series(x_values)
+        if pd.api.types.is_datetime64_any_dtype(x_values):
+            x_values = x_values.dt.strftime('%Y-%m-%d')
+        y_values = np.asarray(y_values)
+        traces.append({
+            'type': 'scatter',
+            'mode': 'lines',
+            'name': str(name),
+            'legendgroup': str(name),
+            'line': {'color': figure_colorway[i % len(figure_colorway)]},
+            'hovertemplate': color + '=' + str(name) + '<br>' + x + '=%{x}<br>' + y + '=%{y}<extra></extra>',
+            'x': x_values.tolist(),
+            'y': encode_typed_array(y_values) if typed_arrays else y_values.tolist(),
+        })
+    layout = dict(figure_layout_style,
+                  title=dict(figure_layout_style['title'], text=title),
+                  xaxis=dict(figure_axis_style, title={'text': x}),
+                  yaxis=dict(figure_axis_style, title={'text': y}),
+                  legend={'title': {'text': color}, 'tracegroupgap': 0})
+    return {'data': traces, 'layout': layout}
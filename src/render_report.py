@@ -0,0 +1,59 @@
+'''Render the current enrollment report to static files, for consumers that only need the latest report (the TACC
+iframe, emailed monthly summaries) and should not run the dash pipeline on each view.
+
+The report is taken from the snapshot store shared with the app: the pipeline runs at most once, only if the
+published snapshot is older than --max-age seconds, and the new snapshot is published for the app as well. The
+layout, tab and figure JSON, table CSVs and a standalone html page are written to STATIC_REPORT_PATH, which the
+app serves at static-report/ with caching headers.
+
+    python render_report.py                       # render the published snapshot, refreshing it if stale
+    python render_report.py --max-age 0           # check the upstream data first
+    python render_report.py --include-plotlyjs inline --output /tmp/report    # self-contained page for email
+'''
+# Libraries
+import sys
+import argparse
+
+# import local modules
+from app import *
+
+def render_static_report(snapshot, report_dir, include_plotlyjs = 'directory'):
+    ''' Write the static artifacts of a snapshot to report_dir: the page layout, every tab rendered, the full rows of
+    the paged report tables and a standalone html page with every tab'''
+    tabs = [(value, label, get_tab_content(snapshot, value)) for value, label, builder in report_tabs]
+    table_frames = {get_file_id(table_id): table for table_id, table in get_report_tables(snapshot).items()}
+    page_meta = snapshot['page_meta']
+    header = [
+        html.H1('Enrollment Report'),
+        html.P('Data Source: ' + page_meta['data_source']),
+        html.P('Data Date: ' + page_meta['data_date']),
+        build_freshness_list(page_meta.get('mcc_status', {})),
+    ]
+    page_html = build_static_page('Enrollment Report', header, [(label, content) for value, label, content in tabs],
+                                  table_frames, external_stylesheets_list, include_plotlyjs)
+    manifest = {'version': snapshot['version'], 'data_source': page_meta['data_source'], 'data_date': page_meta['data_date'],
+                'rendered': datetime.now().isoformat(timespec='seconds')}
+    write_static_report(report_dir, build_page_layout(snapshot), tabs, table_frames, page_html, include_plotlyjs, manifest)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--max-age', type=int, default=SNAPSHOT_TTL, help='seconds a published snapshot is used without checking the upstream data')
+    parser.add_argument('--output', help='write to this directory instead of publishing to STATIC_REPORT_PATH')
+    parser.add_argument('--include-plotlyjs', choices=['directory', 'cdn', 'inline'], default='directory',
+                        help='load plotly.js from a file next to the page, from the plotly CDN or inline')
+    parser.add_argument('--force', action='store_true', help='render again even if this data version was rendered')
+    args = parser.parse_args()
+
+    snapshot = get_snapshot(snapshot_name, build_snapshot, ttl=args.max_age)
+    if not snapshot or not snapshot['report_data']:
+        sys.exit('No report data available')
+
+    if args.output:
+        render_static_report(snapshot, args.output, args.include_plotlyjs)
+        report_dir = args.output
+    else:
+        report_dir = publish_static_report(snapshot['version'], lambda tmp_dir: render_static_report(snapshot, tmp_dir, args.include_plotlyjs),
+                                           force=args.force)
+        if not report_dir:
+            sys.exit('The static report could not be written')
+    print('Static report of data version ' + snapshot['version'] + ' written to ' + str(report_dir))
@@ -0,0 +1,88 @@
+# Libraries
+import traceback
+
+# File Management
+import os # Operating system library
+import glob
+import fcntl # file locks shared between gunicorn workers
+
+import pandas as pd # Dataframe manipulations
+import xlsxwriter
+
+# import local modules
+from config_settings import *
+
+# ----------------------------------------------------------------------------
+# EXCEL WORKBOOK
+# ----------------------------------------------------------------------------
+
+def get_sheet_name(name):
+    '''Excel sheet names are at most 31 characters and cannot contain []:*?/\\'''
+    for char in '[]:*?/\\':
+        name = name.replace(char, ' ')
+    return name[:31]
+
+def write_report_workbook(sheets, filepath):
+    '''Write a workbook with one sheet per (sheet_name, table_columns, table_df) in sheets, where table_columns are
+    DataTable column definitions whose names are tuples for multi-level headers. The workbook is written in
+    constant_memory mode: rows go straight to disk in order, so memory does not grow with the number of rows.'''
+    workbook = xlsxwriter.Workbook(filepath, {'constant_memory': True})
+    header_format = workbook.add_format({'bold': True})
+    for sheet_name, table_columns, table_df in sheets:
+        worksheet = workbook.add_worksheet(get_sheet_name(sheet_name))
+        col_ids = [col['id'] for col in table_columns]
+        col_names = [col['name'] if isinstance(col['name'], (list, tuple)) else (col['name'],) for col in table_columns]
+
+        header_depth = max([len(name) for name in col_names] + [1])
+        for level in range(header_depth):
+            worksheet.write_row(level, 0, [name[level] if level < len(name) else '' for name in col_names], header_format)
+        worksheet.freeze_panes(header_depth, 0)
+
+        # Write python values, with blanks for missing values
+        values_df = table_df[col_ids].astype(object)
+        values_df = values_df.where(values_df.notna(), None)
+        for row_num, row in enumerate(values_df.itertuples(index=False, name=None), start=header_depth):
+            worksheet.write_row(row_num, 0, row)
+    workbook.close()
+
+# ----------------------------------------------------------------------------
+# EXPORT FILE STORE
+# ----------------------------------------------------------------------------
+
+def get_export_filepath(export_name, version, export_path = EXPORT_PATH):
+    return os.path.join(export_path, export_name + '-' + version + '.xlsx')
+
+def get_report_export(export_name, version, build_sheets, export_path = EXPORT_PATH):
+    '''Return the path of the workbook exported for this version, writing it first if it does not exist yet. The
+    version names both the data and the format of the report (the snapshot name), so an app release that changes the
+    sheets does not serve a workbook written by the previous release. build_sheets is only called when the workbook
+    is written and returns the sheets for write_report_workbook. Workers share the export directory, and an
+    exclusive lock makes sure each version is written once. Exports of older versions are removed. Returns None if
+    the workbook cannot be written.'''
+    export_filepath = get_export_filepath(export_name, version, export_path)
+    if os.path.exists(export_filepath):
+        return export_filepath
+
+    os.makedirs(export_path, exist_ok=True)
+    with open(os.path.join(export_path, export_name + '.lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        tmp_filepath = export_filepath + '.' + str(os.getpid()) + '.tmp'
+        try:
+            # Another worker may have written the workbook while this one waited on the lock
+            if os.path.exists(export_filepath):
+                return export_filepath
+
+            write_report_workbook(build_sheets(), tmp_filepath)
+            os.replace(tmp_filepath, export_filepath)
+
+            for old_filepath in glob.glob(os.path.join(export_path, export_name + '-*.xlsx')):
+                if old_filepath != export_filepath:
+                    os.remove(old_filepath)
+            return export_filepath
+        except Exception as e:
+            traceback.print_exc()
+            if os.path.exists(tmp_filepath):
+                os.remove(tmp_filepath)
+            return None
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
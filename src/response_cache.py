@@ -0,0 +1,50 @@
+# Libraries
+import hashlib
+import threading
+from collections import OrderedDict
+
+# import local modules
+from config_settings import *
+
+# ----------------------------------------------------------------------------
+# ETAGS
+# ----------------------------------------------------------------------------
+def get_etag(*parts):
+    '''Return a hash of parts (strings or bytes) for use as an ETag'''
+    etag_hash = hashlib.md5()
+    for part in parts:
+        etag_hash.update(part if isinstance(part, bytes) else str(part).encode())
+        etag_hash.update(b'\0')
+    return etag_hash.hexdigest()
+
+def get_files_version(filepaths):
+    '''Return a hash of the contents of filepaths, read once when called'''
+    contents = []
+    for filepath in sorted(str(filepath) for filepath in filepaths):
+        with open(filepath, 'rb') as f:
+            contents += [filepath, f.read()]
+    return get_etag(*contents)
+
+# ----------------------------------------------------------------------------
+# RESPONSE CACHE
+# ----------------------------------------------------------------------------
+# Final responses (body and headers, after compression) of this process by key, least recently used first. Keys
+# carry the snapshot version, so entries of older versions are never requested again and age out.
+_response_cache = OrderedDict()
+_response_cache_lock = threading.Lock()
+
+def get_cached_response(key):
+    with _response_cache_lock:
+        if key not in _response_cache:
+            return None
+        _response_cache.move_to_end(key)
+        return _response_cache[key]
+
+def cache_response(key, body, headers, max_entries = HTTP_RESPONSE_CACHE_SIZE):
+    '''Keep a response body and its headers under key, dropping the least recently used responses beyond
+    max_entries'''
+    with _response_cache_lock:
+        _response_cache[key] = (body, headers)
+        _response_cache.move_to_end(key)
+        while len(_response_cache) > max_entries:
+            _response_cache.popitem(last=False)
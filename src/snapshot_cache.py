@@ -0,0 +1,165 @@
+# Libraries
+import traceback
+
+# File Management
+import os # Operating system library
+import pathlib # file paths
+import json
+import pickle
+import hashlib
+import fcntl # file locks shared between gunicorn workers
+import time
+import threading
+from datetime import datetime
+import pandas as pd # Dataframe manipulations
+
+# import local modules
+from config_settings import *
+
+# ----------------------------------------------------------------------------
+# SNAPSHOT VERSIONING
+# ----------------------------------------------------------------------------
+
+def get_data_version(subjects_json):
+    '''Return a stable hash of the upstream subjects data. Snapshots built from data with the same version are
+    identical, so an unchanged upstream never triggers a pipeline rebuild.'''
+    data_hash = hashlib.md5()
+    for mcc in sorted(subjects_json, key=str):
+        data_hash.update(str(mcc).encode())
+        if isinstance(subjects_json[mcc], pd.DataFrame):
+            # Reports read by streaming ingestion
+            data_hash.update(','.join(subjects_json[mcc].columns).encode())
+            data_hash.update(pd.util.hash_pandas_object(subjects_json[mcc], index=False).values.tobytes())
+        else:
+            data_hash.update(json.dumps(subjects_json[mcc], sort_keys=True).encode())
+    return data_hash.hexdigest()
+
+def get_snapshot_version(subjects_json, asset_filepaths, report_month = None):
+    '''Return the version of a snapshot built from subjects_json with the asset files in asset_filepaths (report
+    configuration, display terms, screening sites and expectations). Expected enrollment runs through the current
+    month, so the report month (default: this month) is part of the version as well as the data and asset contents.'''
+    if report_month is None:
+        report_month = datetime.now().strftime('%Y-%m')
+    version_hash = hashlib.md5()
+    version_hash.update(get_data_version(subjects_json).encode())
+    version_hash.update(report_month.encode())
+    for filepath in sorted(str(filepath) for filepath in asset_filepaths):
+        version_hash.update(filepath.encode())
+        try:
+            with open(filepath, 'rb') as f:
+                version_hash.update(hashlib.md5(f.read()).digest())
+        except OSError:
+            version_hash.update(b'missing')
+    return version_hash.hexdigest()
+
+# ----------------------------------------------------------------------------
+# SNAPSHOT FILE STORE
+# ----------------------------------------------------------------------------
+
+def get_snapshot_filepath(snapshot_name, snapshot_path = SNAPSHOT_PATH):
+    return os.path.join(snapshot_path, snapshot_name + '.pkl')
+
+# Snapshots already unpickled by this process, keyed by file path and stored with the file's modification time
+_loaded_snapshots = {}
+
+def load_snapshot(snapshot_name, snapshot_path = SNAPSHOT_PATH):
+    '''Read a published snapshot from disk. Returns None if no readable snapshot exists. The file is only
+    unpickled again when another worker (or the refresher) has published a newer one.'''
+    snapshot_filepath = get_snapshot_filepath(snapshot_name, snapshot_path)
+    try:
+        mtime = os.stat(snapshot_filepath).st_mtime_ns
+        if snapshot_filepath in _loaded_snapshots and _loaded_snapshots[snapshot_filepath][0] == mtime:
+            return _loaded_snapshots[snapshot_filepath][1]
+        with open(snapshot_filepath, 'rb') as f:
+            snapshot = pickle.load(f)
+        _loaded_snapshots[snapshot_filepath] = (mtime, snapshot)
+        return snapshot
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        traceback.print_exc()
+        return None
+
+def save_snapshot(snapshot_name, snapshot, snapshot_path = SNAPSHOT_PATH):
+    '''Publish a snapshot atomically: write to a temporary file and rename it over the old snapshot so readers
+    in other workers never see a partially written file.'''
+    os.makedirs(snapshot_path, exist_ok=True)
+    snapshot_filepath = get_snapshot_filepath(snapshot_name, snapshot_path)
+    tmp_filepath = snapshot_filepath + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp_filepath, 'wb') as f:
+        pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_filepath, snapshot_filepath)
+
+def snapshot_is_fresh(snapshot, ttl = SNAPSHOT_TTL):
+    return snapshot is not None and (time.time() - snapshot.get('created', 0)) < ttl
+
+def get_snapshot(snapshot_name, build_snapshot, ttl = SNAPSHOT_TTL, snapshot_path = SNAPSHOT_PATH):
+    '''Return the cached snapshot if it is younger than ttl seconds. Otherwise rebuild it under an exclusive file
+    lock, so that when many workers find the cache stale at the same time only one of them runs build_snapshot and
+    the others pick up its result.
+
+    build_snapshot is called with the previous snapshot (or None) and returns the new snapshot dictionary.'''
+    snapshot = load_snapshot(snapshot_name, snapshot_path)
+    if snapshot_is_fresh(snapshot, ttl):
+        return snapshot
+
+    os.makedirs(snapshot_path, exist_ok=True)
+    lock_filepath = get_snapshot_filepath(snapshot_name, snapshot_path) + '.lock'
+    with open(lock_filepath, 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            # Another worker may have rebuilt the snapshot while this one waited on the lock
+            snapshot = load_snapshot(snapshot_name, snapshot_path)
+            if snapshot_is_fresh(snapshot, ttl):
+                return snapshot
+
+            try:
+                new_snapshot = build_snapshot(snapshot)
+            except Exception as e:
+                # Keep serving the stale snapshot (if there is one) rather than failing the page
+                traceback.print_exc()
+                return snapshot
+            new_snapshot['created'] = time.time()
+            save_snapshot(snapshot_name, new_snapshot, snapshot_path)
+            return new_snapshot
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+# ----------------------------------------------------------------------------
+# BACKGROUND REFRESH
+# ----------------------------------------------------------------------------
+
+# Refresher threads started by this process. Threads do not survive the fork of a preloaded gunicorn master, so
+# each entry records the pid that started it and a forked worker starts its own.
+_refreshers = {}
+_refreshers_lock = threading.Lock()
+
+def refresh_snapshot_loop(snapshot_name, build_snapshot, interval, ttl, snapshot_path):
+    while True:
+        try:
+            get_snapshot(snapshot_name, build_snapshot, ttl, snapshot_path)
+        except Exception as e:
+            traceback.print_exc()
+        time.sleep(interval)
+
+def start_snapshot_refresher(snapshot_name, build_snapshot, interval = SNAPSHOT_REFRESH_INTERVAL, ttl = SNAPSHOT_TTL, snapshot_path = SNAPSHOT_PATH):
+    '''Start a daemon thread in this process that rebuilds the snapshot off the request path whenever it goes
+    stale. Safe to call on every request: only the first call in each process starts a thread. Refreshers in
+    different workers coordinate through the snapshot lock, so a stale snapshot is rebuilt once.'''
+    with _refreshers_lock:
+        refresher = _refreshers.get(snapshot_name)
+        if refresher and refresher[0] == os.getpid() and refresher[1].is_alive():
+            return refresher[1]
+        thread = threading.Thread(target=refresh_snapshot_loop, name='refresh-' + snapshot_name, daemon=True,
+                                  args=(snapshot_name, build_snapshot, interval, ttl, snapshot_path))
+        thread.start()
+        _refreshers[snapshot_name] = (os.getpid(), thread)
+        return thread
+
+def get_published_snapshot(snapshot_name, build_snapshot, ttl = SNAPSHOT_TTL, snapshot_path = SNAPSHOT_PATH):
+    '''Return the most recently published snapshot without waiting on a rebuild, even if it is stale; the
+    background refresher replaces it. Only a cold start with nothing published builds in the request.'''
+    snapshot = load_snapshot(snapshot_name, snapshot_path)
+    if snapshot is None:
+        snapshot = get_snapshot(snapshot_name, build_snapshot, ttl, snapshot_path)
+    return snapshot
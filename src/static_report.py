@@ -0,0 +1,224 @@
+# Libraries
+import traceback
+
+# File Management
+import os # Operating system library
+import re
+import json
+import shutil
+import fcntl # file locks shared between gunicorn workers and the renderer
+import html as html_text # escaping of text in the static page
+
+import pandas as pd # Dataframe manipulations
+import plotly
+import plotly.io
+import plotly.offline
+
+# import local modules
+from config_settings import *
+
+# ----------------------------------------------------------------------------
+# LAYOUT COMPONENTS
+# ----------------------------------------------------------------------------
+# Static artifacts are read off the same dash component trees the live app serves, so the static report shows
+# exactly what the tabs show
+
+def iter_components(component):
+    '''Yield every dash component of a layout tree in document order'''
+    if isinstance(component, (list, tuple)):
+        for child in component:
+            yield from iter_components(child)
+    elif hasattr(component, '_type'):
+        yield component
+        yield from iter_components(getattr(component, 'children', None))
+
+def get_file_id(component_id):
+    '''File name for a component id. Pattern matching ids ({'type', 'index'}) are named by their index.'''
+    if isinstance(component_id, dict):
+        component_id = component_id.get('index', '')
+    return ''.join(char if char.isalnum() or char in '-_' else '_' for char in str(component_id))
+
+def get_table_frame(table, table_frames):
+    '''Return the DataTable column definitions and dataframe of a DataTable component. table_frames holds the full
+    (columns, dataframe) of server-side paged tables by file id, whose component only carries the first page.'''
+    file_id = get_file_id(table.id)
+    if file_id in table_frames:
+        return table_frames[file_id]
+    return table.columns, pd.DataFrame(table.data, columns=[col['id'] for col in table.columns])
+
+def get_column_names(table_columns):
+    '''Column names as tuples of header levels, padded to the same depth'''
+    col_names = [tuple(col['name']) if isinstance(col['name'], (list, tuple)) else (col['name'],) for col in table_columns]
+    header_depth = max([len(name) for name in col_names] + [1])
+    return [name + ('',) * (header_depth - len(name)) for name in col_names]
+
+# ----------------------------------------------------------------------------
+# STATIC PAGE
+# ----------------------------------------------------------------------------
+static_page_css = '''
+body { padding: 20px; }
+table.report-table { border-collapse: collapse; margin-bottom: 20px; font-size: small; }
+table.report-table th, table.report-table td { border: 1px solid #dee2e6; padding: 4px 8px; text-align: right; }
+'''
+
+def render_table_html(table_columns, table_df):
+    values_df = table_df[[col['id'] for col in table_columns]].copy()
+    col_names = get_column_names(table_columns)
+    values_df.columns = pd.MultiIndex.from_tuples(col_names) if len(col_names[0]) > 1 else [name[0] for name in col_names]
+    return values_df.to_html(index=False, na_rep='', border=0, classes='report-table')
+
+def render_component_html(component, table_frames):
+    '''Render a dash layout tree as static html. Html components keep their tag, bootstrap layout components become
+    divs, graphs are drawn with plotly.js and DataTables become html tables with every row. Interactive controls
+    have no static form and are left out.'''
+    if component is None:
+        return ''
+    if isinstance(component, (list, tuple)):
+        return ''.join(render_component_html(child, table_frames) for child in component)
+    if not hasattr(component, '_type'):
+        return html_text.escape(str(component))
+
+    children_html = render_component_html(getattr(component, 'children', None), table_frames)
+    if component._type == 'Graph':
+        return plotly.io.to_html(component.figure, include_plotlyjs=False, full_html=False)
+    if component._type == 'DataTable':
+        return render_table_html(*get_table_frame(component, table_frames))
+    if component._namespace == 'dash_html_components':
+        tag = component._type.lower()
+        href = getattr(component, 'href', None)
+        attributes = ' href="' + html_text.escape(href) + '"' if tag == 'a' and href else ''
+        return '<' + tag + attributes + '>' + children_html + '</' + tag + '>'
+    if component._namespace == 'dash_bootstrap_components' or component._type == 'Loading':
+        return '<div>' + children_html + '</div>'
+    return ''
+
+def get_plotlyjs_html(include_plotlyjs):
+    '''Script tag loading plotly.js: from the plotly CDN ('cdn'), from plotly.min.js next to the page ('directory')
+    or inline in the page ('inline'), which makes the page self-contained for email'''
+    if include_plotlyjs == 'inline':
+        return '<script type="text/javascript">' + plotly.offline.get_plotlyjs() + '</script>'
+    if include_plotlyjs == 'directory':
+        return '<script src="plotly.min.js"></script>'
+    return '<script src="https://cdn.plot.ly/plotly-' + plotly.offline.get_plotlyjs_version() + '.min.js"></script>'
+
+def build_static_page(title, header, sections, table_frames, stylesheets = (), include_plotlyjs = 'directory'):
+    '''Return a standalone html page with the header components followed by one section per (label, content) in
+    sections'''
+    sections_html = ''.join('<section><h2>' + html_text.escape(label) + '</h2>' + render_component_html(content, table_frames) + '</section>'
+                            for label, content in sections)
+    head_html = ''.join('<link rel="stylesheet" href="' + html_text.escape(href) + '">' for href in stylesheets)
+    return ('<!DOCTYPE html><html><head><meta charset="utf-8"><title>' + html_text.escape(title) + '</title>' + head_html +
+            '<style>' + static_page_css + '</style>' + get_plotlyjs_html(include_plotlyjs) + '</head><body>' +
+            render_component_html(header, table_frames) + sections_html + '</body></html>')
+
+# ----------------------------------------------------------------------------
+# ARTIFACTS
+# ----------------------------------------------------------------------------
+def write_json(value, filepath):
+    with open(filepath, 'w') as f:
+        json.dump(value, f, cls=plotly.utils.PlotlyJSONEncoder)
+
+def write_static_report(report_dir, layout, tabs, table_frames, page_html, include_plotlyjs = 'directory', manifest = None):
+    '''Write the static artifacts of a report to report_dir:
+
+    layout.json            the page layout, as served by the dash layout route
+    tabs/<tab>.json        the content of each tab, by tab value, for tabs in (value, label, content)
+    figures/<id>.json      each figure of the page and tabs, by graph id
+    tables/<id>.csv        every row of each table, by table id, with header levels joined by ': '
+    index.html             page_html
+    manifest.json          manifest, with the list of files written
+
+    table_frames holds the full (columns, dataframe) of server-side paged tables by file id (see get_table_frame).'''
+    for sub_dir in ['tabs', 'figures', 'tables']:
+        os.makedirs(os.path.join(report_dir, sub_dir), exist_ok=True)
+    files = ['layout.json', 'index.html']
+    write_json(layout, os.path.join(report_dir, 'layout.json'))
+    with open(os.path.join(report_dir, 'index.html'), 'w', encoding='utf-8') as f:
+        f.write(page_html)
+    if include_plotlyjs == 'directory':
+        with open(os.path.join(report_dir, 'plotly.min.js'), 'w', encoding='utf-8') as f:
+            f.write(plotly.offline.get_plotlyjs())
+        files.append('plotly.min.js')
+
+    for tab, label, content in tabs:
+        tab_file = 'tabs/' + get_file_id(tab) + '.json'
+        write_json(content, os.path.join(report_dir, tab_file))
+        files.append(tab_file)
+
+    components = list(iter_components([layout] + [content for tab, label, content in tabs]))
+    for graph in [c for c in components if c._type == 'Graph' and getattr(c, 'id', None)]:
+        figure_file = 'figures/' + get_file_id(graph.id) + '.json'
+        write_json(graph.figure, os.path.join(report_dir, figure_file))
+        files.append(figure_file)
+    for table in [c for c in components if c._type == 'DataTable' and getattr(c, 'id', None)]:
+        table_columns, table_df = get_table_frame(table, table_frames)
+        table_file = 'tables/' + get_file_id(table.id) + '.csv'
+        csv_df = table_df[[col['id'] for col in table_columns]].copy()
+        csv_df.columns = [': '.join(level for level in name if level) for name in get_column_names(table_columns)]
+        csv_df.to_csv(os.path.join(report_dir, table_file), index=False)
+        files.append(table_file)
+
+    write_json(dict(manifest or {}, files=sorted(set(files))), os.path.join(report_dir, 'manifest.json'))
+
+# ----------------------------------------------------------------------------
+# STATIC REPORT STORE
+# ----------------------------------------------------------------------------
+# Each data version is written to its own directory, named by the version (a hex hash), and published by rewriting
+# the 'current' file, so the server never sends a mix of files from two versions. A version rendered again is written
+# to '<version>.<n>' and published the same way, so the current report stays in place until the new one replaces it.
+# Only report directories and the '*.tmp' work directories of this module are ever removed from the directory.
+report_dir_name_pattern = re.compile(r'^[0-9a-f]+(\.[0-9]+)?$')
+
+def get_static_report_path(static_report_path = STATIC_REPORT_PATH):
+    '''Return the directory of the current static report, or None if none has been published'''
+    try:
+        with open(os.path.join(static_report_path, 'current')) as f:
+            report_dir_name = f.read().strip()
+    except OSError:
+        return None
+    report_dir = os.path.join(static_report_path, report_dir_name)
+    return report_dir if report_dir_name and os.path.isdir(report_dir) else None
+
+def get_new_report_dir_name(version, static_report_path):
+    '''Name of a directory for a new render of version that does not exist yet'''
+    report_dir_name, revision = version, 0
+    while os.path.exists(os.path.join(static_report_path, report_dir_name)):
+        revision += 1
+        report_dir_name = version + '.' + str(revision)
+    return report_dir_name
+
+def publish_static_report(version, write_report, static_report_path = STATIC_REPORT_PATH, force = False):
+    '''Write the static report of this data version with write_report(report_dir) and make it the current one.
+    write_report is not called if the version is already the current one, unless force is set. Renderers share the
+    directory, and an exclusive lock makes sure each version is written once. Once the new report is current, the
+    report directories of other versions and left over work directories are removed. Returns the report directory,
+    or None if it cannot be written.'''
+    os.makedirs(static_report_path, exist_ok=True)
+    with open(os.path.join(static_report_path, 'static_report.lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        tmp_dir = os.path.join(static_report_path, version + '.' + str(os.getpid()) + '.tmp')
+        try:
+            report_dir = get_static_report_path(static_report_path)
+            if force or not report_dir or os.path.basename(report_dir).split('.')[0] != version:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                write_report(tmp_dir)
+                report_dir = os.path.join(static_report_path, get_new_report_dir_name(version, static_report_path))
+                os.rename(tmp_dir, report_dir)
+
+                tmp_current = os.path.join(static_report_path, 'current.' + str(os.getpid()) + '.tmp')
+                with open(tmp_current, 'w') as f:
+                    f.write(os.path.basename(report_dir))
+                os.replace(tmp_current, os.path.join(static_report_path, 'current'))
+
+            for entry in os.listdir(static_report_path):
+                entry_path = os.path.join(static_report_path, entry)
+                if (entry != os.path.basename(report_dir) and os.path.isdir(entry_path) and
+                        (report_dir_name_pattern.match(entry) or entry.endswith('.tmp'))):
+                    shutil.rmtree(entry_path, ignore_errors=True)
+            return report_dir
+        except Exception as e:
+            traceback.print_exc()
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return None
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -0,0 +1,23 @@
+# Libraries
+import os # Operating system library
+import sys
+import atexit
+import shutil
+import tempfile
+
+# The app modules are flat modules in src, imported by name as the app does; the benchmarks hold the synthetic
+# subjects generator and the reference implementations the tests compare against
+TESTS_PATH = os.path.dirname(os.path.abspath(__file__))
+for path in [os.path.join(TESTS_PATH, '..', 'src'), os.path.join(TESTS_PATH, '..', 'benchmarks')]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+# Work files of the app and pipeline go to a scratch directory, and stage logging is turned off, before any module
+# reads config_settings
+SCRATCH_PATH = tempfile.mkdtemp(prefix='tests_')
+atexit.register(shutil.rmtree, SCRATCH_PATH, ignore_errors=True)
+for setting in ['SNAPSHOT_PATH', 'ENROLLED_STORE_PATH', 'EXPORT_PATH', 'METRICS_PATH', 'STATIC_REPORT_PATH']:
+    os.environ.setdefault(setting, os.path.join(SCRATCH_PATH, setting.lower()))
+os.environ.setdefault('STAGE_LOGGING', 'false')
+# Responses are compressed as they are in production, so the HTTP caching tests cover compressed responses
+os.environ.setdefault('HTTP_COMPRESSION', 'br,gzip')
@@ -0,0 +1,93 @@
+# Libraries
+import pandas as pd # Dataframe manipulations
+import pytest
+
+from config_settings import ASSETS_PATH
+from data_processing import (load_display_terms, load_screening_sites, combine_mcc_json, get_enrolled, compact_enrolled,
+                             build_screening_site_index)
+from synthetic_subjects import make_subjects_json
+from bench_get_enrolled import clean_enrolled_previous
+
+# ----------------------------------------------------------------------------
+# FIXTURES
+# ----------------------------------------------------------------------------
+@pytest.fixture(scope='module')
+def display_terms():
+    display_terms, display_terms_dict, display_terms_dict_multi = load_display_terms(ASSETS_PATH, 'A2CPS_display_terms.csv')
+    return display_terms_dict, display_terms_dict_multi
+
+@pytest.fixture(scope='module')
+def screening_sites():
+    return load_screening_sites(ASSETS_PATH, 'screening_sites.csv')
+
+def make_subject(record_id, obtain_date, redcap_data_access_group, sp_data_site = 'N/A', ewdateterm = 'N/A'):
+    return {'main_record_id': record_id, 'obtain_date': obtain_date, 'ewdateterm': ewdateterm,
+            'redcap_data_access_group': redcap_data_access_group, 'sp_data_site': sp_data_site}
+
+def get_site_record_id(screening_sites, mcc, position = 0):
+    '''A record id inside the record_id range of an MCC screening site'''
+    mcc_sites = screening_sites[screening_sites.mcc == mcc]
+    return str(int(mcc_sites.record_id_start.iloc[position]) + 1)
+
+@pytest.fixture(scope='module')
+def subjects_json(screening_sites):
+    '''Synthetic reports of both MCCs with edge rows added'''
+    mcc_json = {mcc: make_subjects_json(mcc, 2000, screening_sites, seed=7) for mcc in [1, 2]}
+    mcc1_id, mcc2_id = get_site_record_id(screening_sites, 1), get_site_record_id(screening_sites, 2)
+    mcc_json[1].update({
+        # consented without a parseable consent date
+        mcc1_id: make_subject(mcc1_id, 'not a date', 'rush_university_me'),
+        # outside every screening site range
+        '9999999': make_subject('9999999', '2022-03-04', 'rush_university_me'),
+        '-5': make_subject('-5', '2022-03-04', 'northshore'),
+        # unknown data access group code
+        get_site_record_id(screening_sites, 1, 1): make_subject(get_site_record_id(screening_sites, 1, 1), '2022-05-06', 'unknown_group'),
+    })
+    mcc_json[2].update({
+        # the same subject also reported by MCC 1
+        mcc1_id: make_subject(mcc1_id, '2022-01-02', 'university_of_mich', '2'),
+        # missing treatment site and data access group
+        mcc2_id: make_subject(mcc2_id, '2022-07-08', 'N/A', 'N/A'),
+    })
+    return mcc_json
+
+# ----------------------------------------------------------------------------
+# ENROLLED CLEANING
+# ----------------------------------------------------------------------------
+def test_get_enrolled_matches_previous_cleaning(subjects_json, screening_sites, display_terms):
+    enrolled = get_enrolled(subjects_json, screening_sites, *display_terms)
+
+    subjects_raw = combine_mcc_json(subjects_json).reset_index(drop=True)
+    previous = clean_enrolled_previous(subjects_raw, screening_sites, *display_terms)
+    pd.testing.assert_frame_equal(compact_enrolled(previous[enrolled.columns].copy()), enrolled)
+
+def test_get_enrolled_edge_rows(subjects_json, screening_sites, display_terms):
+    enrolled = get_enrolled(subjects_json, screening_sites, *display_terms)
+    mcc1_id, mcc2_id = get_site_record_id(screening_sites, 1), get_site_record_id(screening_sites, 2)
+    record_ids = enrolled['record_id'].astype(str)
+
+    # Records outside every screening site range are dropped
+    assert not record_ids.isin(['9999999', '-5']).any()
+    # A subject reported by two MCCs is kept once per report
+    duplicate = enrolled[record_ids == mcc1_id]
+    assert sorted(duplicate['mcc']) == [1, 2]
+    # An unparseable consent date is kept as a missing date and month
+    mcc1_row = duplicate[duplicate['mcc'] == 1].iloc[0]
+    assert pd.isnull(mcc1_row['obtain_date']) and pd.isnull(mcc1_row['obtain_month'])
+    # The treatment site falls back to the data access group, and is missing when both are
+    mcc2_row = duplicate[duplicate['mcc'] == 2].iloc[0]
+    assert mcc2_row['treatment_site'] == mcc2_row['sp_data_site_display']
+    missing_row = enrolled[record_ids == mcc2_id].iloc[0]
+    assert pd.isnull(missing_row['treatment_site']) and pd.isnull(missing_row['treatment_site_type'])
+    # Unknown display term codes translate to missing values
+    unknown_row = enrolled[record_ids == get_site_record_id(screening_sites, 1, 1)].iloc[0]
+    assert pd.isnull(unknown_row['redcap_data_access_group_display'])
+
+def test_overlapping_site_ranges_are_logged(screening_sites, caplog):
+    assert not build_screening_site_index(screening_sites)['overlapping']
+    assert not caplog.records
+    overlapping_sites = screening_sites.copy()
+    overlapping_sites.loc[overlapping_sites.index[0], 'record_id_end'] = overlapping_sites['record_id_end'].max()
+    assert build_screening_site_index(overlapping_sites)['overlapping']
+    assert [record.levelname for record in caplog.records] == ['WARNING']
+    assert 'ranges overlap' in caplog.records[0].getMessage()
@@ -0,0 +1,98 @@
+# Libraries
+import os # Operating system library
+import random
+
+import pandas as pd # Dataframe manipulations
+import pytest
+
+from config_settings import ASSETS_PATH
+from data_processing import load_display_terms, load_screening_sites, get_enrolled, get_report_data, update_base_rollup
+import enrolled_store
+from enrolled_store import get_enrolled_delta, get_enrolled_store_key, load_enrolled_store
+from synthetic_subjects import make_subjects_json
+
+# ----------------------------------------------------------------------------
+# FIXTURES
+# ----------------------------------------------------------------------------
+@pytest.fixture(scope='module')
+def display_terms():
+    display_terms, display_terms_dict, display_terms_dict_multi = load_display_terms(ASSETS_PATH, 'A2CPS_display_terms.csv')
+    return display_terms_dict, display_terms_dict_multi
+
+@pytest.fixture(scope='module')
+def screening_sites():
+    return load_screening_sites(ASSETS_PATH, 'screening_sites.csv')
+
+def make_pulls(screening_sites, n_pulls):
+    '''Successive subjects pulls: each changes consent dates, withdraws, deletes and adds records, and the last
+    reinstates a subject withdrawn in an earlier pull'''
+    rng = random.Random(3)
+    subjects_json = {mcc: make_subjects_json(mcc, 1500, screening_sites, seed=5) for mcc in [1, 2]}
+    pulls = [subjects_json]
+    withdrawn = {}
+    for pull in range(n_pulls):
+        subjects_json = {mcc: {record_id: dict(record) for record_id, record in records.items()} for mcc, records in subjects_json.items()}
+        for mcc, records in subjects_json.items():
+            consented = [record_id for record_id, record in sorted(records.items()) if record['obtain_date'] != 'N/A' and record['ewdateterm'] == 'N/A']
+            for record_id in rng.sample(consented, 15):
+                records[record_id]['obtain_date'] = '2022-0{}-11'.format(rng.randint(1, 9))
+            for record_id in rng.sample(consented, 10):
+                withdrawn[(mcc, record_id)] = records[record_id]['ewdateterm']
+                records[record_id]['ewdateterm'] = '2022-05-01'
+            for record_id in rng.sample(sorted(records), 5):
+                del records[record_id]
+            new_records = make_subjects_json(mcc, 1520, screening_sites, seed=5 + pull + 1)
+            for record_id in sorted(set(new_records) - set(records))[:20]:
+                records[record_id] = new_records[record_id]
+        if pull == n_pulls - 1:
+            for (mcc, record_id), ewdateterm in list(withdrawn.items())[:5]:
+                if record_id in subjects_json[mcc]:
+                    subjects_json[mcc][record_id]['ewdateterm'] = ewdateterm
+        pulls.append(subjects_json)
+    return pulls
+
+def sort_enrolled(enrolled):
+    return enrolled.drop(columns=['source_hash'], errors='ignore').sort_values(['mcc', 'record_id'], ignore_index=True)
+
+# ----------------------------------------------------------------------------
+# INCREMENTAL UPDATE
+# ----------------------------------------------------------------------------
+@pytest.mark.parametrize('max_segments', [24, 2])
+def test_incremental_update_equals_full_rebuild(tmp_path, monkeypatch, screening_sites, display_terms, max_segments):
+    # With 2 segments the store is compacted every other pull
+    monkeypatch.setattr(enrolled_store, 'ENROLLED_STORE_MAX_SEGMENTS', max_segments)
+    store_path = str(tmp_path / 'enrolled_store')
+    pulls = make_pulls(screening_sites, 4)
+
+    delta = get_enrolled_delta(pulls[0], screening_sites, *display_terms, store_path=store_path)
+    assert delta['rebuilt']
+    report_data = get_report_data(delta['enrolled'], screening_sites)
+
+    for subjects_json in pulls[1:]:
+        previous_generation = delta['generation']
+        delta = get_enrolled_delta(subjects_json, screening_sites, *display_terms, store_path=store_path)
+        assert not delta['rebuilt'] and delta['previous_generation'] == previous_generation
+        assert len(delta['added']) > 0 and len(delta['removed']) > 0
+
+        full_enrolled = get_enrolled(subjects_json, screening_sites, *display_terms)
+        pd.testing.assert_frame_equal(sort_enrolled(delta['enrolled']), sort_enrolled(full_enrolled))
+        # The store reads back as the updated dataframe
+        stored, excluded_hashes, generation = load_enrolled_store(get_enrolled_store_key(screening_sites, *display_terms), store_path)
+        assert generation == delta['generation']
+        pd.testing.assert_frame_equal(sort_enrolled(stored), sort_enrolled(full_enrolled))
+        assert len([f for f in os.listdir(store_path) if f.endswith('.feather')]) <= max_segments
+
+        base_rollup = update_base_rollup(report_data['base_rollup'], delta['added'], delta['removed'], delta['enrolled'])
+        report_data = get_report_data(delta['enrolled'], screening_sites, base_rollup=base_rollup)
+        full_report_data = get_report_data(full_enrolled, screening_sites)
+        for key in ['base_rollup', 'enrollment_count', 'summary_rollup', 'expected_plot_df', 'site_performance']:
+            pd.testing.assert_frame_equal(report_data[key], full_report_data[key])
+        for mcc in full_report_data['site_enrollments']:
+            pd.testing.assert_frame_equal(report_data['site_enrollments'][mcc], full_report_data['site_enrollments'][mcc])
+        assert report_data['summary_options_list'] == full_report_data['summary_options_list']
+
+    # A pull with no changes leaves the store as it is
+    unchanged = get_enrolled_delta(pulls[-1], screening_sites, *display_terms, store_path=store_path)
+    assert len(unchanged['added']) == 0 and len(unchanged['removed']) == 0
+    assert unchanged['generation'] == delta['generation']
+    assert update_base_rollup(report_data['base_rollup'], unchanged['added'], unchanged['removed'], unchanged['enrolled']) is report_data['base_rollup']
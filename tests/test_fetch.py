@@ -0,0 +1,119 @@
+# Libraries
+import os
+import json
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+# import local modules
+import data_processing
+from data_processing import fetch_mcc_json, get_subjects_json, get_report_meta_filepath
+
+REPORT = 'subjects'
+REPORT_SUFFIX = 'subjects-[mcc]-latest.json'
+READ_TIMEOUT = 0.5
+
+def make_report(mcc):
+    return {str(1000 * mcc + n): {'main_record_id': str(1000 * mcc + n), 'obtain_date': '2022-01-0' + str(n),
+                                  'ewdateterm': 'N/A', 'redcap_data_access_group': 'group_' + str(mcc),
+                                  'sp_data_site': 'N/A'} for n in range(1, 4)}
+
+# ----------------------------------------------------------------------------
+# LOCAL API SERVER
+# ----------------------------------------------------------------------------
+class ReportHandler(BaseHTTPRequestHandler):
+    '''Serve the reports of the server state by path. Mode 'ok' answers with the report and its ETag, or a 304 if
+    the request carries the current ETag; 'error' answers every request with a 503 and 'timeout' answers after the
+    read timeout of the client.'''
+    def do_GET(self):
+        state = self.server.state
+        state['requests'].append((self.path, self.headers.get('If-None-Match')))
+        if state['mode'] == 'error':
+            self.send_response(503)
+            self.end_headers()
+            return
+        if state['mode'] == 'timeout':
+            time.sleep(READ_TIMEOUT * 4)
+        body = json.dumps(state['reports'][self.path]).encode()
+        etag = '"' + str(hash(body)) + '"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def report_server(monkeypatch):
+    '''Serve the reports of MCC 1 and 2 on a local port, with a client session that retries once without backoff
+    and times out quickly. Yields the url root and the server state.'''
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ReportHandler)
+    server.daemon_threads = True
+    server.state = {'mode': 'ok', 'requests': [],
+                    'reports': {'/' + REPORT + '/' + REPORT_SUFFIX.replace('[mcc]', str(mcc)): make_report(mcc) for mcc in [1, 2]}}
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    monkeypatch.setattr(data_processing, 'HTTP_RETRIES', 1)
+    monkeypatch.setattr(data_processing, 'HTTP_BACKOFF', 0)
+    monkeypatch.setattr(data_processing, 'HTTP_TIMEOUT', (READ_TIMEOUT, READ_TIMEOUT))
+    monkeypatch.setattr(data_processing, '_http_session', None)
+    yield 'http://127.0.0.1:' + str(server.server_address[1]), server.state
+    server.shutdown()
+    server.server_close()
+
+# ----------------------------------------------------------------------------
+# TESTS
+# ----------------------------------------------------------------------------
+def test_fetch_keeps_etag_and_reuses_copy_on_304(report_server, tmp_path):
+    url_root, state = report_server
+    json_url = url_root + '/' + REPORT + '/subjects-1-latest.json'
+    mcc_filepath = str(tmp_path / 'subjects-1-latest.json')
+
+    assert fetch_mcc_json(json_url, mcc_filepath) == make_report(1)
+    with open(get_report_meta_filepath(mcc_filepath)) as f:
+        meta = json.load(f)
+    assert meta['etag'] and meta['fetched']
+    assert state['requests'] == [('/' + REPORT + '/subjects-1-latest.json', None)]
+
+    # The second request is conditional on the ETag, and the 304 is answered from the file on disk
+    first_mtime = os.path.getmtime(mcc_filepath)
+    assert fetch_mcc_json(json_url, mcc_filepath) == make_report(1)
+    assert state['requests'][-1][1] == meta['etag']
+    assert os.path.getmtime(mcc_filepath) == first_mtime
+    with open(get_report_meta_filepath(mcc_filepath)) as f:
+        assert json.load(f)['fetched'] >= meta['fetched']
+
+@pytest.mark.parametrize('mode', ['error', 'timeout'])
+def test_api_failure_falls_back_to_last_good_copy(report_server, tmp_path, mode):
+    from app import build_freshness_list
+    url_root, state = report_server
+    subjects_json, data_source, data_date, mcc_status = get_subjects_json(REPORT, REPORT_SUFFIX, url_root, [1, 2], str(tmp_path), streaming=False)
+    assert data_source == 'API'
+    assert [status['source'] for status in mcc_status.values()] == ['API', 'API']
+    fetched = {mcc: status['fetched'] for mcc, status in mcc_status.items()}
+
+    state['mode'] = mode
+    subjects_json, data_source, data_date, mcc_status = get_subjects_json(REPORT, REPORT_SUFFIX, url_root, [1, 2], str(tmp_path), streaming=False)
+    assert subjects_json == {1: make_report(1), 2: make_report(2)}
+    assert data_source == 'local files'
+    assert mcc_status == {mcc: {'source': 'last good copy', 'fetched': fetched[mcc]} for mcc in [1, 2]}
+    freshness_text = [item.children for item in build_freshness_list(mcc_status).children]
+    assert all(text.startswith('MCC' + str(mcc) + ': API unavailable, showing data from ')
+               for mcc, text in zip([1, 2], freshness_text))
+
+def test_api_failure_without_copy_is_unavailable(report_server, tmp_path):
+    url_root, state = report_server
+    state['mode'] = 'error'
+    subjects_json, data_source, data_date, mcc_status = get_subjects_json(REPORT, REPORT_SUFFIX, url_root, [1], str(tmp_path), streaming=False)
+    assert subjects_json == {}
+    assert data_date == 'unavailable'
+    assert mcc_status == {1: {'source': 'unavailable', 'fetched': None}}
@@ -0,0 +1,78 @@
+# Libraries
+import os
+import pathlib
+import functools
+import threading
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+import pytest
+
+# import local modules
+from synthetic_subjects import write_subjects_files
+from static_report import publish_static_report
+import app
+
+BROWSER_HEADERS = {'Accept-Encoding': 'gzip, deflate, br'}
+
+class QuietRequestHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture(scope='module')
+def client(tmp_path_factory):
+    '''Test client of the app with a snapshot built from synthetic reports served on a local port'''
+    reports_path = str(tmp_path_factory.mktemp('reports'))
+    write_subjects_files(os.path.join(reports_path, app.report), 500, app.mcc_list, report_suffix=app.report_suffix)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(QuietRequestHandler, directory=reports_path))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(app, 'DATA_PATH', pathlib.Path(str(tmp_path_factory.mktemp('downloads'))))
+        monkeypatch.setattr(app, 'file_url_root', 'http://127.0.0.1:' + str(server.server_address[1]))
+        # Keep the background refresher from replacing the snapshot between requests
+        monkeypatch.setattr(app, 'start_snapshot_refresher', lambda *args, **kwargs: None)
+        yield app.server.test_client()
+    server.shutdown()
+    server.server_close()
+
+def get(client, path, headers):
+    response = client.get(path, headers=headers)
+    response.close()
+    return response
+
+def test_compressed_layout_revalidates(client):
+    assert app.HTTP_COMPRESSION
+    response = get(client, app.layout_route, BROWSER_HEADERS)
+    assert response.status_code == 200
+    assert response.headers['Content-Encoding'] == 'br'
+    etag = response.headers['ETag']
+    # The layout carries a weak ETag of the snapshot, which compression leaves as it is
+    assert etag.startswith('W/"') and not etag.endswith(':br"')
+
+    revalidated = get(client, app.layout_route, dict(BROWSER_HEADERS, **{'If-None-Match': etag}))
+    assert revalidated.status_code == 304
+    assert revalidated.headers['ETag'] == etag
+
+    # Answered from the response cache, compressed for each encoding the browser accepts
+    cached = get(client, app.layout_route, BROWSER_HEADERS)
+    assert (cached.status_code, cached.headers['Content-Encoding'], cached.headers['ETag']) == (200, 'br', etag)
+    assert get(client, app.layout_route, {'Accept-Encoding': 'gzip'}).headers['Content-Encoding'] == 'gzip'
+
+def test_compressed_static_report_revalidates(client):
+    def write_report(report_dir):
+        os.makedirs(os.path.join(report_dir, 'tables'))
+        pathlib.Path(report_dir, 'tables', 'enrollments.csv').write_text('month,site,enrolled\n' + '2022-01,UT,12\n' * 500)
+    publish_static_report('c' * 32, write_report)
+    path = app.static_report_route + 'tables/enrollments.csv'
+    response = get(client, path, BROWSER_HEADERS)
+    assert response.status_code == 200
+    # Static report files are sent as they are on disk, with the strong ETag of the file
+    assert 'Content-Encoding' not in response.headers
+    etag = response.headers['ETag']
+    assert etag.startswith('"') and not etag.endswith(':br"')
+
+    revalidate_headers = dict(BROWSER_HEADERS, **{'If-None-Match': etag, 'If-Modified-Since': response.headers['Last-Modified']})
+    revalidated = get(client, path, revalidate_headers)
+    assert revalidated.status_code == 304
+    assert revalidated.headers['ETag'] == etag
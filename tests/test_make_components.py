@@ -0,0 +1,33 @@
+# Libraries
+import pandas as pd
+
+# import local modules
+from make_components import filter_table_frame, sort_table_frame
+
+TABLE = pd.DataFrame({
+    'Date_Year': ['2021', '2022', '2022', '2023'],
+    'Site': ['UT', 'UC', 'UT', 'UC'],
+    'Count': [5, 1200, 30, 7],
+    'Percent': ['100.0%', '20.0%', '', '9.5%'],
+})
+
+def test_filter_compares_text_columns_by_value():
+    assert filter_table_frame(TABLE, '{Date_Year} = 2022')['Count'].tolist() == [1200, 30]
+    assert filter_table_frame(TABLE, '{Date_Year} != 2022')['Count'].tolist() == [5, 7]
+    assert filter_table_frame(TABLE, '{Date_Year} > 2021 && {Date_Year} < 2023')['Count'].tolist() == [1200, 30]
+    assert filter_table_frame(TABLE, '{Percent} >= 20')['Count'].tolist() == [5, 1200]
+    assert filter_table_frame(TABLE, '{Count} > 10')['Count'].tolist() == [1200, 30]
+    assert filter_table_frame(TABLE, '{Site} = UT')['Count'].tolist() == [5, 30]
+    assert filter_table_frame(TABLE, '{Site} = "UC" && {Date_Year} ge 2022')['Count'].tolist() == [1200, 7]
+    # A number column never matches text
+    assert filter_table_frame(TABLE, '{Count} > UT').empty
+    assert filter_table_frame(TABLE, '{Site} contains T')['Count'].tolist() == [5, 30]
+
+def test_sort_orders_percent_columns_by_value():
+    percent_asc = sort_table_frame(TABLE, [{'column_id': 'Percent', 'direction': 'asc'}])
+    assert percent_asc['Percent'].tolist() == ['9.5%', '20.0%', '100.0%', '']
+    percent_desc = sort_table_frame(TABLE, [{'column_id': 'Percent', 'direction': 'desc'}])
+    assert percent_desc['Percent'].tolist() == ['100.0%', '20.0%', '9.5%', '']
+    # Text columns sort as text, ties keep their order
+    site_year = sort_table_frame(TABLE, [{'column_id': 'Site', 'direction': 'asc'}, {'column_id': 'Date_Year', 'direction': 'desc'}])
+    assert site_year['Count'].tolist() == [7, 1200, 30, 5]
@@ -0,0 +1,23 @@
+# Libraries
+from snapshot_cache import get_data_version, get_snapshot_version
+
+SUBJECTS_JSON = {1: {'1001': {'obtain_date': '2022-01-02', 'ewdateterm': 'N/A'}}}
+
+def test_snapshot_version_tracks_data_month_and_assets(tmp_path):
+    asset_file = tmp_path / 'screening_sites.csv'
+    asset_file.write_text('record_id_start,record_id_end\n1000,1999\n')
+    version = get_snapshot_version(SUBJECTS_JSON, [asset_file], '2022-01')
+
+    assert get_snapshot_version(SUBJECTS_JSON, [asset_file], '2022-01') == version
+    # A new report month extends the expected enrollment grid
+    assert get_snapshot_version(SUBJECTS_JSON, [asset_file], '2022-02') != version
+    # So does new subjects data
+    changed_json = {1: {'1001': {'obtain_date': '2022-01-03', 'ewdateterm': 'N/A'}}}
+    assert get_data_version(changed_json) != get_data_version(SUBJECTS_JSON)
+    assert get_snapshot_version(changed_json, [asset_file], '2022-01') != version
+    # And an edited or missing asset file
+    asset_file.write_text('record_id_start,record_id_end\n1000,2999\n')
+    edited_version = get_snapshot_version(SUBJECTS_JSON, [asset_file], '2022-01')
+    assert edited_version != version
+    asset_file.unlink()
+    assert get_snapshot_version(SUBJECTS_JSON, [asset_file], '2022-01') not in [version, edited_version]
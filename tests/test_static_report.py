@@ -0,0 +1,54 @@
+# Libraries
+import os
+
+# import local modules
+from static_report import get_static_report_path, publish_static_report
+
+VERSION_1 = 'a' * 32
+VERSION_2 = 'b' * 32
+
+def write_index(text):
+    def write_report(report_dir):
+        os.makedirs(report_dir)
+        with open(os.path.join(report_dir, 'index.html'), 'w') as f:
+            f.write(text)
+    return write_report
+
+def read_current_index(static_report_path):
+    with open(os.path.join(get_static_report_path(static_report_path), 'index.html')) as f:
+        return f.read()
+
+def test_publish_replaces_current_report_in_place(tmp_path):
+    static_report_path = str(tmp_path)
+    assert get_static_report_path(static_report_path) is None
+    first_dir = publish_static_report(VERSION_1, write_index('first'), static_report_path)
+    assert first_dir == get_static_report_path(static_report_path)
+    assert read_current_index(static_report_path) == 'first'
+
+    # The current version is not written again unless forced
+    def fail_report(report_dir):
+        raise AssertionError('written again')
+    assert publish_static_report(VERSION_1, fail_report, static_report_path) == first_dir
+
+    # While a forced render is written, the current report is still served
+    def write_forced(report_dir):
+        assert read_current_index(static_report_path) == 'first'
+        write_index('forced')(report_dir)
+    forced_dir = publish_static_report(VERSION_1, write_forced, static_report_path, force=True)
+    assert forced_dir != first_dir and not os.path.exists(first_dir)
+    assert read_current_index(static_report_path) == 'forced'
+
+    # A failed render leaves the current report in place
+    def write_broken(report_dir):
+        os.makedirs(report_dir)
+        raise ValueError('render failed')
+    assert publish_static_report(VERSION_2, write_broken, static_report_path) is None
+    assert read_current_index(static_report_path) == 'forced'
+
+    # Only report directories of other versions and work directories are removed
+    os.makedirs(os.path.join(static_report_path, 'shared_assets'))
+    os.makedirs(os.path.join(static_report_path, VERSION_1 + '.123.tmp'))
+    second_dir = publish_static_report(VERSION_2, write_index('second'), static_report_path)
+    assert read_current_index(static_report_path) == 'second'
+    assert sorted(entry for entry in os.listdir(static_report_path) if os.path.isdir(os.path.join(static_report_path, entry))) == \
+        sorted(['shared_assets', os.path.basename(second_dir)])